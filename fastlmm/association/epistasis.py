@@ -8,6 +8,8 @@ from fastlmm.inference import LMM
 import scipy.stats as stats
 from pysnptools.snpreader import Bed
 from fastlmm.util.pickle_io import load, save
+from fastlmm.util.result_file import write_results
+from fastlmm.util.sorted_writer import SortedWriter
 import time
 import pandas as pd
 from unittest.mock import patch
@@ -29,6 +31,8 @@ def epistasis(
     cache_file=None,
     runner=None,
     count_A1=None,
+    log_delta_optimizer="grid",
+    output_top_n=None,
 ):
     """
     Function performing epistasis GWAS.  See http://www.nature.com/srep/2013/130122/srep01099/full/srep01099.html.
@@ -67,7 +71,8 @@ def epistasis(
             If you give no sid_list_1, all sids in test_snps will be used.
     :type sid_list_1: list of strings
 
-    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text.
+    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text,
+         unless the name ends in '.parquet' or '.feather' (these need 'pyarrow', see :mod:`fastlmm.util.result_file`).
     :type output_file_name: file name
 
     :param log_delta: A parameter to LMM learning, optional
@@ -98,6 +103,15 @@ def epistasis(
          alleles (the PLINK standard) or the number of A2 alleles. False is the current default, but in the future the default will change to True.
     :type count_A1: bool
 
+    :param log_delta_optimizer: (default:"grid")
+            When searching for log_delta, "grid" evaluates a grid and refines it with Brent's method.
+            "newton" takes Newton steps in log_delta and falls back to the grid if they don't find the minimum.
+    :type log_delta_optimizer: string
+
+    :param output_top_n: (default:None) If given, output_file_name must be given. Results are spilled, sorted, to disk
+            and merged into output_file_name, so memory does not grow with the number of pairs.
+            Only the output_top_n pairs with the smallest PValue are returned.
+    :type output_top_n: number
 
     :rtype: Pandas dataframe with one row per SNP pair. Columns include "PValue"
 
@@ -139,6 +153,8 @@ def epistasis(
             output_file_name,
             cache_file,
             count_A1=count_A1,
+            log_delta_optimizer=log_delta_optimizer,
+            output_top_n=output_top_n,
         )
         logging.info("# of pairs is {0}".format(epistasis.pair_count))
         epistasis.fill_in_cache_file()
@@ -176,6 +192,8 @@ class _Epistasis(object):  # implements IDistributable
         output_file=None,
         cache_file=None,
         count_A1=None,
+        log_delta_optimizer="grid",
+        output_top_n=None,
     ):
         self._ran_once = False
 
@@ -197,6 +215,11 @@ class _Epistasis(object):  # implements IDistributable
         self.external_log_delta = log_delta
         self.min_log_delta = min_log_delta
         self.max_log_delta = max_log_delta
+        self.log_delta_optimizer = log_delta_optimizer
+        self.output_top_n = output_top_n
+        assert (
+            output_top_n is None or output_file is not None
+        ), "output_top_n requires an output_file_name"
         self._str = "{0}({1},{2},G0={6},G1={7},mixing={8},covar={3},output_file={12},sid_list_0={4},sid_list_1{5},log_delta={9},min_log_delta={10},max_log_delta={11},cache_file={13})".format(
             self.__class__.__name__,
             self.test_snps,
@@ -313,12 +336,20 @@ class _Epistasis(object):  # implements IDistributable
     def reduce(self, result_sequence):
         # doesn't need "run_once()"
 
+        if self.output_top_n is not None:
+            writer = SortedWriter(
+                self.output_file_or_none + ".spill", top_n=self.output_top_n
+            )
+            for result in result_sequence:
+                writer.add(result)
+            return writer.finish(self.output_file_or_none)
+
         frame = pd.concat(result_sequence)
         frame.sort_values(by="PValue", inplace=True)
         frame.index = np.arange(len(frame))
 
         if self.output_file_or_none is not None:
-            frame.to_csv(self.output_file_or_none, sep="\t", index=False)
+            write_results(frame, self.output_file_or_none)
 
         return frame
 
@@ -549,6 +580,7 @@ class _Epistasis(object):  # implements IDistributable
                 sid_count=self.G0.sid_count,
                 min_log_delta=self.min_log_delta,
                 max_log_delta=self.max_log_delta,
+                optimizer=self.log_delta_optimizer,
             )  #!!what about findA2H2? minH2=0.00001
             self.external_log_delta = result["log_delta"]
 
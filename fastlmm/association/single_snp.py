@@ -1,12 +1,18 @@
+import hashlib
+import itertools
 import logging
 import os
+import threading
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from unittest.mock import patch
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import psutil
 import pysnptools.util as pstutil
 import scipy.stats as stats
 from fastlmm.inference.fastlmm_predictor import (
@@ -16,6 +22,8 @@ from fastlmm.inference.fastlmm_predictor import (
     _SnpTrainTest,
 )
 from fastlmm.inference.lmm_cov import LMM as lmm_cov
+from fastlmm.util.result_file import write_results
+from fastlmm.util.sorted_writer import SortedWriter
 from pysnptools.kernelreader import Identity as KernelIdentity
 from pysnptools.kernelreader import KernelData, SnpKernel
 from pysnptools.snpreader import Bed, Pheno, SnpData
@@ -55,6 +63,18 @@ def single_snp(
     random_seed=0,
     xp=None,
     count_A1=None,
+    loco_kernel_blocks=False,
+    prefetch=False,
+    snp_stats_columns=False,
+    float32_scan=False,
+    float32_recheck_threshold=1e-4,
+    adapt_block_size=False,
+    screening=False,
+    screening_margin=None,
+    profile_file_name=None,
+    h2_optimizer="grid",
+    output_top_n=None,
+    permutation_count=None,
 ):
     """
     Function performing single SNP GWAS using cross validation over the chromosomes and REML. Will reorder and intersect IIDs as needed.
@@ -109,7 +129,8 @@ def single_snp(
            (Warning: setting False can cause proximal contamination.)
     :type leave_out_one_chrom: boolean
 
-    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text.
+    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text,
+         unless the name ends in '.parquet' or '.feather' (these need 'pyarrow', see :mod:`fastlmm.util.result_file`).
     :type output_file_name: file name
 
     :param h2: A parameter to LMM learning, optional
@@ -127,6 +148,8 @@ def single_snp(
                 The file contains the S and U from the decomposition of the training matrix and other values.
                 It is in Python's np.savez (\*.npz) format.
                 Calls using the same cache file should have the same inputs (pheno, K0, K1, covar) but test_snps can differ.
+                U is kept in its own \*.U.npy file next to the cache file. With numpy, SNPs are tested against a memory map
+                of that file, read in tiles, so U need not fit in memory.
     :type cache_file: file name
 
     :param GB_goal: gigabytes of memory the run should use, optional. If not given, will read the test_snps in blocks the same size as the kernel,
@@ -161,7 +184,7 @@ def single_snp(
         By default, all rows are included. This is used to create a random sample of output rows.
     :type random_threshold: number between 0 and 1
 
-    :param random_seed: Seed used to assign a random values to rows. Used with random_threshold.
+    :param random_seed: Seed used to assign a random values to rows. Used with random_threshold. Also seeds the permutations of permutation_count.
     :type random_threshold: integer
 
     :param map_reduce_outer: If true (default), divides work by chromosome. If false, divides test_snp work into chunks.
@@ -180,6 +203,78 @@ def single_snp(
          alleles (the PLINK standard) or the number of A2 alleles. False is the current default, but in the future the default will change to True.
     :type count_A1: bool
 
+    :param loco_kernel_blocks: If True (default False), and leave_out_one_chrom is True, read and standardize the kernel SNPs (K0 and K1, when given as SNPs)
+         just once, instead of once per chromosome. With a low-rank kernel, the standardized SNPs are kept in memory. With a full-rank kernel, the
+         whole-genome kernel is kept in memory and each chromosome's kernel is created by subtracting that chromosome's part. Results match
+         the default up to round-off, except that a kernel is treated as low-rank only if all its SNPs (not just those off the chromosome)
+         number fewer than the iids.
+    :type loco_kernel_blocks: bool
+
+    :param prefetch: If True (default False), read (and standardize) the next block of test SNPs in a background thread while
+         the current block is being tested. Block sizes are reduced a little so that the extra block stays within GB_goal.
+         (With random_threshold, the changed block boundaries change the random draws, and so the results.)
+    :type prefetch: bool
+
+    :param snp_stats_columns: If True (default False), add columns "MAF" (minor allele frequency, assuming 0,1,2 allele counts)
+         and "CallRate" (fraction of iids not missing) for each test SNP. These come from the same read used for testing.
+    :type snp_stats_columns: bool
+
+    :param float32_scan: If True (default False), read, rotate and test the test SNPs in single precision. The null model
+         (the kernel's eigendecomposition, h2 and mixing) is still found in double precision. This about halves the memory per block
+         (so blocks are larger) and speeds up the matrix products, at the cost of a single-precision copy of the eigenvectors.
+    :type float32_scan: bool
+
+    :param float32_recheck_threshold: When float32_scan is True, SNPs with a single-precision p-value below this value
+         (default 1e-4) are re-read and re-tested in double precision, so their reported values match the default.
+    :type float32_recheck_threshold: number
+
+    :param adapt_block_size: If True (default False), test the first block of SNPs while measuring this process's peak memory,
+         then pick the size of the remaining blocks so that the process uses about GB_goal gigabytes, but no more than
+         a fraction (adapt_memory_fraction, default .8) of the memory the operating system reports as available. If GB_goal is None,
+         the blocks grow to use that fraction of available memory. The chosen size is logged.
+    :type adapt_block_size: bool
+
+    :param screening: If True (default False), pvalue_threshold must be given. Every SNP first gets a cheap screening test that
+         needs no rotation by the kernel's eigenvectors. Only SNPs whose screening p-value is at most pvalue_threshold
+         get the exact test. The screening test replaces each SNP's g'V^-1 g with gamma*g'g. By default, gamma is
+         1/(largest eigenvalue of the covariance), a lower bound, so the screening p-value is never larger than the exact one
+         and screening gives the same results as not screening.
+    :type screening: bool
+
+    :param screening_margin: If given (default None), screening is approximate. gamma is calibrated by exactly testing a sample of the SNPs
+         and is screening_margin (for example, .5) times the smallest ratio seen in the sample. This usually sends far fewer SNPs
+         to the exact test, but it is a heuristic, not a bound, so a SNP whose exact p-value is at most pvalue_threshold can be dropped.
+         Smaller values are safer. gamma is never smaller than the bound used by default.
+    :type screening_margin: number
+
+    :param profile_file_name: Name of a JSON file (default None) to which to write the wall time, CPU time, bytes read,
+         and snps/second of each stage (kernel fixup, kernel read, eigendecomposition, h2 search, cache load, snp block read,
+         standardization, screening, rotation, nLLeval, stats, output write), by chromosome and snp block.
+         CPU time is for the whole process, so it includes, for example, prefetching the next block.
+         The same records are also in the output's attrs["profile"], so pandas.DataFrame(results_dataframe.attrs["profile"])
+         is a table of them.
+    :type profile_file_name: string
+
+    :param h2_optimizer: How to search for h2 when h2 and log_delta are not given. "grid" (default) evaluates a grid
+         and refines it with Brent's method. "newton" takes Newton steps in log(delta), using the closed-form derivatives
+         of the REML log likelihood, and falls back to the grid if they don't find the minimum. It usually needs far fewer
+         likelihood evaluations.
+    :type h2_optimizer: string
+
+    :param output_top_n: If given (default None), output_file_name must be given. Each block's results are spilled,
+         sorted, to a directory next to output_file_name and then merged into output_file_name, so memory does not
+         grow with the number of results. Only the output_top_n rows with the smallest PValue are returned.
+    :type output_top_n: number
+
+    :param permutation_count: If given (default None), pheno must be a single phenotype. Instead of testing pheno, tests
+         permutation_count permuted phenotypes and returns, for each, the row of its smallest p-value. Each permuted
+         phenotype is the covariates' fit to pheno plus a permutation of the residuals, so covariate effects are kept
+         while any snp effect is removed. The permutations are tested together as a multi-phenotype run, so the snps are
+         read and rotated once. The returned frame, sorted by PValue, is the empirical distribution of the genome-wide
+         smallest p-value. Its 0.05 quantile, frame.PValue.quantile(.05), is a 5% genome-wide significance threshold.
+         Can't be used with pvalue_threshold, random_threshold, screening or output_top_n.
+    :type permutation_count: number
+
     :rtype: Pandas dataframe with one row per test SNP. Columns include "PValue"
 
     :Example:
@@ -210,6 +305,11 @@ def single_snp(
 
     if output_file_name is not None:
         os.makedirs(Path(output_file_name).parent, exist_ok=True)
+    assert (
+        output_top_n is None or output_file_name is not None
+    ), "output_top_n requires an output_file_name"
+    spill_dir = f"{output_file_name}.spill" if output_top_n is not None else None
+    profile = _Profile(enabled=profile_file_name is not None)
 
     xp = pstutil.array_module(xp)
     with patch.dict("os.environ", {"ARRAY_MODULE": xp.__name__}) as _:
@@ -225,29 +325,47 @@ def single_snp(
             good_values_per_iid > 0, :
         ]  # drop individuals with no good pheno values.
         covar = _pheno_fixup(covar, iid_if_none=pheno.iid, count_A1=count_A1)
+        if permutation_count is not None:
+            assert pheno.sid_count == 1, "permutation_count requires a single phenotype"
+            assert (
+                pvalue_threshold is None
+                and random_threshold is None
+                and not screening
+                and output_top_n is None
+            ), "permutation_count can't be used with pvalue_threshold, random_threshold, screening or output_top_n"
+            pheno, covar = _permuted_pheno(pheno, covar, permutation_count, random_seed)
+        min_per_pheno = permutation_count is not None
 
         if not leave_out_one_chrom:
             assert (
                 covar_by_chrom is None
             ), "When 'leave_out_one_chrom' is False, 'covar_by_chrom' must be None"  # !!!LATER document covar_by_chrom
-            K0 = _kernel_fixup(
-                K0 or G0 or test_snps,
-                iid_if_none=test_snps.iid,
-                standardizer=Unit(),
-                count_A1=count_A1,
-            )
-            K1 = _kernel_fixup(
-                K1 or G1,
-                iid_if_none=test_snps.iid,
-                standardizer=Unit(),
-                count_A1=count_A1,
-            )
+            with profile.stage("kernel fixup"):
+                K0 = _kernel_fixup(
+                    K0 or G0 or test_snps,
+                    iid_if_none=test_snps.iid,
+                    standardizer=Unit(),
+                    count_A1=count_A1,
+                )
+                K1 = _kernel_fixup(
+                    K1 or G1,
+                    iid_if_none=test_snps.iid,
+                    standardizer=Unit(),
+                    count_A1=count_A1,
+                )
             K0, K1, test_snps, pheno, covar = pstutil.intersect_apply(
                 [K0, K1, test_snps, pheno, covar]
             )
             logging.debug("# of iids now {0}".format(K0.iid_count))
             K0, K1, block_size = _set_block_size(
-                K0, K1, mixing, GB_goal, force_full_rank, force_low_rank
+                K0,
+                K1,
+                mixing,
+                GB_goal,
+                force_full_rank,
+                force_low_rank,
+                prefetch,
+                float32_scan,
             )
 
             frame = _internal_single(
@@ -270,8 +388,26 @@ def single_snp(
                 random_threshold=random_threshold,
                 random_seed=random_seed,
                 xp=xp,
+                prefetch=prefetch,
+                snp_stats_columns=snp_stats_columns,
+                float32_scan=float32_scan,
+                float32_recheck_threshold=float32_recheck_threshold,
+                adapt_block_size=adapt_block_size,
+                GB_goal=GB_goal,
+                screening=screening,
+                screening_margin=screening_margin,
+                profile=profile,
+                h2_optimizer=h2_optimizer,
+                output_top_n=output_top_n,
+                spill_dir=spill_dir,
+                min_per_pheno=min_per_pheno,
             )
-            if pvalue_threshold is None and random_threshold is None:
+            if (
+                pvalue_threshold is None
+                and random_threshold is None
+                and output_top_n is None
+                and not min_per_pheno
+            ):
                 sid_index_range = IntRangeSet(frame["sid_index"])
                 assert sid_index_range == (
                     0,
@@ -298,30 +434,79 @@ def single_snp(
                 else:
                     input_files.append(Ki)
 
+            if loco_kernel_blocks:
+                with profile.stage("kernel read"):
+                    loco_blocks0, loco_blocks1 = [
+                        _LocoKernelBlocks.create(
+                            Ki,
+                            test_snps,
+                            pheno,
+                            covar,
+                            GB_goal,
+                            force_full_rank,
+                            force_low_rank,
+                            count_A1=count_A1,
+                        )
+                        for Ki in [K0 or G0 or test_snps, K1 or G1]
+                    ]
+            else:
+                loco_blocks0, loco_blocks1 = None, None
+
             def nested_closure(chrom):
                 logging.info(f"working on chrom {chrom}")
                 xp = pstutil.array_module()
+                profile_chrom = profile.child(chrom)
                 test_snps_chrom = test_snps[:, test_snps.pos[:, 0] == chrom]
                 covar_chrom = _create_covar_chrom(covar, covar_by_chrom, chrom)
                 cache_file_chrom = (
                     None if cache_file is None else f"{cache_file}.{chrom}.npz"
                 )
 
-                K0_chrom = _K_per_chrom(K0 or G0 or test_snps, chrom, test_snps.iid)
-                K1_chrom = _K_per_chrom(K1 or G1, chrom, test_snps.iid)
+                for use_blocks in [True, False]:
+                    with profile_chrom.stage("kernel fixup"):
+                        K0_chrom = _K_per_chrom(
+                            K0 or G0 or test_snps,
+                            chrom,
+                            test_snps.iid,
+                            loco_blocks=loco_blocks0 if use_blocks else None,
+                        )
+                        K1_chrom = _K_per_chrom(
+                            K1 or G1,
+                            chrom,
+                            test_snps.iid,
+                            loco_blocks=loco_blocks1 if use_blocks else None,
+                        )
 
-                (
-                    K0_chrom,
-                    K1_chrom,
-                    test_snps_chrom,
-                    pheno_chrom,
-                    covar_chrom,
-                ) = pstutil.intersect_apply(
-                    [K0_chrom, K1_chrom, test_snps_chrom, pheno, covar_chrom]
-                )
+                    (
+                        K0_chrom,
+                        K1_chrom,
+                        test_snps_chrom_i,
+                        pheno_chrom,
+                        covar_chrom_i,
+                    ) = pstutil.intersect_apply(
+                        [K0_chrom, K1_chrom, test_snps_chrom, pheno, covar_chrom]
+                    )
+                    # The blocks were standardized on the iids common to all chroms. If this chrom's
+                    # covariates remove more iids, fall back to reading this chrom's kernel from scratch.
+                    if not use_blocks or all(
+                        blocks is None or blocks.iid_count == K0_chrom.iid_count
+                        for blocks in [loco_blocks0, loco_blocks1]
+                    ):
+                        break
+                    logging.warning(
+                        f"covar_by_chrom removes iids from chrom {chrom}, so not using loco_kernel_blocks for it"
+                    )
+                test_snps_chrom, covar_chrom = test_snps_chrom_i, covar_chrom_i
                 logging.debug("# of iids now {0}".format(K0_chrom.iid_count))
                 K0_chrom, K1_chrom, block_size = _set_block_size(
-                    K0_chrom, K1_chrom, mixing, GB_goal, force_full_rank, force_low_rank
+                    K0_chrom,
+                    K1_chrom,
+                    mixing,
+                    GB_goal,
+                    force_full_rank,
+                    force_low_rank,
+                    prefetch,
+                    float32_scan,
                 )
 
                 distributable = _internal_single(
@@ -344,15 +529,47 @@ def single_snp(
                     random_threshold=random_threshold,
                     random_seed=random_seed,
                     xp=xp,
+                    prefetch=prefetch,
+                    snp_stats_columns=snp_stats_columns,
+                    float32_scan=float32_scan,
+                    float32_recheck_threshold=float32_recheck_threshold,
+                    adapt_block_size=adapt_block_size,
+                    GB_goal=GB_goal,
+                    screening=screening,
+                    screening_margin=screening_margin,
+                    profile=profile_chrom,
+                    h2_optimizer=h2_optimizer,
+                    output_top_n=output_top_n,
+                    spill_dir=spill_dir,
+                    min_per_pheno=min_per_pheno,
                 )
                 return distributable
 
             def reducer_closure(frame_sequence):
-                frame = pd.concat(frame_sequence)
-                frame.sort_values(by="PValue", inplace=True)
-                frame.index = np.arange(len(frame))
-                if output_file_name is not None:
-                    frame.to_csv(output_file_name, sep="\t", index=False)
+                profile_all = profile.child()
+                profile_all.extend(profile.records)
+                if output_top_n is not None:
+                    # Each chrom's frame is its top rows plus a sorted file to merge
+                    writer = SortedWriter(spill_dir, top_n=output_top_n)
+                    for frame_chrom in frame_sequence:
+                        profile_all.extend(frame_chrom)
+                        writer.add(frame_chrom)
+                    with profile_all.stage("output write", snp_count=writer.row_count):
+                        frame = writer.finish(output_file_name)
+                else:
+                    frame_sequence = list(frame_sequence)
+                    frame = pd.concat(frame_sequence)
+                    if min_per_pheno:
+                        frame = _min_per_pheno(frame)
+                    frame.sort_values(by="PValue", inplace=True)
+                    frame.index = np.arange(len(frame))
+                    for frame_chrom in frame_sequence:
+                        profile_all.extend(frame_chrom)
+                    if output_file_name is not None:
+                        with profile_all.stage("output write", snp_count=len(frame)):
+                            write_results(frame, output_file_name)
+                if profile.enabled:
+                    frame.attrs["profile"] = profile_all.records
                 logging.info("PhenotypeName\t{0}".format(pheno.sid[0]))
                 logging.info("SampleSize\t{0}".format(test_snps.iid_count))
                 logging.info("SNPCount\t{0}".format(test_snps.sid_count))
@@ -372,26 +589,42 @@ def single_snp(
                 runner=runner_outer,
             )
 
+    if profile_file_name is not None:
+        os.makedirs(Path(profile_file_name).parent, exist_ok=True)
+        pd.DataFrame(
+            frame.attrs.get("profile", []), columns=_Profile.columns
+        ).to_json(profile_file_name, orient="records", indent=2)
+
     return frame
 
 
 overhead_gig = 0.127
 factor = 8.5  # found via trial and error
+_extra_pheno_block_size = 1000  # phenotypes whose h2 is searched together in compute_extra
 
 
-def _GB_goal_from_block_size(block_size, iid_count, kernel_gig):
-    left_bytes = block_size * (iid_count * 8.0 * factor)
+def _GB_goal_from_block_size(
+    block_size, iid_count, kernel_gig, prefetch=False, float32_scan=False
+):
+    # A prefetched block is one more [iid_count x block_size] array
+    value_bytes = 4.0 if float32_scan else 8.0
+    left_bytes = block_size * (iid_count * value_bytes * (factor + prefetch))
     left_gig = left_bytes / 1024.0**3
     GB_goal = left_gig + overhead_gig + kernel_gig
     return GB_goal
 
 
-def _block_size_from_GB_goal(GB_goal, iid_count, min_count):
-    kernel_bytes = iid_count * min_count * 8
+def _block_size_from_GB_goal(
+    GB_goal, iid_count, min_count, prefetch=False, float32_scan=False
+):
+    # With float32_scan, there is also a float32 copy of the eigenvectors
+    kernel_bytes = iid_count * min_count * (12 if float32_scan else 8)
     kernel_gig = kernel_bytes / (1024.0**3)
 
     if GB_goal is None:
-        GB_goal = _GB_goal_from_block_size(min_count, iid_count, kernel_gig)
+        GB_goal = _GB_goal_from_block_size(
+            min_count, iid_count, kernel_gig, prefetch, float32_scan
+        )
         logging.info("Setting GB_goal to {0} GB".format(GB_goal))
         return min_count
 
@@ -401,12 +634,15 @@ def _block_size_from_GB_goal(GB_goal, iid_count, min_count):
             "The full kernel and related operations will likely not fit in the goal_memory"
         )
     left_bytes = left_gig * 1024.0**3
-    snps_at_once = left_bytes / (iid_count * 8.0 * factor)
+    value_bytes = 4.0 if float32_scan else 8.0
+    snps_at_once = left_bytes / (iid_count * value_bytes * (factor + prefetch))
     block_size = int(snps_at_once)
 
     if block_size < min_count:
         block_size = min_count
-        GB_goal = _GB_goal_from_block_size(block_size, iid_count, kernel_gig)
+        GB_goal = _GB_goal_from_block_size(
+            block_size, iid_count, kernel_gig, prefetch, float32_scan
+        )
         warnings.warn(
             "Can't meet goal_memory without loading too few snps at once. Resetting GB_goal to {0} GB".format(
                 GB_goal
@@ -429,9 +665,11 @@ def single_snp_leave_out_one_chrom(*args, **kwargs):
     return single_snp(*args, **kwargs)
 
 
-def _K_per_chrom(K, chrom, iid, count_A1=None):
+def _K_per_chrom(K, chrom, iid, count_A1=None, loco_blocks=None):
     if K is None:
         return KernelIdentity(iid)
+    elif loco_blocks is not None:
+        return loco_blocks.kernel(chrom)
     else:
         if isinstance(K, dict):
             return _kernel_fixup(
@@ -450,6 +688,86 @@ def _K_per_chrom(K, chrom, iid, count_A1=None):
             )
 
 
+class _LocoKernelBlocks(object):
+    """
+    Reads the kernel SNPs once and then creates every leave-out-one-chromosome kernel from per-chromosome blocks.
+
+    Each SNP is Unit standardized on its own, so the kernel is a sum of per-chromosome terms, G_c x G_c.T.
+    In the low-rank case, the standardized SNPs are kept in memory and each chromosome's kernel just selects columns.
+    In the full-rank case, the whole-genome kernel is kept in memory and each chromosome's kernel
+    subtracts that chromosome's block (which is read on its own).
+    """
+
+    def __init__(self, snpreader, low_rank, block_size):
+        self.snpreader = snpreader
+        self.low_rank = low_rank
+        self.block_size = block_size
+        self.iid = snpreader.iid
+        if low_rank:
+            logging.info(
+                f"Reading all {snpreader.sid_count} kernel SNPs once for leave-out-one-chrom (low rank)"
+            )
+            self.G = snpreader.read().standardize(Unit())
+            self.K_all = None
+        else:
+            logging.info(
+                f"Reading all {snpreader.sid_count} kernel SNPs once for leave-out-one-chrom (full rank)"
+            )
+            self.G = None
+            self.K_all = SnpKernel(snpreader, Unit(), block_size=block_size).read()
+
+    @property
+    def iid_count(self):
+        return len(self.iid)
+
+    @staticmethod
+    def create(
+        K,
+        test_snps,
+        pheno,
+        covar,
+        GB_goal,
+        force_full_rank,
+        force_low_rank,
+        count_A1=None,
+    ):
+        """
+        Returns None if K can't be divided into blocks (for example, it is missing, a dictionary, or a precomputed kernel).
+        """
+        if K is None or isinstance(K, dict):
+            return None
+        K_all = _kernel_fixup(
+            K, iid_if_none=test_snps.iid, standardizer=Unit(), count_A1=count_A1
+        )
+        if not isinstance(K_all, SnpKernel) or not isinstance(
+            K_all.standardizer, Unit
+        ):
+            return None
+        snpreader, _, _, _ = pstutil.intersect_apply(
+            [K_all.snpreader, test_snps, pheno, covar]
+        )
+        low_rank = not force_full_rank and (
+            force_low_rank or snpreader.sid_count < snpreader.iid_count
+        )
+        block_size = _block_size_from_GB_goal(
+            GB_goal, snpreader.iid_count, snpreader.iid_count
+        )
+        return _LocoKernelBlocks(snpreader, low_rank, block_size)
+
+    def kernel(self, chrom):
+        is_chrom = self.snpreader.pos[:, 0] == chrom
+        if self.low_rank:
+            return SnpKernel(self.G[:, ~is_chrom], SS_Identity())
+        K_chrom = SnpKernel(
+            self.snpreader[:, is_chrom], Unit(), block_size=self.block_size
+        ).read()
+        return KernelData(
+            iid=self.iid,
+            val=self.K_all.val - K_chrom.val,
+            name=f"{self.snpreader} without chrom {chrom}",
+        )
+
+
 #!!!move to own file?
 class _Mixer(object):
     def __init__(self, do_g, kernel_trained0, kernel_trained1, mixing):
@@ -737,12 +1055,23 @@ class _Mixer(object):
             return np.inf
 
 
-def _set_block_size(K0, K1, mixing, GB_goal, force_full_rank, force_low_rank):
+def _set_block_size(
+    K0,
+    K1,
+    mixing,
+    GB_goal,
+    force_full_rank,
+    force_low_rank,
+    prefetch=False,
+    float32_scan=False,
+):
     min_count = _internal_determine_block_size(
         K0, K1, mixing, force_full_rank, force_low_rank
     )
     iid_count = K0.iid_count if K0 is not None else K1.iid_count
-    block_size = _block_size_from_GB_goal(GB_goal, iid_count, min_count)
+    block_size = _block_size_from_GB_goal(
+        GB_goal, iid_count, min_count, prefetch, float32_scan
+    )
     # logging.info("Dividing SNPs by {0}".format(-(test_snps.sid_count//-block_size)))
 
     try:
@@ -867,6 +1196,19 @@ def _internal_single(
     random_threshold,
     random_seed,
     xp,
+    prefetch=False,
+    snp_stats_columns=False,
+    float32_scan=False,
+    float32_recheck_threshold=None,
+    adapt_block_size=False,
+    GB_goal=None,
+    screening=False,
+    screening_margin=None,
+    profile=None,
+    h2_optimizer="grid",
+    output_top_n=None,
+    spill_dir=None,
+    min_per_pheno=False,
 ):
 
     assert K0 is not None, "real assert"
@@ -901,6 +1243,9 @@ def _internal_single(
     else:
         interact = None
 
+    if profile is None:
+        profile = _Profile(enabled=False)
+
     lmm, h2, mixing = _find_h2_s_u(
         mixing,
         h2,
@@ -913,6 +1258,8 @@ def _internal_single(
         K1,
         cache_file,
         runner,
+        profile,
+        h2_optimizer,
     )
     assert lmm.Y.shape == pheno.shape, "expect pheno and lmm.Y to have the same shape"
 
@@ -929,24 +1276,72 @@ def _internal_single(
         pvalue_threshold,
         random_threshold,
         random_seed,
+        prefetch,
+        snp_stats_columns,
+        float32_scan,
+        float32_recheck_threshold,
+        adapt_block_size,
+        GB_goal,
+        screening,
+        screening_margin,
+        profile,
+        output_top_n,
+        spill_dir,
+        min_per_pheno,
     )
 
     return frame
 
 
-cache_version = 3
+cache_version = 4
+
+
+def _cache_fingerprint(K0, K1, iid, covar_val, y, mixing, h2, force_full_rank, force_low_rank):
+    # A hash of everything that the cached S, U, UY, h2 and mixing depend on.
+    hasher = hashlib.sha256()
+
+    def update(value):
+        hasher.update(str(value).encode())
+        hasher.update(b"\x00")
+
+    update(cache_version)
+    update("\n".join(f"{fid} {iid}" for fid, iid in iid))
+    for val in [covar_val, y]:
+        val = np.ascontiguousarray(pstutil.asnumpy(val))
+        update(val.shape)
+        hasher.update(val.tobytes())
+    for K in [K0, K1]:
+        if isinstance(K, SnpKernel):
+            update(f"SnpKernel {K.standardizer}")
+            update("\n".join(K.snpreader.sid))
+        elif isinstance(K, KernelData):
+            update("KernelData")
+            hasher.update(np.ascontiguousarray(K.val).tobytes())
+        else:
+            update(K)
+    update((mixing, None if h2 is None else list(np.ravel(h2)), force_full_rank, force_low_rank))
+    return hasher.hexdigest()
 
 
-def save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp):
+def _cache_U_file(cache_file, fingerprint):
+    # U is saved separately, uncompressed, so that it can be memory-mapped.
+    # Its name includes the fingerprint, so a U file can never be mistaken for another's.
+    return f"{cache_file}.{fingerprint[:16]}.U.npy"
+
+
+def save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp, fingerprint=""):
     pstutil.create_directory_if_necessary(cache_file)
     assert (
         lmm_0.U is not None and lmm_0.S is not None
     ), "Expect S and U have been computed"
+    U_file = _cache_U_file(cache_file, fingerprint)
+    np.save(U_file, pstutil.asnumpy(lmm_0.U))  # write U before the file that refers to it
     xp.savez(
         cache_file,
         version=cache_version,
+        fingerprint=fingerprint,
+        U_file=os.path.basename(U_file),
         S=lmm_0.S,
-        U=lmm_0.U,
         UY=lmm_0.UY,
         UUY=lmm_0.UUY if lmm_0.UUY is not None else [False],
         h2_0=h2_0,
@@ -956,18 +1351,37 @@ def save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp):
         os.unlink(cache_file_extra)
 
 
-def load_cache(covar_val, y_0, cache_file, xp):
+def load_cache(covar_val, y_0, cache_file, xp, fingerprint=None):
+    """
+    Returns None, None, None if the cache is from an earlier version or (when fingerprint is given)
+    from different inputs. In that case, its U file is removed.
+    """
     lmm_0 = lmm_cov(X=covar_val, Y=y_0, G=None, K=None, xp=xp)
     with xp.load(cache_file) as data:  #!! similar code in epistasis
         version = data["version"]
-        assert version == cache_version, f"Expect cache version {cache_version}"
+        if version != cache_version or (
+            fingerprint is not None and str(data["fingerprint"]) != fingerprint
+        ):
+            logging.warning(
+                f"Cache file '{cache_file}' doesn't match the current inputs, so recomputing it"
+            )
+            if version == cache_version:
+                U_file = os.path.join(os.path.dirname(cache_file), str(data["U_file"]))
+                if os.path.exists(U_file):
+                    os.unlink(U_file)
+            return None, None, None
+        U_file = os.path.join(os.path.dirname(cache_file), str(data["U_file"]))
         lmm_0.S = data["S"]
-        lmm_0.U = data["U"]
         lmm_0.UY = data["UY"]
         lmm_0.UUY = None if data["UUY"].dtype != "float64" else data["UUY"]
         h2_0 = data["h2_0"]
         mixing_0 = data["mixing_0"]
 
+    if xp is np:
+        lmm_0.U = np.load(U_file, mmap_mode="r")  # read-only and shared between processes
+    else:
+        lmm_0.U = xp.asarray(np.load(U_file))
+
     assert (
         len(h2_0) == 1
         and len(mixing_0.shape) == 0
@@ -977,11 +1391,17 @@ def load_cache(covar_val, y_0, cache_file, xp):
     assert (
         lmm_0.UUY is None or lmm_0.UUY.shape[1] == 1
     ), "Expect lmm_0.UUY to have dimension 1"
+    assert lmm_0.U.shape == (
+        covar_val.shape[0],
+        lmm_0.S.shape[0],
+    ), "Expect cached U to agree with the iids and S"
 
     return lmm_0, h2_0, mixing_0
 
 
-def save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp):
+def save_cache_extra(
+    lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp, fingerprint=""
+):
     pstutil.create_directory_if_necessary(cache_file_extra)
     assert (
         lmm_multi.UY is not None and lmm_multi.S is not None
@@ -989,6 +1409,7 @@ def save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp):
     xp.savez(
         cache_file_extra,
         version=cache_version,
+        fingerprint=fingerprint,
         UY=lmm_multi.UY,
         UUY=lmm_multi.UUY if lmm_multi.UUY is not None else [False],
         h2=multi_h2,
@@ -996,14 +1417,26 @@ def save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp):
     )
 
 
-def load_cache_extra(lmm_multi, multi_y, cache_file_extra, xp):
+def load_cache_extra(lmm_multi, multi_y, cache_file_extra, xp, fingerprint=None):
+    """
+    Returns None, None, None if the cache is from an earlier version or (when fingerprint is given)
+    from different inputs.
+    """
     with xp.load(cache_file_extra) as data:  #!! similar code in epistasis
         version = data["version"]
-        assert version == cache_version, f"Expect cache version {cache_version}"
-        lmm_multi.UY = data["UY"]
-        lmm_multi.UUY = None if data["UUY"].dtype != "float64" else data["UUY"]
+        if version != cache_version or (
+            fingerprint is not None and str(data["fingerprint"]) != fingerprint
+        ):
+            logging.warning(
+                f"Cache file '{cache_file_extra}' doesn't match the current inputs, so recomputing it"
+            )
+            return None, None, None
+        UY = data["UY"]
+        UUY = None if data["UUY"].dtype != "float64" else data["UUY"]
         h2_multi = data["h2"]
         mixing_multi = data["mixing"]
+    lmm_multi.UY = UY
+    lmm_multi.UUY = UUY
     lmm_multi.Y = multi_y
     assert (
         len(h2_multi) == multi_y.shape[1]
@@ -1028,6 +1461,8 @@ def _find_h2_s_u(
     K1,
     cache_file,
     runner,
+    profile,
+    h2_optimizer="grid",
 ):
 
     assert multi_pheno.sid_count >= 1, "Expect at least one phenotype"
@@ -1041,10 +1476,29 @@ def _find_h2_s_u(
     y_0 = multi_y[:, 0:1]
     cache_file_extra = f"{cache_file}.extra.npz" if cache_file is not None else None
 
+    if cache_file is not None:
+        fingerprint = _cache_fingerprint(
+            K0,
+            K1,
+            multi_pheno.iid,
+            covar_val,
+            y_0,
+            mixing,
+            h2,
+            force_full_rank,
+            force_low_rank,
+        )
+    else:
+        fingerprint = None
+
     logging.info("Finding SU and then h2 for first phenotype")
+    lmm_0 = None
     if cache_file is not None and os.path.exists(cache_file):
-        lmm_0, h2_0, mixing_0 = load_cache(covar_val, y_0, cache_file, xp)
-    else:
+        with profile.stage("cache load"):
+            lmm_0, h2_0, mixing_0 = load_cache(
+                covar_val, y_0, cache_file, xp, fingerprint
+            )
+    if lmm_0 is None:
         lmm_0, h2_0, mixing_0 = _find_h2_s_u_for_one_pheno(
             K0,
             K1,
@@ -1060,16 +1514,35 @@ def _find_h2_s_u(
             None,
             None,
             xp,
+            profile,
+            h2_optimizer,
         )
 
         if cache_file is not None:
-            save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp)
+            save_cache(
+                lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp, fingerprint
+            )
+            if xp is np:
+                # Test SNPs against U on disk (as when the cache is loaded) and free the in-memory U and K.
+                lmm_0.U = np.load(_cache_U_file(cache_file, fingerprint), mmap_mode="r")
+                lmm_0.K = None
 
     if multi_pheno.sid_count == 1:
         return lmm_0, h2_0, mixing_0
-    elif cache_file_extra is not None and os.path.exists(cache_file_extra):
-        return load_cache_extra(lmm_0, multi_y, cache_file_extra, xp)
-    else:
+
+    if cache_file_extra is not None:
+        fingerprint_extra = hashlib.sha256(
+            fingerprint.encode()
+            + np.ascontiguousarray(pstutil.asnumpy(multi_y)).tobytes()
+        ).hexdigest()
+        if os.path.exists(cache_file_extra):
+            lmm_multi, multi_h2, multi_mixing = load_cache_extra(
+                lmm_0, multi_y, cache_file_extra, xp, fingerprint_extra
+            )
+            if lmm_multi is not None:
+                return lmm_multi, multi_h2, multi_mixing
+
+    with profile.stage("h2 search"):
         lmm_multi, multi_h2, multi_mixing = compute_extra(
             lmm_0,
             h2,
@@ -1082,10 +1555,18 @@ def _find_h2_s_u(
             force_low_rank,
             runner,
             xp,
+            h2_optimizer,
         )
-        if cache_file_extra is not None:
-            save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp)
-        return lmm_multi, multi_h2, multi_mixing
+    if cache_file_extra is not None:
+        save_cache_extra(
+            lmm_multi,
+            multi_h2,
+            multi_mixing,
+            cache_file_extra,
+            xp,
+            fingerprint_extra,
+        )
+    return lmm_multi, multi_h2, multi_mixing
 
 
 def compute_extra(
@@ -1100,52 +1581,61 @@ def compute_extra(
     force_low_rank,
     runner,
     xp,
+    h2_optimizer="grid",
 ):
-    uy_list = [lmm_0.UY[:, 0]]
-    if lmm_0.UUY is not None:
-        uuy_list = [lmm_0.UUY[:, 0]]
-    h2_list = [h2_0]
-    mixing_list = [mixing_0]
-
-    def mapper(pheno_index):
-        logging.info(f"working on pheno_index {pheno_index} of {multi_pheno.sid_count}")
-        return _find_h2_s_u_for_one_pheno(
-            K0=None,
-            K1=None,
-            covar_val=lmm_0.X,
+    # All phenotypes share S and U (and the mixing of the first phenotype), so
+    # rotate and search h2 for a block of phenotypes at once. Blocks bound the [k x P] arrays.
+    pheno_count = multi_pheno.col_count
+    work_count = -((pheno_count - 1) // -_extra_pheno_block_size)
+
+    def mapper(work_index):
+        start = 1 + (pheno_count - 1) * work_index // work_count
+        end = 1 + (pheno_count - 1) * (work_index + 1) // work_count
+        logging.info(
+            f"working on pheno_index {start} to {end-1} of {multi_pheno.sid_count}"
+        )
+        lmm_block = lmm_cov(
+            X=lmm_0.X,
             regressX=lmm_0.regressX,
             linreg=lmm_0.linreg,
-            y=multi_y[:, pheno_index : pheno_index + 1],
-            mixing=mixing_0,
-            h2=h2,
-            force_full_rank=force_full_rank,
-            force_low_rank=force_low_rank,
+            Y=multi_y[:, start:end],
             K=lmm_0.K,
+            G=None,
+            inplace=True,
             S=lmm_0.S,
             U=lmm_0.U,
             xp=xp,
         )
+        if h2 is None:
+            logging.info("Starting findH2 for all phenotypes in block")
+            result = lmm_block.findH2(optimizer=h2_optimizer)
+            if not isinstance(result, list):
+                result = [result]
+            h2_block = [np.full(np.shape(h2_0), item["h2"]) for item in result]
+        else:
+            h2_block = [h2] * (end - start)
+        return lmm_block.UY, lmm_block.UUY, h2_block
 
-    result_list = map_reduce(
-        range(1, multi_pheno.col_count), mapper=mapper, runner=runner
-    )
-    # could do this with runner
-    for lmm_p, h2_p, mixing_p in result_list:
-        uy_list.append(lmm_p.UY[:, 0])
-        if lmm_p.UUY is not None:
-            uuy_list.append(lmm_p.UUY[:, 0])
-        h2_list.append(h2_p)
-        mixing_list.append(mixing_p)
+    result_list = map_reduce(range(work_count), mapper=mapper, runner=runner)
+
+    uy_list = [lmm_0.UY[:, 0:1]]
+    uuy_list = [lmm_0.UUY[:, 0:1]] if lmm_0.UUY is not None else None
+    h2_list = [h2_0]
+    for uy_block, uuy_block, h2_block in result_list:
+        uy_list.append(uy_block)
+        if uuy_list is not None:
+            uuy_list.append(uuy_block)
+        h2_list.extend(h2_block)
 
     lmm_0.Y = multi_y
-    lmm_0.UY = np.r_[uy_list].T
+    lmm_0.UY = np.c_[tuple(uy_list)]
     if lmm_0.UUY is not None:
-        lmm_0.UUY = np.r_[uuy_list].T
+        lmm_0.UUY = np.c_[tuple(uuy_list)]
         assert (
             lmm_0.UUY.shape == multi_pheno.shape
         ), "expect pheno and lmm.UUY to have the same shape"
     multi_h2 = np.r_[h2_list]
-    multi_mixing = np.r_[mixing_list]
+    multi_mixing = np.r_[[mixing_0] * pheno_count]
 
     return lmm_0, multi_h2, multi_mixing
 
@@ -1165,21 +1655,27 @@ def _find_h2_s_u_for_one_pheno(
     S,
     U,
     xp,
+    profile=None,
+    h2_optimizer="grid",
 ):
+    if profile is None:
+        profile = _Profile(enabled=False)
 
     if S is None:
-        K, h2, mixer = _Mixer.combine_the_best_way(
-            K0,
-            K1,
-            covar_val,
-            y,
-            mixing,
-            h2,
-            force_full_rank=force_full_rank,
-            force_low_rank=force_low_rank,
-            kernel_standardizer=DiagKtoN(),
-            xp=xp,
-        )
+        with profile.stage("kernel read") as record:
+            K, h2, mixer = _Mixer.combine_the_best_way(
+                K0,
+                K1,
+                covar_val,
+                y,
+                mixing,
+                h2,
+                force_full_rank=force_full_rank,
+                force_low_rank=force_low_rank,
+                kernel_standardizer=DiagKtoN(),
+                xp=xp,
+            )
+            record["bytes"] = (K.snpreader if mixer.do_g else K).val.nbytes
         mixing = mixer.mixing
 
         if mixer.do_g:
@@ -1210,6 +1706,8 @@ def _find_h2_s_u_for_one_pheno(
                 U=None,
                 xp=xp,
             )
+        with profile.stage("eigendecomposition"):
+            lmm.getSU()
     else:
         lmm = lmm_cov(
             X=covar_val,
@@ -1226,7 +1724,8 @@ def _find_h2_s_u_for_one_pheno(
 
     if h2 is None:
         logging.info("Starting findH2")
-        result = lmm.findH2()
+        with profile.stage("h2 search"):
+            result = lmm.findH2(optimizer=h2_optimizer)
         if not isinstance(result, list):
             result = [result]
         h2 = np.array([item["h2"] for item in result])
@@ -1249,20 +1748,93 @@ def _snp_tester(
     pvalue_threshold,
     random_threshold,
     random_seed,
+    prefetch=False,
+    snp_stats_columns=False,
+    float32_scan=False,
+    float32_recheck_threshold=None,
+    adapt_block_size=False,
+    GB_goal=None,
+    screening=False,
+    screening_margin=None,
+    profile=None,
+    output_top_n=None,
+    spill_dir=None,
+    min_per_pheno=False,
 ):
+    assert not screening or (
+        pvalue_threshold is not None and random_threshold is None
+    ), "screening requires a pvalue_threshold and no random_threshold"
 
     work_count = -(
         test_snps.sid_count // -block_size
     )  # Find the work count based on batch size (rounding up)
+    block_starts = [
+        test_snps.sid_count * work_index // work_count
+        for work_index in range(work_count + 1)
+    ]
     pvalue_count = test_snps.sid_count * pheno.sid_count
+    if profile is None:
+        profile = _Profile(enabled=False)
 
     Sd, denom, h2 = lmm.get_Sd_etc(
         Sd=None, denom=None, h2=h2, logdelta=None, delta=None, scale=1, weightW=None
     )
 
+    if float32_scan:
+        # The null model was found in float64. Only the scan is in float32.
+        dtype = np.float32
+        lmm_scan = lmm.astype(dtype)
+        Sd_scan, denom_scan = Sd.astype(dtype), denom.astype(dtype)
+        interact_scan = interact.astype(dtype) if interact is not None else None
+    else:
+        dtype = np.float64
+        lmm_scan, Sd_scan, denom_scan, interact_scan = lmm, Sd, denom, interact
+
+    if screening and screening_margin is None:
+        screener = _Screener(lmm_scan, Sd_scan, denom_scan)
+    elif screening:
+        xp = pstutil.array_module()
+        calibration_index = np.unique(
+            np.linspace(
+                0,
+                test_snps.sid_count - 1,
+                min(screening_calibration_count, test_snps.sid_count),
+            ).astype(int)
+        )
+        calibration_val = xp.asarray(
+            test_snps[:, calibration_index].read(dtype=dtype).standardize().val
+        )
+        if interact_scan is not None:
+            calibration_val = calibration_val * interact_scan[:, xp.newaxis]
+        screener = _Screener(
+            lmm_scan, Sd_scan, denom_scan, calibration_val, screening_margin
+        )
+    else:
+        screener = None
+
     # We define three closures, that is, functions define inside function so that the inner function has access to the local variables of the outer function.
     def debatch_closure(work_index):
-        return test_snps.sid_count * work_index // work_count
+        return block_starts[work_index]
+
+    def read_closure(work_index):
+        # Also returns the profile records, because the read may happen in the prefetcher's thread
+        start = debatch_closure(work_index)
+        end = debatch_closure(work_index + 1)
+        profile_read = profile.child()
+        with profile_read.stage("snp block read", work_index, end - start) as record:
+            snps_read = test_snps[:, start:end].read(dtype=dtype)
+            record["bytes"] = snps_read.val.nbytes
+        with profile_read.stage("standardization", work_index, end - start):
+            # Collect the raw per-snp statistics here, so the block is never read again
+            missing_count = np.isnan(snps_read.val).sum(axis=0)
+            if pstutil.array_module() is np:
+                snps_read, unit_trained = snps_read.standardize(return_trained=True)
+                snp_stats = unit_trained.stats
+            else:
+                snp_stats = None  # found when standardizing with the array module
+        return snps_read, snp_stats, missing_count, profile_read.records
+
+    prefetcher = None  # set below, after any change to the blocks
 
     def mapper_closure(work_index):
         xp = pstutil.array_module()
@@ -1275,59 +1847,117 @@ def _snp_tester(
         start = debatch_closure(work_index)
         end = debatch_closure(work_index + 1)
 
-        raw_snps = test_snps[:, start:end]
-        snps_read = raw_snps.read()
+        profile_block = profile.child()
+        if prefetcher is not None:
+            snps_read, snp_stats, missing_count, records = prefetcher.read(work_index)
+        else:
+            snps_read, snp_stats, missing_count, records = read_closure(work_index)
+        profile_block.extend(records)
         if xp is np:
-            snps_read.standardize()
             val = xp.asarray(snps_read.val)
         else:
-            val = xp.asarray(snps_read.val)
-            statsx = xp.empty(
-                [val.shape[1], 2],
-                dtype=val.dtype,
-                order="F" if val.flags["F_CONTIGUOUS"] else "C",
-            )
-            Standardizer._standardize_unit_python(
-                val, apply_in_place=True, use_stats=False, stats=statsx
-            )
+            with profile_block.stage("standardization", work_index, end - start):
+                val = xp.asarray(snps_read.val)
+                statsx = xp.empty(
+                    [val.shape[1], 2],
+                    dtype=val.dtype,
+                    order="F" if val.flags["F_CONTIGUOUS"] else "C",
+                )
+                Standardizer._standardize_unit_python(
+                    val, apply_in_place=True, use_stats=False, stats=statsx
+                )
+                snp_stats = pstutil.asnumpy(statsx)
 
-        if interact is not None:
-            variables_to_test = val * interact[:, xp.newaxis]
+        def nLLeval(lmm_x, snps, Sd_x, denom_x):
+            with profile_block.stage("rotation", work_index, snps.shape[1]):
+                Usnps, UUsnps = lmm_x.rotate(snps)
+            with profile_block.stage("nLLeval", work_index, snps.shape[1]):
+                return lmm_x.nLLeval(
+                    h2=h2,
+                    dof=None,
+                    scale=1.0,
+                    penalty=0.0,
+                    Usnps=Usnps,
+                    UUsnps=UUsnps,
+                    Sd=Sd_x,
+                    denom=denom_x,
+                )
+
+        if interact_scan is not None:
+            variables_to_test = val * interact_scan[:, xp.newaxis]
         else:
             variables_to_test = val
 
-        res = lmm.nLLeval(
-            h2=h2,
-            dof=None,
-            scale=1.0,
-            penalty=0.0,
-            snps=variables_to_test,
-            Sd=Sd,
-            denom=denom,
-        )
+        if screener is not None:
+            # Only the snps that pass screening get the exact test. The rest get NaN, so they are not output.
+            with profile_block.stage("screening", work_index, end - start):
+                screen_pvalues = screener.pvalues(variables_to_test)
+            exact_index = np.flatnonzero((screen_pvalues <= pvalue_threshold).any(axis=1))
+            logging.info(
+                f"single_snp: {len(exact_index)} of {end-start} snps pass screening"
+            )
+            res = {
+                "beta": xp.full((end - start, pheno.sid_count), np.nan, dtype=dtype),
+                "variance_beta": xp.full(
+                    (end - start, pheno.sid_count), np.nan, dtype=dtype
+                ),
+            }
+            if len(exact_index) > 0:
+                res_exact = nLLeval(
+                    lmm_scan, variables_to_test[:, exact_index], Sd_scan, denom_scan
+                )
+                res["beta"][exact_index] = res_exact["beta"]
+                res["variance_beta"][exact_index] = res_exact["variance_beta"]
+        else:
+            res = nLLeval(lmm_scan, variables_to_test, Sd_scan, denom_scan)
+
+        if float32_scan:
+            res["beta"] = res["beta"].astype(np.float64)
+            res["variance_beta"] = res["variance_beta"].astype(np.float64)
+            p_values = _compute_pvalues(res["beta"], res["variance_beta"], lmm)
+            recheck_index = np.flatnonzero(
+                (p_values < float32_recheck_threshold).any(axis=1)
+            )
+            if len(recheck_index) > 0:
+                logging.info(
+                    f"single_snp: Rechecking {len(recheck_index)} snps in float64"
+                )
+                snps_recheck = test_snps[:, start + recheck_index].read().standardize()
+                val_recheck = xp.asarray(snps_recheck.val)
+                if interact is not None:
+                    val_recheck = val_recheck * interact[:, xp.newaxis]
+                res_recheck = nLLeval(lmm, val_recheck, Sd, denom)
+                res["beta"][recheck_index] = res_recheck["beta"]
+                res["variance_beta"][recheck_index] = res_recheck["variance_beta"]
 
         assert test_snps.iid_count == lmm.U.shape[0]
         assert (
             res["beta"].size == (end - start) * pheno.sid_count
         ), "Expect multi_beta to be (end-start)x phenos"
 
-        df = _multi_compute_stats(
-            res["beta"],
-            res["variance_beta"],
-            start,
-            end,
-            raw_snps,
-            snps_read,
-            pheno.sid,
-            mixing,
-            h2,
-            lmm,
-            pvalue_threshold=pvalue_threshold,
-            random_threshold=random_threshold,
-            random_seed=random_seed,
-            pvalue_count=pvalue_count,
-            xp=xp,
-        )
+        with profile_block.stage("stats", work_index, end - start):
+            df = _multi_compute_stats(
+                res["beta"],
+                res["variance_beta"],
+                start,
+                end,
+                snps_read,
+                snp_stats,
+                missing_count,
+                pheno.sid,
+                mixing,
+                h2,
+                lmm,
+                pvalue_threshold=pvalue_threshold,
+                random_threshold=random_threshold,
+                random_seed=random_seed,
+                pvalue_count=pvalue_count,
+                snp_stats_columns=snp_stats_columns,
+                xp=xp,
+                min_per_pheno=min_per_pheno,
+            )
+        if profile.enabled:
+            df.attrs["profile"] = profile_block.records
 
         logging.info("time={0}".format(time.time() - do_work_time))
         return df
@@ -1336,34 +1966,331 @@ def _snp_tester(
         if output_file_name is not None:
             create_directory_if_necessary(output_file_name)
 
+        profile_all = profile.child()
+        profile_all.extend(profile.records)
+        if output_top_n is not None:
+            # Spill each block as it arrives. With LOCO, output_file_name is None and the
+            # merged file goes to the outer reducer (see SortedWriter.finish).
+            writer = SortedWriter(spill_dir, top_n=output_top_n)
+            for df in result_sequence:
+                profile_all.extend(df)
+                writer.add(df)
+            with profile_all.stage("output write", snp_count=writer.row_count):
+                frame = writer.finish(output_file_name)
+            if profile.enabled:
+                frame.attrs["profile"] = profile_all.records
+            return frame
+
+        result_sequence = list(result_sequence)
         frame = pd.concat(result_sequence)
+        if min_per_pheno:
+            frame = _min_per_pheno(frame)
         frame.sort_values(by="PValue", inplace=True)
         frame.index = np.arange(len(frame))
 
+        for df in result_sequence:
+            profile_all.extend(df)
         if output_file_name is not None:
-            frame.to_csv(output_file_name, sep="\t", index=False)
+            with profile_all.stage("output write", snp_count=len(frame)):
+                write_results(frame, output_file_name)
+        if profile.enabled:
+            frame.attrs["profile"] = profile_all.records
 
         return frame
 
-    frame = map_reduce(
-        range(work_count),
-        mapper=mapper_closure,
-        reducer=reducer_closure,
-        input_files=[test_snps],
-        output_files=[output_file_name],
-        name="single_snp(output_file={0})".format(output_file_name),
-        runner=runner,
-    )
+    if adapt_block_size and work_count > 1:
+        # Test the first block while measuring memory, then re-divide the remaining snps
+        with _PeakRSS() as peak_rss:
+            probe_frame = mapper_closure(0)
+        block_size = _adapted_block_size(
+            GB_goal,
+            peak_rss,
+            block_starts[1],
+            test_snps.iid_count,
+            4.0 if float32_scan else 8.0,
+            prefetch,
+        )
+        rest_count = test_snps.sid_count - block_starts[1]
+        rest_work_count = -(rest_count // -block_size)
+        probe_end = block_starts[1]
+        block_starts = [0] + [
+            probe_end + rest_count * work_index // rest_work_count
+            for work_index in range(rest_work_count + 1)
+        ]
+        work_count = len(block_starts) - 1
+        work_start = 1
+    else:
+        probe_frame = None
+        work_start = 0
+
+    if prefetch:
+        prefetcher = _BlockPrefetcher(read_closure, work_count)
+
+    def reducer_with_probe_closure(result_sequence):
+        if probe_frame is not None:
+            result_sequence = itertools.chain([probe_frame], result_sequence)
+        return reducer_closure(result_sequence)
+
+    try:
+        frame = map_reduce(
+            range(work_start, work_count),
+            mapper=mapper_closure,
+            reducer=reducer_with_probe_closure,
+            input_files=[test_snps],
+            output_files=[output_file_name],
+            name="single_snp(output_file={0})".format(output_file_name),
+            runner=runner,
+        )
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
     return frame
 
 
+screening_calibration_count = 200  # snps tested exactly to calibrate screening
+
+
+class _Screener(object):
+    """
+    The cheap first stage of single_snp's two-stage screening. After regressing out the covariates,
+    the exact test of a snp g needs g'V^-1 y and g'V^-1 g. The first is g'w, for a w found once.
+    The second needs g rotated by the eigenvectors, so it is replaced by gamma*g'g.
+    With gamma = 1/(largest eigenvalue of V), gamma*g'g is a lower bound. A smaller g'V^-1 g only increases the
+    test statistic, so the screening p-value is at most the exact one. If calibration_val is given, gamma is instead
+    margin times the smallest ratio g'V^-1 g / g'g seen in those snps (but at least the bound). That is a heuristic:
+    another snp's ratio can be smaller, and then its screening p-value can be larger than its exact one.
+    """
+
+    def __init__(self, lmm, Sd, denom, calibration_val=None, margin=None):
+        xp = lmm._xp
+        UY, UUY = lmm.getUY()
+        denom = denom.reshape(-1)
+        self.w = lmm.U.dot(UY / Sd)
+        if UUY is not None:
+            self.w += UUY / denom
+        self.YKY = lmm.computeYKY_multi(Sd=Sd, denom=denom, UY=UY, UUY=UUY)
+        self.linreg = lmm.linreg
+        self.N = lmm.Y.shape[0] - lmm.linreg.D
+        self.df = lmm.U.shape[0] - (lmm.linreg.D + 1)
+
+        # Always true: g'V^-1 g >= g'g / (largest eigenvalue of V)
+        largest = Sd.max(axis=0)
+        if UUY is not None:
+            largest = xp.maximum(largest, denom)
+        gamma_bound = 1.0 / largest
+        if calibration_val is None:
+            self.gamma = gamma_bound
+            logging.info(f"single_snp: screening gamma={self.gamma}")
+            return
+
+        # Calibrate with snps tested exactly
+        Usnps, UUsnps = lmm.rotate(A=calibration_val)
+        snpsKsnps = lmm.computeAKA_multi(Sd=Sd, denom=denom, UA=Usnps, UUA=UUsnps)
+        calibration_res = self.linreg.regress(calibration_val)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = snpsKsnps / (calibration_res * calibration_res).sum(0)[:, None]
+        ratio[~xp.isfinite(ratio)] = np.nan
+        gamma_calibrated = margin * xp.nanmin(ratio, axis=0)
+        self.gamma = xp.maximum(gamma_bound, xp.nan_to_num(gamma_calibrated))
+        logging.info(f"single_snp: screening gamma={self.gamma}")
+
+    def pvalues(self, val):
+        val_res = self.linreg.regress(val)
+        gg = (val_res * val_res).sum(0)
+        num = val_res.T.dot(self.w)  # g'V^-1 y, [S x P]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            q = num * num / (self.gamma[None, :] * gg[:, None])
+            q = q.clip(max=self.YKY * (1.0 - 1e-10))
+            chi2stats = pstutil.asnumpy((self.N - 1.0) * q / (self.YKY - q))
+        return stats.f.sf(chi2stats, 1, self.df)
+
+
+adapt_memory_fraction = 0.8  # fraction of available memory that adapt_block_size will use
+
+
+class _PeakRSS(object):
+    """
+    Context manager that samples the resident memory of this process in a background thread.
+    Afterwards, 'start' is the memory (in bytes) on entry and 'peak' the largest seen.
+    """
+
+    def __init__(self, interval=0.005):
+        self._interval = interval
+
+    def __enter__(self):
+        self._process = psutil.Process()
+        self.start = self.peak = self._process.memory_info().rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            self.peak = max(self.peak, self._process.memory_info().rss)
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+
+def _adapted_block_size(
+    GB_goal, peak_rss, probe_count, iid_count, value_bytes, prefetch
+):
+    # Memory freed by earlier work may be reused without increasing the resident memory,
+    # so never assume less than the snps read and rotated (plus a prefetched block).
+    measured = (peak_rss.peak - peak_rss.start) / probe_count
+    bytes_per_snp = max(measured, iid_count * value_bytes * 2)
+    bytes_per_snp += iid_count * value_bytes * prefetch  # not measured with the probe
+
+    available = psutil.virtual_memory().available
+    target = peak_rss.start + adapt_memory_fraction * available
+    if GB_goal is not None:
+        target = min(target, GB_goal * 1024.0**3)
+    block_size = max(int((target - peak_rss.start) / bytes_per_snp), 1)
+    logging.info(
+        f"single_snp: adapted block size is {block_size} snps "
+        + f"(measured {measured / 1024.0**2:.3f} MB per snp, "
+        + f"process uses {peak_rss.start / 1024.0**3:.2f} GB, "
+        + f"target {target / 1024.0**3:.2f} GB, "
+        + f"{available / 1024.0**3:.2f} GB available)"
+    )
+    return block_size
+
+
+class _BlockPrefetcher(object):
+    """
+    Reads block work_index+1 of the test SNPs in a background thread while block work_index is being tested.
+    At most one block is read ahead. A block that wasn't read ahead (for example, because a runner
+    gives the blocks out of order) is read directly.
+    """
+
+    def __init__(self, read_block, work_count):
+        self._read_block = read_block
+        self._work_count = work_count
+        self.__setstate__(None)
+
+    def __getstate__(self):
+        # Don't pickle the thread pool or the pending block
+        return (self._read_block, self._work_count)
+
+    def __setstate__(self, state):
+        if state is not None:
+            self._read_block, self._work_count = state
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = None  # (work_index, future)
+
+    def read(self, work_index):
+        with self._lock:
+            pending, self._pending = self._pending, None
+            if work_index + 1 < self._work_count:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1)
+                # Submitted before this block is waited on, so that the thread
+                # reads the next block as soon as it finishes this one.
+                self._pending = (
+                    work_index + 1,
+                    self._executor.submit(self._read_block, work_index + 1),
+                )
+            elif self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+        if pending is not None and pending[0] == work_index:
+            return pending[1].result()
+        if pending is not None:
+            pending[1].cancel()
+        return self._read_block(work_index)
+
+    def close(self):
+        """
+        Drop any block read ahead and stop the thread, for example, when the caller stops before the last block.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, None
+            executor, self._executor = self._executor, None
+        if pending is not None:
+            pending[1].cancel()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+class _Profile(object):
+    """
+    Records the wall time, CPU time, bytes read and snps/second of each stage of single_snp.
+    Each record is a dictionary, so a list of records can be pickled, merged, and turned into a DataFrame.
+    When not enabled, 'stage' records nothing.
+    """
+
+    columns = [
+        "stage",
+        "chrom",
+        "block",
+        "wall_time",
+        "cpu_time",
+        "bytes",
+        "snp_count",
+        "snps_per_second",
+    ]
+
+    def __init__(self, enabled=True, chrom=None):
+        self.enabled = enabled
+        self.chrom = chrom
+        self.records = []
+
+    def child(self, chrom=None):
+        return _Profile(self.enabled, self.chrom if chrom is None else chrom)
+
+    @contextmanager
+    def stage(self, name, block=None, snp_count=None):
+        # Yields a dictionary to which the stage can add "bytes" (or change "snp_count")
+        record = {"bytes": None, "snp_count": snp_count}
+        if not self.enabled:
+            yield record
+            return
+        wall_time0, cpu_time0 = time.perf_counter(), time.process_time()
+        yield record
+        wall_time = time.perf_counter() - wall_time0
+        snp_count = record["snp_count"]
+        self.records.append(
+            {
+                "stage": name,
+                "chrom": self.chrom,
+                "block": block,
+                "wall_time": wall_time,
+                "cpu_time": time.process_time() - cpu_time0,
+                "bytes": record["bytes"],
+                "snp_count": snp_count,
+                "snps_per_second": (
+                    snp_count / wall_time
+                    if snp_count is not None and wall_time > 0
+                    else None
+                ),
+            }
+        )
+
+    def extend(self, frame_or_records):
+        # Frames from mappers carry their records in attrs["profile"]
+        if isinstance(frame_or_records, pd.DataFrame):
+            frame_or_records = frame_or_records.attrs.get("profile", [])
+        self.records.extend(frame_or_records)
+
+
+def _compute_pvalues(multi_beta, multi_variance_beta, lmm):
+    chi2stats = pstutil.asnumpy(multi_beta * multi_beta / multi_variance_beta)
+    return stats.f.sf(chi2stats, 1, lmm.U.shape[0] - (lmm.linreg.D + 1))
+
+
 def _multi_compute_stats(
     multi_beta,
     multi_variance_beta,
     start,
     end,
-    raw_snps,
     snps_read,
+    snp_stats,
+    missing_count,
     pheno_sid,
     mixing,
     h2,
@@ -1373,6 +2300,8 @@ def _multi_compute_stats(
     random_seed,
     pvalue_count,
     xp,
+    snp_stats_columns=False,
+    min_per_pheno=False,
 ):
     assert len(multi_beta.reshape(-1)) == (end - start) * len(
         pheno_sid
@@ -1381,14 +2310,22 @@ def _multi_compute_stats(
         multi_variance_beta.shape == multi_beta.shape
     ), "expect beta and variance_beta to agree on shape"
 
-    g_var = np.nanvar(raw_snps.read().val, axis=0)
+    # snp_stats holds the Unit standardizer's mean and std of the raw snps. The std of a constant snp is stored as inf.
+    snp_mean = snp_stats[:, 0]
+    snp_std = snp_stats[:, 1]
+    g_var = np.where(np.isinf(snp_std), 0.0, snp_std * snp_std)
     p_var = lmm.Y.var(axis=0)
     effect_size = multi_beta**2 * g_var[..., None] / p_var[None, ...]
 
-    chi2stats = pstutil.asnumpy(multi_beta * multi_beta / multi_variance_beta)
-    p_values = stats.f.sf(chi2stats, 1, lmm.U.shape[0] - (lmm.linreg.D + 1))
+    p_values = _compute_pvalues(multi_beta, multi_variance_beta, lmm)
+    if min_per_pheno:
+        # Keep only each pheno's smallest p-value (NaN counts as largest)
+        min_index = np.argmin(np.where(np.isnan(p_values), np.inf, p_values), axis=0)
+        pvalue_keep_index = np.zeros(p_values.size, dtype=bool)
+        pvalue_keep_index[min_index + np.arange(len(pheno_sid)) * (end - start)] = True
     p_values = p_values.T.reshape(-1)
-    pvalue_keep_index = p_values <= (pvalue_threshold or 1.0)
+    if not min_per_pheno:
+        pvalue_keep_index = p_values <= (pvalue_threshold or 1.0)
     if random_threshold is not None:
         rng = np.random.RandomState((start, random_seed))
         random_values = rng.random(len(pvalue_keep_index))
@@ -1424,10 +2361,44 @@ def _multi_compute_stats(
     dataframe["EffectSize"] = effect_size.T.reshape(-1)[keep_index]
     dataframe["Mixing"] = np.repeat(mixing, snps_read.sid_count)[keep_index]
     dataframe["Nullh2"] = np.repeat(h2, snps_read.sid_count)[keep_index]
+    if snp_stats_columns:
+        allele_freq = snp_mean / 2.0
+        dataframe["MAF"] = np.tile(
+            np.minimum(allele_freq, 1.0 - allele_freq), len(pheno_sid)
+        )[keep_index]
+        dataframe["CallRate"] = np.tile(
+            1.0 - missing_count / snps_read.iid_count, len(pheno_sid)
+        )[keep_index]
 
     return dataframe
 
 
+def _min_per_pheno(frame):
+    # The row of each pheno's smallest p-value. Without a "Pheno" column, there is one pheno.
+    frame = frame.sort_values(by="PValue", kind="mergesort")
+    if "Pheno" in frame.columns:
+        return frame.drop_duplicates(subset="Pheno")
+    return frame.head(1)
+
+
+def _permuted_pheno(pheno, covar, permutation_count, seed):
+    # Freedman-Lane: the covariates' fit plus permuted residuals, so the covariate effects are kept
+    pheno, covar = pstutil.intersect_apply([pheno, covar])
+    covar_val = np.c_[covar.read(view_ok=True, order="A").val, np.ones(pheno.iid_count)]
+    y = pheno.read(view_ok=True).val[:, 0]
+    fit = covar_val.dot(np.linalg.lstsq(covar_val, y, rcond=None)[0])
+    residual = y - fit
+    rng = np.random.RandomState(seed)
+    val = np.array(
+        [fit + residual[rng.permutation(len(y))] for _ in range(permutation_count)]
+    ).T
+    sid = np.array(
+        [f"{pheno.sid[0]}.perm{index}" for index in range(permutation_count)],
+        dtype="str",
+    )
+    return SnpData(iid=pheno.iid, sid=sid, val=val, name="permuted pheno"), covar
+
+
 def _create_covar_chrom(covar, covar_by_chrom, chrom, count_A1=None):
     if covar_by_chrom is not None:
         covar_by_chrom_chrom = covar_by_chrom[chrom]
@@ -1457,6 +2428,18 @@ def _find_mixing_from_Gs(G, covar, G0_standardized_val, G1_standardized_val, h2,
     assert h2 is None, "if mixing is None, expect h2 to also be None"
     resmin = [None]
 
+    # Mixing only reweights the columns of G0 and G1. So, factor the covariate-regressed [G0,G1] into Q*R once,
+    # and then each mixing value needs only the SVD of R*weights (which is [k0+k1 x k0+k1]) and not of an [N x k0+k1] matrix.
+    k0 = G0_standardized_val.shape[1]
+    low_rank = G.shape[1] < G.shape[0]  # otherwise, lmm_cov uses the full kernel
+    if low_rank:
+        linreg = lmm_cov(X=covar, Y=y, G=None, K=None, inplace=True, xp=xp).linreg
+        G[:, :k0] = G0_standardized_val
+        G[:, k0:] = G1_standardized_val
+        Q, R = xp.linalg.qr(linreg.regress(Y=G))
+        Py = linreg.regress(Y=y)
+        QY = Q.T.dot(Py)
+
     def f(
         mixing,
         G0_standardized_val=G0_standardized_val,
@@ -1470,8 +2453,25 @@ def _find_mixing_from_Gs(G, covar, G0_standardized_val, G1_standardized_val, h2,
             assert mixing.ndim == 1 and mixing.shape[0] == 1
             mixing = mixing[0]
 
-        _mix_from_Gs(G, G0_standardized_val, G1_standardized_val, mixing)
-        lmm = lmm_cov(X=covar, Y=y, G=G, K=None, inplace=True, xp=xp)
+        if low_rank:
+            weights = xp.concatenate(
+                [
+                    xp.full(k0, np.sqrt(1.0 - float(mixing))),
+                    xp.full(G.shape[1] - k0, np.sqrt(float(mixing))),
+                ]
+            )
+            # As in lmm_cov.setSU_fromG, but with U in the basis of Q. findH2 needs only S and the rotated y.
+            # Each trial gets its own lmm (sharing linreg), so no trial's S and U outlive it.
+            U, S, _ = xp.linalg.svd(R * weights, full_matrices=False)
+            inonzero = S > 1e-10
+            lmm = lmm_cov(
+                linreg=linreg, Y=y, S=S[inonzero] ** 2, U=U[:, inonzero], xp=xp
+            )
+            lmm.UY = lmm.U.T.dot(QY)
+            lmm.UUY = Py - Q.dot(lmm.U.dot(lmm.UY))
+        else:
+            _mix_from_Gs(G, G0_standardized_val, G1_standardized_val, mixing)
+            lmm = lmm_cov(X=covar, Y=y, G=G, K=None, inplace=True, xp=xp)
         result = lmm.findH2()
         if (resmin[0] is None) or (result["nLL"] < resmin[0]["nLL"]):
             resmin[0] = result
@@ -1492,6 +2492,8 @@ def _find_mixing_from_Gs(G, covar, G0_standardized_val, G1_standardized_val, h2,
         assert mixing.ndim == 1 and mixing.shape[0] == 1
         mixing = mixing[0]
 
+    # The search leaves G holding the unweighted (QR) or last trial's (full rank) columns, so mix it with the result.
+    _mix_from_Gs(G, G0_standardized_val, G1_standardized_val, mixing)
     h2 = resmin[0]["h2"]
     return mixing, h2
 
@@ -1511,6 +2513,8 @@ def _find_mixing_from_Ks(K, covar, K0_val, K1_val, h2, y, xp):
 
         _mix_from_Ks(K, K0_val, K1_val, mixing)
         lmm = lmm_cov(X=covar, Y=y, G=None, K=K, inplace=True, xp=xp)
+        # Finding h2 needs only the eigenvalues and the rotated y, so skip the eigenvectors
+        lmm.setSUY_fromK_tridiagonal()
         result = lmm.findH2()
         if (resmin[0] is None) or (result["nLL"] < resmin[0]["nLL"]):
             resmin[0] = result
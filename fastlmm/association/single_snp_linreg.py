@@ -7,6 +7,7 @@ import numpy as np
 import scipy.stats as stats
 from pysnptools.snpreader import Bed
 from fastlmm.util.pickle_io import load, save
+from fastlmm.util.result_file import write_results
 import time
 import pandas as pd
 from fastlmm.inference.lmm_cov import LMM as fastLMM
@@ -67,7 +68,8 @@ def single_snp_linreg(
     :param max_output_len: Maximum number of Pvalues to return. Default to None, which means 'Return all'.
     :type max_output_len: number
 
-    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text.
+    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text,
+         unless the name ends in '.parquet' or '.feather' (these need 'pyarrow', see :mod:`fastlmm.util.result_file`).
     :type output_file_name: file name
 
     :param GB_goal: gigabytes of memory the run should use, optional. If not given, will read the test_snps in blocks of size iid_count,
@@ -183,7 +185,7 @@ def single_snp_linreg(
             dataframe["PValue"] = pval[sort_index]
 
             if output_file_name is not None:
-                dataframe.to_csv(output_file_name, sep="\t", index=False)
+                write_results(dataframe, output_file_name)
 
             return dataframe
 
@@ -1,7 +1,9 @@
 import os
 import logging
 import sys
+import hashlib
 import collections
+from concurrent.futures import ThreadPoolExecutor
 
 if sys.version_info.major == 3 and sys.version_info.minor >= 10:
     from collections.abc import Mapping
@@ -30,6 +32,7 @@ from pysnptools.snpreader import SnpGen
 from pysnptools.util.filecache import LocalCache, FileCache
 from fastlmm.inference.fastlmm_predictor import _snps_fixup, _pheno_fixup
 from fastlmm.util.mingrid import minimize1D
+from fastlmm.util.result_file import get_result_format, read_results, write_results
 from fastlmm.util.matrix.mmultfile import mmultfile_b_less_aatb, mmultfile_ata
 from unittest.mock import patch
 
@@ -55,6 +58,8 @@ def single_snp_scale(
     count_A1=False,
     clear_local_lambda=None,
     force_python_only=False,
+    G0_storage="float64",
+    pipeline_count=None,
 ):
     """
     Function performing single SNP GWAS using REML and cross validation over the chromosomes. Will reorder and intersect IIDs as needed.
@@ -112,7 +117,9 @@ def single_snp_scale(
             If not given, will assume that it can use memory about the same size as one copy of ``G0``.
     :type memory_factor: number
 
-    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text.
+    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text,
+         unless the name ends in '.parquet' or '.feather' (these need 'pyarrow', see :mod:`fastlmm.util.result_file`).
+         The per-block results kept in the cache use the same format.
     :type output_file_name: file name
 
     :param runner: a `Runner <http://fastlmm.github.io/PySnpTools/#util-mapreduce1-runner-runner>`__, optional: Tells how to run locally, multi-processor, or on a cluster.
@@ -153,6 +160,18 @@ def single_snp_scale(
 
     :param force_python_only: (Default: False) Skip faster C++ code. Used for debugging and testing.
 
+    :param G0_storage: (Default: "float64") How stage 0 stores G. "float64" stores the standardized, covariate-residualized
+        values. "int8" stores G0's genotypes, one byte each, with each SNP's mean, standard deviation and covariate coefficients.
+        The GtG and PostSVD stages then standardize and residualize blocks as they read them, in Python. That makes the stage 0 cache
+        8 times smaller, but G0's values must be integers (for example, allele counts read from a BED file).
+    :type G0_storage: string
+
+    :param pipeline_count: (Default: None) If given, the SVD, PostSVD and TestSNPs stages are not barriers across chromosomes.
+        Instead, up to pipeline_count chromosomes (those with the most test SNPs first) each run through the three stages,
+        starting a stage as soon as that chromosome's previous stage is done. Each stage still uses its own runner.
+        Can't be used with ``clear_local_lambda``, which could remove files that other chromosomes' stages are using.
+    :type pipeline_count: integer
+
     :rtype: Pandas dataframe with one row per test SNP. Columns include "PValue"
 
     :Example:
@@ -179,6 +198,8 @@ def single_snp_scale(
     * 4: TestSNPs - For each test SNP, read its data, regress out covariates, use the appropriate U and compute a Pvalue.
 
     All stages cache intermediate results. If the results for stage are found in the cache, that stage will be skipped.
+    The cache is keyed by a fingerprint of ``G0``, the iids and the covariates, so runs with other phenotypes (or batches of phenotypes)
+    share stages 0 to 3. For a new phenotype, only UY, UUY and h2 are computed from the cached U, and then TestSNPs is run.
     """
     with patch.dict("os.environ", {"ARRAY_MODULE": "numpy"}) as _:
 
@@ -198,10 +219,25 @@ def single_snp_scale(
         chrom_list, pheno1, RxY, test_snps1, X, Xdagger, G0 = preload(
             covar, G0, pheno, test_snps, count_A1=count_A1, multi_pheno_is_ok=True
         )
+        # Stages 0 to 3 depend only on G0, the iids and the covariates, so they go in a folder keyed by those.
+        # Within it, the values that depend on the phenotype(s) are keyed by the phenotype(s).
         cache_dict = _cache_dict_fixup(cache, chrom_list)
+        if cache_dict[0].file_exists("1_GtG/done.txt"):
+            # Caches from before the 'G0_*' folders
+            logging.warning(
+                "Cache '{0}' has stages from an older version, which are not used. ".format(
+                    cache_dict[0].name
+                )
+                + "To save space, remove its '0_G', '1_GtG', '2_SVD', '3_PostSVD' and '4_TestSNPs' folders."
+            )
+        G0_key = "G0_{0}".format(_G0_fingerprint(G0, X, G0_storage)[:16])
+        cache_dict = {
+            chrom: storage.join(G0_key) for chrom, storage in cache_dict.items()
+        }
+        pheno_key = "pheno_{0}".format(_pheno_fingerprint(pheno1, RxY)[:16])
 
         G0_memmap_lambda, ss_per_snp = get_G0_memmap(
-            G0, cache_dict[0], X, Xdagger, memory_factor
+            G0, cache_dict[0], X, Xdagger, memory_factor, G0_storage=G0_storage
         )
 
         gtg_npz_lambda = get_gtg(
@@ -214,60 +250,102 @@ def single_snp_scale(
             min_work_count=gtg_min_work_count,
         )
 
-        svd(
-            chrom_list,
-            gtg_npz_lambda,
-            memory_factor,
-            cache_dict[0],
-            G0.iid_count,
-            G0.pos,
-            ss_per_snp,
-            X,
-            svd_runner,
-        )
+        def svd_stage(chrom_list_stage):
+            svd(
+                chrom_list_stage,
+                gtg_npz_lambda,
+                memory_factor,
+                cache_dict[0],
+                G0.iid_count,
+                G0.pos,
+                ss_per_snp,
+                X,
+                svd_runner,
+            )
 
         log_frequency = 200 if logging.getLogger().level <= logging.INFO else 0
-        postsvd(
-            chrom_list,
-            gtg_npz_lambda,
-            memory_factor,
-            cache_dict,
-            G0.iid,
-            G0.sid,
-            G0_memmap_lambda,
-            ss_per_snp,
-            RxY,
-            X,
-            postsvd_runner,
-            clear_local_lambda,
-            postsvd_min_work_count,
-            log_frequency=log_frequency,
-        )
+
+        def postsvd_stage(chrom_list_stage):
+            postsvd(
+                chrom_list_stage,
+                gtg_npz_lambda,
+                memory_factor,
+                cache_dict,
+                G0.iid,
+                G0.sid,
+                G0_memmap_lambda,
+                ss_per_snp,
+                RxY,
+                X,
+                postsvd_runner,
+                clear_local_lambda,
+                postsvd_min_work_count,
+                log_frequency=log_frequency,
+                pheno_key=pheno_key,
+            )
 
         test_snps_memory_factor = memory_factor
 
-        frame = do_test_snps(
-            cache_dict,
-            chrom_list,
-            gtg_npz_lambda,
-            test_snps_memory_factor,
-            G0.iid_count,
-            G0.sid_count,
-            G0.pos,
-            pheno1,
-            ss_per_snp,
-            RxY,
-            X,
-            Xdagger,
-            test_snps=test_snps1,
-            runner=test_snps_runner,
-            output_file_name=output_file_name,
-            min_work_count=test_snps_min_work_count,
-        )
+        def test_snps_stage(chrom_list_stage, output_file_name=None):
+            return do_test_snps(
+                cache_dict,
+                chrom_list_stage,
+                gtg_npz_lambda,
+                test_snps_memory_factor,
+                G0.iid_count,
+                G0.sid_count,
+                G0.pos,
+                pheno1,
+                ss_per_snp,
+                RxY,
+                X,
+                Xdagger,
+                test_snps=test_snps1,
+                runner=test_snps_runner,
+                output_file_name=output_file_name,
+                min_work_count=test_snps_min_work_count,
+                result_format=result_format,
+                pheno_key=pheno_key,
+            )
+
+        result_format = get_result_format(output_file_name)
+        if pipeline_count is None:
+            svd_stage(chrom_list)
+            postsvd_stage(chrom_list)
+            frame = test_snps_stage(chrom_list, output_file_name)
+        else:
+            assert (
+                clear_local_lambda is None
+            ), "pipeline_count can't be used with clear_local_lambda"
+            test_snps_count = collections.Counter(test_snps1.pos[:, 0])
+            frame_list = _run_pipelined(
+                sorted(chrom_list, key=lambda chrom: -test_snps_count[chrom]),
+                [svd_stage, postsvd_stage, test_snps_stage],
+                pipeline_count,
+            )
+            frame = pd.concat(frame_list)
+            frame.sort_values(by="PValue", inplace=True)
+            frame.index = np.arange(len(frame))
+            if output_file_name is not None:
+                pstutil.create_directory_if_necessary(output_file_name)
+                write_results(frame, output_file_name)
 
         return frame
 
 
+def _run_pipelined(chrom_list, stage_list, pipeline_count):
+    # Each chrom runs through the stages in order, as a list of one chrom. Up to pipeline_count chroms are in flight,
+    # each in its own thread. The stages' runners do the work, so the threads mostly wait. Returns the last stage's results.
+    def chrom_closure(chrom):
+        result = None
+        for stage in stage_list:
+            result = stage([chrom])
+        return result
+
+    with ThreadPoolExecutor(max_workers=pipeline_count) as executor:
+        return list(executor.map(chrom_closure, chrom_list))
+
+
 def snp_fn(data_folder, file_index):
     return data_folder + "/{0}.bed".format(file_index)
 
@@ -598,24 +676,34 @@ def get_clear_local(file_cache):
     return clear_local_lambda
 
 
-def get_G0_memmap(G0, file_cache_parent, X, Xdagger, memory_factor):
+def get_G0_memmap(
+    G0, file_cache_parent, X, Xdagger, memory_factor, G0_storage="float64"
+):
     """
     Create a version of the selected SNPs that is unit standardized. It will also be 'DiagKToN' standardization ready (see PySnpTools for info on 'DiagKToN'). The result
     will be uploaded into a file_cache (e.g. some shared cluster storage). The actual return value from this function is a lambda that when called will download G0 (if needed) and open it
     up as a memory-mapped numpy array.
+
+    With G0_storage="int8", the lambda instead returns a :class:`_CompactG0`, which standardizes and residualizes as it reads.
     """
+    assert G0_storage in {"float64", "int8"}, "Expect G0_storage to be 'float64' or 'int8'"
     file_cache = file_cache_parent.join("0_G")
     fn_done = "done.txt"
-    fn_G0_memmap = "G0_data.memmap"
+    fn_G0_memmap = "G0_data.memmap" if G0_storage == "float64" else "G0_int8.memmap"
+    fn_G0_meta = "G0_int8.npz"
     fn_ss = "ss_per_snp.npz"
 
     def G0_memmap_lambda():
         with file_cache.open_read(fn_G0_memmap) as local_G0_memmap:
+            if G0_storage == "int8":
+                with file_cache.open_read(fn_G0_meta) as local_G0_meta:
+                    return _CompactG0(local_G0_memmap, local_G0_meta)
             G0_memmap = SnpMemMap(local_G0_memmap)
         #!!!not fully closing the read here because SnpMemMap has the local file open, but at least we know usage has started
         return G0_memmap
 
-    if file_cache.file_exists(fn_done):
+    # The G0_memmap check catches a cache left by a run with the other G0_storage
+    if file_cache.file_exists(fn_done) and file_cache.file_exists(fn_G0_memmap):
         with file_cache.open_read(fn_ss) as ss_storage:
             with np.load(ss_storage) as data:
                 ss_per_snp = data["arr_0"]
@@ -637,6 +725,22 @@ def get_G0_memmap(G0, file_cache_parent, X, Xdagger, memory_factor):
     def debatch_closure2(work_index2):
         return G0.sid_count * work_index2 // work_count2
 
+    if G0_storage == "int8":
+        ss_per_snp = _write_compact_G0(
+            G0,
+            file_cache,
+            fn_G0_memmap,
+            fn_G0_meta,
+            X,
+            Xdagger,
+            work_count2,
+            debatch_closure2,
+        )
+        with file_cache.open_write(fn_ss) as ss_storage:
+            np.savez(ss_storage, ss_per_snp)
+        file_cache.save(fn_done, "")
+        return G0_memmap_lambda, ss_per_snp
+
     logging.info("About to allocate memmap of G0_data.memmap")
 
     with _file_transfer_reporter(
@@ -723,6 +827,135 @@ def get_G0_memmap(G0, file_cache_parent, X, Xdagger, memory_factor):
     return G0_memmap_lambda, ss_per_snp
 
 
+class _CompactG0(object):
+    """
+    G0 as stored by get_G0_memmap(..., G0_storage="int8"): genotypes, one signed byte each (with :attr:`missing` for missing
+    values), plus the per-SNP Unit standardizer stats and covariate coefficients. :meth:`read` gives the same standardized,
+    covariate-residualized values that G0_storage="float64" stores.
+    """
+
+    missing = -128
+
+    def __init__(self, filename, meta_filename):
+        self.filename = filename
+        with np.load(meta_filename) as data:
+            self.iid = data["iid"]
+            self.sid = data["sid"]
+            self.pos = data["pos"]
+            self.stats = data["stats"]
+            self.beta = data["beta"]
+            self.X = data["X"]
+        self.val = np.memmap(
+            filename,
+            dtype=np.int8,
+            mode="r",
+            shape=(len(self.iid), len(self.sid)),
+            order="F",
+        )
+
+    @property
+    def iid_count(self):
+        return len(self.iid)
+
+    @property
+    def sid_count(self):
+        return len(self.sid)
+
+    @staticmethod
+    def encode(val):
+        assert np.all(
+            np.isnan(val) | ((val == np.round(val)) & (np.abs(val) <= 127))
+        ), "G0_storage='int8' requires G0 values that are integers between -127 and 127"
+        return np.where(np.isnan(val), _CompactG0.missing, val).astype(np.int8)
+
+    def read(self, start_iid_index=0, stop_iid_index=None, sid_index=slice(None)):
+        """
+        The standardized, covariate-residualized values of the given iid range and sids, as a new float64 array.
+        """
+        code = self.val[start_iid_index:stop_iid_index, sid_index]
+        val = code.astype(np.float64, order="F")
+        val[code == _CompactG0.missing] = np.nan
+        val -= self.stats[sid_index, 0]
+        val /= self.stats[sid_index, 1]  # A constant snp has std inf, so becomes 0
+        val[np.isnan(val)] = 0  # Unit standardization fills missing with the mean
+        val -= self.X[start_iid_index:stop_iid_index].dot(self.beta[:, sid_index])
+        return val
+
+    def ata_piece(self, work_index, work_count, log_frequency=-1):
+        """
+        Rows start: and columns start:stop of G.T x G, where start:stop is sid piece work_index of work_count.
+        (The same piece that :func:`fastlmm.util.matrix.mmultfile.mmultfile_ata_piece` finds from a memmap file.)
+        """
+
+        def debatch_closure(work_index2):
+            return self.sid_count * work_index2 // work_count
+
+        start = debatch_closure(work_index)
+        stop = debatch_closure(work_index + 1)
+        piece = self.read(sid_index=slice(start, stop))
+        ata_piece = np.zeros((self.sid_count - start, stop - start), order="C")
+        for i in range(work_index, work_count):
+            starti = debatch_closure(i)
+            stopi = debatch_closure(i + 1)
+            if log_frequency > 0 and i % log_frequency == 0:
+                logging.info("{0}/{1}".format(i, work_count))
+            piecei = piece if i == work_index else self.read(sid_index=slice(starti, stopi))
+            ata_piece[starti - start : stopi - start, :] = piecei.T.dot(piece)
+        return ata_piece
+
+
+def _write_compact_G0(
+    G0, file_cache, fn_G0_memmap, fn_G0_meta, X, Xdagger, work_count2, debatch_closure2
+):
+    ss_per_snp = np.empty([G0.sid_count])
+    stats = np.empty([G0.sid_count, 2])
+    beta = np.empty([X.shape[1], G0.sid_count])
+    t0 = time.time()
+    with file_cache.open_write(
+        fn_G0_memmap, size=G0.iid_count * G0.sid_count
+    ) as G0_memmap_storage_file_name:
+        G0_int8 = np.memmap(
+            G0_memmap_storage_file_name,
+            dtype=np.int8,
+            mode="w+",
+            shape=(G0.iid_count, G0.sid_count),
+            order="F",
+        )
+        for work_index in range(work_count2):
+            if work_count2 > 1:
+                logging.info(
+                    "get_G0_data_memmap: Working on part {0} of {1}".format(
+                        work_index, work_count2
+                    )
+                )
+            start = debatch_closure2(work_index)
+            stop = debatch_closure2(work_index + 1)
+            G0_data_piece = G0[:, start:stop].read()
+            G0_int8[:, start:stop] = _CompactG0.encode(G0_data_piece.val)
+            G0_data_piece, unit_trained = G0_data_piece.standardize(
+                Unit(), return_trained=True
+            )
+            stats[start:stop] = unit_trained.stats
+            ss_per_snp[start:stop] = np.einsum(
+                "i...,i...", G0_data_piece.val, G0_data_piece.val
+            )
+            beta[:, start:stop] = Xdagger.dot(G0_data_piece.val)
+        G0_int8.flush()
+        del G0_int8
+    with file_cache.open_write(fn_G0_meta) as local_meta:
+        np.savez(
+            local_meta,
+            iid=G0.iid,
+            sid=G0.sid,
+            pos=G0.pos,
+            stats=stats,
+            beta=beta,
+            X=X,
+        )
+    logging.info("G0 (int8) work took {0}".format(format_delta(time.time() - t0)))
+    return ss_per_snp
+
+
 def get_gtg(
     common_cache_parent,
     G0_iid_count,
@@ -794,11 +1027,11 @@ def get_gtg(
     return reader_closure
 
 
-def get_U(chrom, chrom_cache):
+def get_U(chrom, chrom_cache, pheno_key):
     chrom = int(chrom)
 
     fn_U = "3_PostSVD/chrom{0}/U.memmap".format(chrom)  #!!!const
-    fn_UUYetc = "3_PostSVD/chrom{0}/UUYetc.npz".format(chrom)  #!!!const
+    fn_UUYetc = "3_PostSVD/chrom{0}/{1}/UUYetc.npz".format(chrom, pheno_key)  #!!!const
 
     assert chrom_cache.file_exists(fn_U) == chrom_cache.file_exists(
         fn_UUYetc
@@ -878,8 +1111,8 @@ def find_h2_inner(k, N, UUYUUYsum0, UYUY, S, chrom):
     return h2
 
 
-def get_h2(k, N, UUYUUYsum0, UYUY, S, chrom_cache, chrom):
-    fn_h2 = "3_PostSVD/chrom{0}/h2.npz".format(int(chrom))  #!!!const
+def get_h2(k, N, UUYUUYsum0, UYUY, S, chrom_cache, chrom, pheno_key):
+    fn_h2 = "3_PostSVD/chrom{0}/{1}/h2.npz".format(int(chrom), pheno_key)  #!!!const
     with chrom_cache.open_read(fn_h2) as local_fn_h2:
         with np.load(local_fn_h2) as data:
             h2 = data["arr_0"]
@@ -900,7 +1133,9 @@ def svd(
 ):
     """
     For the chromosomes listed, compute an SVD on a square matrix SNP-to-SNP matrix. Each SVD can be done on a different
-    node in a cluster. The actual SVD is done with special version of the LAPACK DGESDD function.
+    node in a cluster. Each chromosome's block of GtG is factored directly with a symmetric eigendecomposition (see _factor_gtg).
+    (Factoring the whole GtG once and downdating it per chromosome leaves a dense eigenproblem per chromosome as large as
+    the whole GtG, so it would be slower.)
 
     Results are stored at a known location in the cluster storage.
     """
@@ -928,50 +1163,7 @@ def svd(
         # =============================================================
         idx2 = np.arange(len(idx))[idx]
         ata = gtg_npz[idx2].read()
-
-        # Because the iid_count can be so big, the factor created for one_step_svd can be very inappropriate for here
-        factor_tall_skinny = float(ata.iid_count) / np.diag(ata.val).sum()
-        ata._val *= factor_tall_skinny
-
-        ##############################################################
-        ############# SLOWEST ########################################
-        ##############################################################
-        # 25K x 25K x 25K -> 25K x 25K
-        # =============================================================
-        num_threads = get_num_threads(None)
-        logging.info(
-            "About to svd on square {0}. Expected time ({2} procs)={1}".format(
-                ata.iid_count,
-                format_delta((ata.iid_count * 0.000707) ** 3 * 20.0 / num_threads),
-                num_threads,
-            )
-        )
-        t0 = time.time()
-        [Uata3, Sata3, _] = la.svd(ata.val, full_matrices=False, compute_uv=True)
-        logging.info(
-            "Actual time for svd on square={0}".format(format_delta(time.time() - t0))
-        )
-        Sata3 *= factor / factor_tall_skinny  # make the results match one_step_svd
-        S3 = Sata3**0.5
-        V3 = Uata3.T
-
-        ##############################################################
-        ############# SLOWEST ########################################
-        ##############################################################
-        # 25K**2.8 -> 25K x 25K
-        #        Is there a faster way to do the dot with the diag???
-        # =============================================================
-        SVinv3 = la.inv(np.dot(np.diag(S3), V3))
-        SVinv3 *= np.sqrt(factor)
-
-        S = S3
-        if np.any(S < -0.1):
-            logging.warning("kernel contains a negative Eigenvalue")
-        inonzero = S > 1e-10
-        S = S[inonzero]
-        S = S * S
-
-        SVinv3b = SVinv3[:, inonzero]
+        SVinv3b, S = _factor_gtg(ata.val, factor)
 
         fn = "SVinv_etc{0}.npz".format(int(chrom))  #!!!const
         if common_cache.file_exists(fn):
@@ -985,13 +1177,70 @@ def svd(
         needed_chrom_list,
         mapper=mapper_closure,
         runner=runner_svd,
-        name="{0}.svd".format(os.path.basename(common_cache.name)),
+        name="{0}.svd{1}".format(
+            os.path.basename(common_cache.name), _chrom_suffix(needed_chrom_list)
+        ),
         input_files=[],
         output_files=[],
     )
     return SVinv_etc_fn_list
 
 
+def _factor_gtg(ata_val, factor):
+    """
+    Factor one leave-out-chromosome block of GtG (which is scaled in place). Returns SVinv3b, which maps
+    the block's G to its U, and S, the nonzero eigenvalues of the kernel.
+    """
+    # Because the iid_count can be so big, the factor created for one_step_svd can be very inappropriate for here
+    factor_tall_skinny = float(ata_val.shape[0]) / np.diag(ata_val).sum()
+    ata_val *= factor_tall_skinny
+
+    ##############################################################
+    ############# SLOWEST ########################################
+    ##############################################################
+    # 25K x 25K x 25K -> 25K x 25K
+    # =============================================================
+    # ata is symmetric positive semi-definite, so its SVD is its eigendecomposition. The symmetric
+    # eigensolver (divide-and-conquer, like DGESDD) needs well under half the flops of the SVD.
+    num_threads = get_num_threads(None)
+    logging.info(
+        "About to eigh on square {0}. Expected time ({2} procs)={1}".format(
+            ata_val.shape[0],
+            format_delta((ata_val.shape[0] * 0.000707) ** 3 * 7.0 / num_threads),
+            num_threads,
+        )
+    )
+    t0 = time.time()
+    Sata3, Uata3 = la.eigh(ata_val)
+    logging.info(
+        "Actual time for eigh on square={0}".format(format_delta(time.time() - t0))
+    )
+    Sata3, Uata3 = Sata3[::-1], Uata3[:, ::-1]  # descending, like the SVD
+    Sata3 *= factor / factor_tall_skinny  # make the results match one_step_svd
+    # Round-off can make zero eigenvalues slightly negative. Keep the sign so they are dropped below.
+    S3 = np.sign(Sata3) * np.abs(Sata3) ** 0.5
+
+    S = S3
+    if np.any(S < -0.1):
+        logging.warning("kernel contains a negative Eigenvalue")
+    inonzero = S > 1e-10
+    S = S[inonzero]
+
+    # V3 = Uata3.T is orthogonal, so inv(diag(S3) V3) is V3.T scaled by 1/S3. Only the inonzero columns are kept,
+    # so scale just those (25K x 25K, with no inverse and no dense diag product).
+    SVinv3b = Uata3[:, inonzero]
+    SVinv3b *= np.sqrt(factor) / S
+
+    S = S * S
+
+    return SVinv3b, S
+
+
+def _chrom_suffix(chrom_list):
+    # With pipeline_count, stages run on one chrom at a time, so give their jobs distinct names
+    return "_{0}".format(int(chrom_list[0])) if len(chrom_list) == 1 else ""
+
+
 def postsvd_piece(
     start_iid_index,
     stop_iid_index,
@@ -1003,6 +1252,27 @@ def postsvd_piece(
 ):
     logging.info("About to read")
     t0_piece = time.time()
+    if isinstance(G0_memmap, _CompactG0):
+        sid_index = np.concatenate(
+            [np.arange(start_idx, stop_idx) for start_idx, stop_idx in idx_array]
+        )
+        piece = G0_memmap.read(start_iid_index, stop_iid_index, sid_index)
+    else:
+        piece = _read_piece(
+            start_iid_index, stop_iid_index, G0_memmap, idx_array, SVinv3b, log_frequency
+        )
+    logging.info("About to mult")
+    product = np.array(np.dot(piece, SVinv3b), order="F")
+    logging.info("About to save")
+    product.flatten(order="K").tofile(fn_U_piece, "")
+    logging.info(
+        "post svd piece: clocktime {0}".format(format_delta(time.time() - t0_piece))
+    )
+
+
+def _read_piece(
+    start_iid_index, stop_iid_index, G0_memmap, idx_array, SVinv3b, log_frequency
+):
     piece = np.zeros((stop_iid_index - start_iid_index, SVinv3b.shape[0]), order="F")
     with open(G0_memmap.filename, "rb") as fp:
         so_far_idx = 0
@@ -1030,13 +1300,7 @@ def postsvd_piece(
                         )
                     )
             so_far_idx += stop_idx - start_idx
-    logging.info("About to mult")
-    product = np.array(np.dot(piece, SVinv3b), order="F")
-    logging.info("About to save")
-    product.flatten(order="K").tofile(fn_U_piece, "")
-    logging.info(
-        "post svd piece: clocktime {0}".format(format_delta(time.time() - t0_piece))
-    )
+    return piece
 
 
 def postsvd(
@@ -1054,6 +1318,7 @@ def postsvd(
     clear_local_lambda,
     min_work_count,
     log_frequency=-1,
+    pheno_key="pheno",
 ):
     """
     For the chromosomes listed, take the square SVD and turn it into U, the "tall-and-skinny" SVD needed. Also, computed related values UY and UUY.
@@ -1062,7 +1327,8 @@ def postsvd(
     This function uses two levels of map-reduce that are run as a single cluster job. The top level loops across the chromosomes, the
     second level does a matrix multiple in blocks. At the lowest level, the matrix multiple is multithreaded.
 
-    Save the results under a known name in the cluster storage.
+    Save the results under a known name in the cluster storage. UY, UUY and h2 go in a sub folder named pheno_key. If U is already
+    saved for a chromosome, only they are computed.
     """
     sub_dir = "3_PostSVD"
     common_cache = cache_dict[0].join(sub_dir)
@@ -1072,10 +1338,17 @@ def postsvd(
         for chrom in chrom_list
         if not common_cache.file_exists("chrom{0}/done.txt".format(int(chrom)))
     ]
-    if not needed_chrom_list:
-        return
+    pheno_chrom_list = [
+        chrom
+        for chrom in chrom_list
+        if chrom not in needed_chrom_list
+        and not common_cache.file_exists(
+            "chrom{0}/{1}/done.txt".format(int(chrom), pheno_key)
+        )
+    ]
     G0_iid_count = len(G0_iid)
     G0_sid_count = len(G0_sid)
+    N = G0_iid_count - X.shape[1]  # number of degrees of freedom
 
     def mapper_closure(chrom):
         chrom = int(chrom)
@@ -1084,12 +1357,9 @@ def postsvd(
         fn_U = "chrom{0}/U.memmap".format(int(chrom))
         if chrom_storage.file_exists(fn_U):
             chrom_storage.remove(fn_U)
-        fn_UUYetc = "chrom{0}/UUYetc.npz".format(int(chrom))
-        if chrom_storage.file_exists(fn_UUYetc):
-            chrom_storage.remove(fn_UUYetc)
-        fn_h2 = "chrom{0}/h2.npz".format(int(chrom))  #!!!const
-        if chrom_storage.file_exists(fn_h2):
-            chrom_storage.remove(fn_h2)
+        for fn in _pheno_postsvd_file_names(chrom, pheno_key):
+            if chrom_storage.file_exists(fn):
+                chrom_storage.remove(fn)
 
         work_count = -(
             G0_iid_count // -int(G0_sid_count * memory_factor)
@@ -1264,32 +1534,10 @@ def postsvd(
                     )
                 )
 
-                # =============================================================
-                # 25K x 1M x 2 -> 25K x 2
-                # =============================================================
-                UY = U_snp_mem_map.val.T.dot(
-                    RxY
-                )  # Note: This could be pushed into the 'map' step, with each step returning a UYi that would all be summed together.
-                # =============================================================
-                # 1M x 25K x 2 -> 1M x 2
-                # =============================================================
-                UUY = RxY - U_snp_mem_map.val.dot(
-                    UY
-                )  # This is can't be pushed into the 'map' step because it depends on all of UY
-
                 U_snp_mem_map.flush()
-
-            with chrom_storage.open_write(fn_UUYetc) as local_fn_UUYetc:
-                np.savez(local_fn_UUYetc, S=S, UY=UY, UUY=UUY)
-
-            # =============================================================
-            # 25K x about 30
-            # =============================================================
-            UYUY = UY * UY
-            UUYUUYsum0 = (UUY * UUY).sum(0)
-            N = G0_iid_count - X.shape[1]  # number of degrees of freedom
-            k = S.shape[0]
-            h2 = find_h2(k, N, UUYUUYsum0, UYUY, S, chrom)  # h2 depends on y
+                _save_pheno_postsvd(
+                    chrom, chrom_storage, pheno_key, U_snp_mem_map.val, S, RxY, N
+                )
 
             t0_etc = time.time()
             logging.info(
@@ -1298,12 +1546,10 @@ def postsvd(
                 )
             )
 
-            with chrom_storage.open_write(fn_h2) as local_fn_h2:
-                np.savez(local_fn_h2, h2)
-
             if clear_local_lambda is not None:
                 chrom_storage.cloud_storage_only()
 
+            common_cache.save("chrom{0}/{1}/done.txt".format(int(chrom), pheno_key), "")
             common_cache.save("chrom{0}/done.txt".format(int(chrom)), "")
 
             t0_up = time.time()
@@ -1327,12 +1573,98 @@ def postsvd(
             output_files=[],
         )
 
-    map_reduceX(
-        needed_chrom_list,
-        mapper=mapper_closure,
-        name="{0}.postsvd".format(os.path.basename(cache_dict[0].name)),
-        runner=postsvd_runner,
-    )
+    def pheno_mapper_closure(chrom):
+        # U is in the cache (from a run with other phenotypes), so only UY, UUY and h2 are needed
+        chrom = int(chrom)
+        chrom_storage = cache_dict[chrom].join(sub_dir)
+        t0_start = time.time()
+        logging.info(
+            "postsvd, chrom {0}: reusing U to find UY, UUY and h2 for '{1}'".format(
+                chrom, pheno_key
+            )
+        )
+
+        with cache_dict[0].open_read(
+            "2_SVD/SVinv_etc{0}.npz".format(chrom)
+        ) as handle_local:
+            with np.load(handle_local) as data:
+                S = data["S"]
+
+        with chrom_storage.open_read(
+            "chrom{0}/U.memmap".format(chrom)
+        ) as local_fn_U:
+            U_memmap = SnpMemMap(local_fn_U)
+            _save_pheno_postsvd(
+                chrom, chrom_storage, pheno_key, U_memmap.val, S, RxY, N
+            )
+
+        if clear_local_lambda is not None:
+            chrom_storage.cloud_storage_only()
+
+        common_cache.save("chrom{0}/{1}/done.txt".format(chrom, pheno_key), "")
+        logging.info(
+            "postsvd, chrom {0}: phenotype work took {1}".format(
+                chrom, format_delta(time.time() - t0_start)
+            )
+        )
+
+    if needed_chrom_list:
+        map_reduceX(
+            needed_chrom_list,
+            mapper=mapper_closure,
+            name="{0}.postsvd{1}".format(
+                os.path.basename(cache_dict[0].name), _chrom_suffix(needed_chrom_list)
+            ),
+            runner=postsvd_runner,
+        )
+    if pheno_chrom_list:
+        map_reduce(
+            pheno_chrom_list,
+            mapper=pheno_mapper_closure,
+            runner=postsvd_runner,
+            name="{0}.postsvd_pheno{1}".format(
+                os.path.basename(cache_dict[0].name), _chrom_suffix(pheno_chrom_list)
+            ),
+            input_files=[],
+            output_files=[],
+        )
+
+
+def _pheno_postsvd_file_names(chrom, pheno_key):
+    return [
+        "chrom{0}/{1}/{2}".format(int(chrom), pheno_key, file_name)
+        for file_name in ["UUYetc.npz", "h2.npz"]
+    ]
+
+
+def _save_pheno_postsvd(chrom, chrom_storage, pheno_key, U, S, RxY, N):
+    """
+    Compute and save the PostSVD values that depend on the phenotype(s): UY, UUY and h2.
+    """
+    fn_UUYetc, fn_h2 = _pheno_postsvd_file_names(chrom, pheno_key)
+
+    # =============================================================
+    # 25K x 1M x 2 -> 25K x 2
+    # =============================================================
+    UY = U.T.dot(RxY)
+    # =============================================================
+    # 1M x 25K x 2 -> 1M x 2
+    # =============================================================
+    UUY = RxY - U.dot(UY)
+
+    with chrom_storage.open_write(fn_UUYetc) as local_fn_UUYetc:
+        np.savez(local_fn_UUYetc, S=S, UY=UY, UUY=UUY)
+
+    # =============================================================
+    # 25K x about 30
+    # =============================================================
+    UYUY = UY * UY
+    UUYUUYsum0 = (UUY * UUY).sum(0)
+    k = S.shape[0]
+    h2 = find_h2(k, N, UUYUUYsum0, UYUY, S, chrom)  # h2 depends on y
+
+    with chrom_storage.open_write(fn_h2) as local_fn_h2:
+        np.savez(local_fn_h2, h2)
 
 
 def get_U_h2(
@@ -1346,6 +1678,7 @@ def get_U_h2(
     RxY,
     pheno,
     X,
+    pheno_key,
 ):
     #!!! similar code above
     logging.debug("Retrieving on chrom {0}".format(chrom))
@@ -1359,7 +1692,7 @@ def get_U_h2(
     # 1M x 25K x 25K => 1M x 25K
     # =============================================================
     S, U_memmap, UY, UUY = get_U(
-        chrom, chrom_cache
+        chrom, chrom_cache, pheno_key
     )  #!!!y: at the end, U is multiplied twice with yish things
 
     # =============================================================
@@ -1370,7 +1703,7 @@ def get_U_h2(
     N = pheno.iid_count - X.shape[1]  # number of degrees of freedom
     k = S.shape[0]
     h2, logdetK, YKY, Sd, denom = get_h2(
-        k, N, UUYUUYsum0, UYUY, S, chrom_cache, chrom
+        k, N, UUYUUYsum0, UYUY, S, chrom_cache, chrom, pheno_key
     )  #!!!y: h2 depends on y
 
     return h2, U_memmap, Sd, denom, UY, UUY, YKY, N, logdetK
@@ -1440,6 +1773,8 @@ def do_test_snps(
     runner,
     output_file_name=None,
     min_work_count=1,
+    result_format=None,
+    pheno_key="pheno",
 ):
     """
     For every test SNP, measure its pvalue. Nest two levels of map-reduce. On the top level, loop over chromosomes. Within each chromosome
@@ -1449,7 +1784,8 @@ def do_test_snps(
     """
     __del__(test_snps)  # Close any open Bed files
 
-    results_storage = cache_dict[0].join("4_TestSNPs")
+    results_storage = cache_dict[0].join("4_TestSNPs").join(pheno_key)
+    result_format = get_result_format(output_file_name, result_format)
 
     def mapper_closure2(chrom):
         chrom_index = chrom_list.index(chrom)
@@ -1480,12 +1816,15 @@ def do_test_snps(
             done_file = "chrom{0}/done.{1}of{2}.txt".format(
                 chrom, work_index, work_count
             )
-            cache_file = "chrom{0}/result.{1}of{2}.tsv".format(
-                chrom, work_index, work_count
+            cache_file = "chrom{0}/result.{1}of{2}.{3}".format(
+                chrom, work_index, work_count, result_format
             )
-            if results_storage.file_exists(done_file):
+            # The cache_file check catches a done_file left by a run with another result_format
+            if results_storage.file_exists(done_file) and results_storage.file_exists(
+                cache_file
+            ):
                 with results_storage.open_read(cache_file) as local_file:
-                    dataframe = pd.read_csv(local_file, delimiter="\t")
+                    dataframe = read_results(local_file, result_format)
                     return dataframe
 
             if results_storage.file_exists(cache_file):
@@ -1511,6 +1850,7 @@ def do_test_snps(
                 RxY,
                 pheno,
                 X,
+                pheno_key,
             )
 
             if work_count > 1:
@@ -1666,7 +2006,7 @@ def do_test_snps(
 
             dataframe = pd.concat(dataframe_list)
             with results_storage.open_write(cache_file) as local_file:
-                dataframe.to_csv(local_file, sep="\t", index=False)
+                write_results(dataframe, local_file, result_format)
 
             results_storage.save(done_file, "")
 
@@ -1695,7 +2035,7 @@ def do_test_snps(
 
         if output_file_name is not None:
             pstutil.create_directory_if_necessary(output_file_name)
-            frame.to_csv(output_file_name, sep="\t", index=False)
+            write_results(frame, output_file_name)
 
         logging.info("PhenotypeName(s)\t{0}".format(pheno.sid))
         logging.info("SampleSize\t{0}".format(test_snps.iid_count))
@@ -1724,7 +2064,9 @@ def clear_cache_dict(start_stage, cache_dict, chrom_num_list):
          'svd' (clear stage 'svd' and later), 'postsvd' (clear stage postsvd and later), 'testsnps' (clear stage testsnps)
     :type start_stage: string or None
 
-    :param cache_dict: Dictionary mapping chromosomes to :class:`LocalCache` or other storage
+    :param cache_dict: Dictionary mapping chromosomes to :class:`LocalCache` or other storage, as given to :func:`.single_snp_scale`.
+         The stages are cleared in every 'G0_*' folder (one per fingerprint of G0, the iids and the covariates) that
+         :func:`.single_snp_scale` made in cache_dict[0].
     :type cache_dict: dictionary
 
     :param chrom_num_list: List of chromosome numbers to look at.
@@ -1734,10 +2076,26 @@ def clear_cache_dict(start_stage, cache_dict, chrom_num_list):
     if start_stage is None:
         return
 
+    G0_key_list = sorted(
+        {
+            file_name.split("/")[0]
+            for file_name in cache_dict[0].walk()
+            if file_name.startswith("G0_") and "/" in file_name
+        }
+    )
     with log_in_place(
         "clearing cache dict to '{0}'".format(start_stage), logging.INFO
     ) as log_writer:
-        _clear_cache_dict_internal(start_stage, cache_dict, chrom_num_list, log_writer)
+        for G0_key in G0_key_list:
+            G0_cache_dict = {
+                chrom: storage.join(G0_key) for chrom, storage in cache_dict.items()
+            }
+            _clear_cache_dict_internal(
+                start_stage, G0_cache_dict, chrom_num_list, log_writer
+            )
+
+
+_G0_file_names = ["G0_data.memmap", "G0_int8.memmap", "G0_int8.npz", "ss_per_snp.npz"]
 
 
 def _clear_cache_dict_internal(start_stage, cache_dict, chrom_num_list, log_writer):
@@ -1745,7 +2103,7 @@ def _clear_cache_dict_internal(start_stage, cache_dict, chrom_num_list, log_writ
         _clear_cache_dict_internal(
             "gtg", cache_dict, chrom_num_list, log_writer
         )  # Recursion
-        for file_name in ["G0_data.memmap", "ss_per_snp.npz"]:
+        for file_name in _G0_file_names:
             if cache_dict[0].file_exists(file_name):
                 cache_dict[0].remove(file_name, log_writer=log_writer)
     elif start_stage == "gtg":
@@ -1772,7 +2130,7 @@ def _clear_cache_dict_internal(start_stage, cache_dict, chrom_num_list, log_writ
             "testsnps", cache_dict, chrom_num_list, log_writer
         )  # Recursion
     elif start_stage == "testsnps":
-        for file_name in ["G0_data.memmap", "ss_per_snp.npz"]:
+        for file_name in _G0_file_names:
             log_writer("cloud storage only '{0}'".format(file_name))
             if cache_dict[0].file_exists(file_name):
                 cache_dict[0].cloud_storage_only(file_name, log_writer=log_writer)
@@ -1783,6 +2141,72 @@ def _clear_cache_dict_internal(start_stage, cache_dict, chrom_num_list, log_writ
         raise Exception("Don't know start_stage='{0}'".format(start_stage))
 
 
+#: Part of every G0 fingerprint. Change it when the format of the stage 0 to 3 cache changes.
+cache_version = "single_snp_scale 1"
+
+
+def _G0_fingerprint(G0, X, G0_storage):
+    # A hash of everything that stages 0 to 3 depend on. G0's in-memory values are hashed. Values in files
+    # are represented by the files' names, sizes and modification times.
+    hasher = hashlib.sha256()
+
+    def update(value):
+        hasher.update(str(value).encode())
+        hasher.update(b"\x00")
+
+    update(cache_version)
+    update(G0)
+    _update_source(G0, update, hasher)
+    update("\n".join(f"{fid} {iid}" for fid, iid in G0.iid))
+    update("\n".join(G0.sid))
+    hasher.update(np.ascontiguousarray(G0.pos).tobytes())
+    update(X.shape)
+    hasher.update(np.ascontiguousarray(X).tobytes())
+    update(G0_storage)
+    return hasher.hexdigest()
+
+
+def _update_source(reader, update, hasher):
+    # Follow subsets and merges down to the readers that hold the values
+    if hasattr(reader, "_internal"):
+        _update_source(reader._internal, update, hasher)
+    elif hasattr(reader, "reader_list"):
+        for sub_reader in reader.reader_list:
+            _update_source(sub_reader, update, hasher)
+    elif isinstance(reader, SnpData):
+        val = reader.val
+        update((val.shape, val.dtype))
+        # Blocks of rows, in C order, so that the memory order doesn't matter and an F-order copy stays small
+        row_count = max(1, 2**20 // max(1, val.shape[1]))
+        for start in range(0, val.shape[0], row_count):
+            hasher.update(np.ascontiguousarray(val[start : start + row_count]))
+    elif hasattr(reader, "_storage"):  # for example, DistributedBed
+        storage = reader._storage
+        for file_name in sorted(storage.walk()):
+            update((file_name, storage.getmtime(file_name)))
+    else:
+        for attr in ["filename", "_cache_file"]:
+            file_name = getattr(reader, attr, None)
+            if file_name is not None and os.path.exists(file_name):
+                update(
+                    (
+                        os.path.abspath(file_name),
+                        os.path.getsize(file_name),
+                        os.path.getmtime(file_name),
+                    )
+                )
+
+
+def _pheno_fingerprint(pheno, RxY):
+    # The iids and covariates are already in the G0 fingerprint, so RxY stands for the phenotype values.
+    hasher = hashlib.sha256()
+    hasher.update("\n".join(pheno.sid).encode())
+    hasher.update(b"\x00")
+    hasher.update(str(RxY.shape).encode())
+    hasher.update(np.ascontiguousarray(RxY).tobytes())
+    return hasher.hexdigest()
+
+
 def _cache_dict_fixup(cache_dict, chrom_list):
     # If a dictionary, then fix up the values. Else, fix up the value and create a dictionary.
     if isinstance(cache_dict, Mapping):
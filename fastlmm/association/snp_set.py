@@ -9,6 +9,7 @@ import scipy.stats as stats
 from fastlmm.util.pickle_io import load, save
 import time
 import pandas as pd
+from fastlmm.util.result_file import get_result_format, write_results
 
 def snp_set(
         test_snps,
@@ -47,7 +48,8 @@ def snp_set(
     :param covar: covariate information, optional: The name of a file in PLINK phenotype format.
     :type covar: a 'pheno dictionary' or a string
 
-    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created.
+    :param output_file_name: Name of file to write results to, optional. If not given, no output file will be created. The output format is tab-delimited text,
+         unless the name ends in '.parquet' or '.feather' (these need 'pyarrow', see :mod:`fastlmm.util.result_file`).
     :type output_file_name: file name
 
     :param G0: Training SNPs from which to construct a similarity kernel. It should be the base name of files in PLINK Bed or Ped format.
@@ -125,6 +127,10 @@ def snp_set(
             test="lrt_up"
 
 
+    result_file_name = None
+    if get_result_format(output_file_name) != "tsv": #FastLmmSet writes text, so write it to a temp file and convert it
+        result_file_name, output_file_name = output_file_name, None
+
     if output_file_name is None:
         import tempfile
         fileno, output_file_name = tempfile.mkstemp()
@@ -165,6 +171,8 @@ def snp_set(
     if is_temp:
         fptr.close()
         os.remove(output_file_name)
+    if result_file_name is not None:
+        write_results(dataframe, result_file_name)
 
     return dataframe
     
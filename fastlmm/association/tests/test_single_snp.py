@@ -4,6 +4,7 @@ import logging
 import unittest
 import os.path
 import doctest
+import importlib.util
 import pandas as pd
 from numpy.random import RandomState
 from pathlib import Path
@@ -452,6 +453,330 @@ class TestSingleSnp(unittest.TestCase):
 
         self.compare_files(frame, "one")
 
+    def test_prefetch(self):
+        logging.info("TestSingleSnp test_prefetch")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        frame_list = []
+        for prefetch in [False, True]:
+            frame = single_snp(
+                test_snps=test_snps[:, :25],
+                pheno=pheno,
+                mixing=0,
+                leave_out_one_chrom=False,
+                G0=test_snps[:, 100:105],  # low rank, so blocks of 5 snps
+                covar=covar,
+                GB_goal=0,
+                count_A1=False,
+                prefetch=prefetch,
+            )
+            frame_list.append(frame)
+        assert len(frame_list[0]) == 25
+        np.testing.assert_array_equal(frame_list[0]["SNP"], frame_list[1]["SNP"])
+        np.testing.assert_allclose(
+            frame_list[0]["PValue"], frame_list[1]["PValue"], rtol=1e-10
+        )
+
+    def test_prefetch_close(self):
+        logging.info("TestSingleSnp test_prefetch_close")
+        from fastlmm.association.single_snp import _BlockPrefetcher
+
+        prefetcher = _BlockPrefetcher(lambda work_index: work_index * 10, 5)
+        assert prefetcher.read(0) == 0  # starts reading block 1
+        executor = prefetcher._executor
+        assert executor is not None
+        prefetcher.close()  # as if the caller stopped here
+        assert prefetcher._executor is None and prefetcher._pending is None
+        assert executor._shutdown
+
+    def test_adapt_block_size(self):
+        logging.info("TestSingleSnp test_adapt_block_size")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        frame_list = []
+        # GB_goal=0 shrinks the remaining blocks to 1 snp. GB_goal=None grows them.
+        for adapt_block_size, GB_goal in [(False, 0), (True, 0), (True, None)]:
+            frame = single_snp(
+                test_snps=test_snps[:, :25],
+                pheno=pheno,
+                mixing=0,
+                leave_out_one_chrom=False,
+                G0=test_snps[:, 100:105],  # low rank, so first block of 5 snps
+                covar=covar,
+                GB_goal=GB_goal,
+                count_A1=False,
+                adapt_block_size=adapt_block_size,
+            )
+            frame_list.append(frame.set_index("SNP").sort_index())
+        for frame in frame_list[1:]:
+            assert len(frame) == 25
+            np.testing.assert_allclose(
+                frame.PValue, frame_list[0].PValue, rtol=1e-10
+            )
+
+    def test_screening(self):
+        logging.info("TestSingleSnp test_screening")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        for G0 in [test_snps, test_snps[:, 100:200]]:  # full rank and low rank
+            frame_list = []
+            # The default bound is guaranteed. On this data, the calibrated (approximate) one also drops nothing.
+            for screening, screening_margin in [
+                (False, None),
+                (True, None),
+                (True, 0.5),
+            ]:
+                frame = single_snp(
+                    test_snps=test_snps[:, :1000],
+                    pheno=pheno,
+                    mixing=0,
+                    leave_out_one_chrom=False,
+                    G0=G0,
+                    covar=covar,
+                    count_A1=False,
+                    pvalue_threshold=0.01,
+                    screening=screening,
+                    screening_margin=screening_margin,
+                )
+                frame_list.append(frame.set_index("SNP").sort_index())
+            frame_exact = frame_list[0]
+            assert len(frame_exact) > 0
+            for frame_screening in frame_list[1:]:
+                np.testing.assert_array_equal(frame_screening.index, frame_exact.index)
+                np.testing.assert_allclose(
+                    frame_screening.PValue, frame_exact.PValue, rtol=1e-10
+                )
+
+    def test_float32_scan(self):
+        logging.info("TestSingleSnp test_float32_scan")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        for G0 in [test_snps, test_snps[:, 100:200]]:  # full rank and low rank
+            frame_list = []
+            for float32_scan in [False, True]:
+                frame = single_snp(
+                    test_snps=test_snps[:, :100],
+                    pheno=pheno,
+                    mixing=0,
+                    leave_out_one_chrom=False,
+                    G0=G0,
+                    covar=covar,
+                    count_A1=False,
+                    float32_scan=float32_scan,
+                    float32_recheck_threshold=0.2,
+                )
+                frame_list.append(frame.set_index("SNP").sort_index())
+            frame64, frame32 = frame_list
+            np.testing.assert_allclose(frame32.PValue, frame64.PValue, rtol=1e-3)
+            is_recheck = frame64.PValue < 0.1
+            assert is_recheck.any()
+            np.testing.assert_allclose(
+                frame32.PValue[is_recheck], frame64.PValue[is_recheck], rtol=1e-10
+            )
+
+    def test_snp_stats_columns(self):
+        logging.info("TestSingleSnp test_snp_stats_columns")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        frame = single_snp(
+            test_snps=test_snps[:, :10],
+            pheno=pheno,
+            mixing=0,
+            leave_out_one_chrom=False,
+            G0=test_snps,
+            covar=covar,
+            count_A1=False,
+            snp_stats_columns=True,
+        )
+        self.compare_files(frame, "one")
+
+        snps = test_snps[:, frame["sid_index"].values.astype(int)].read().val
+        allele_freq = np.nanmean(snps, axis=0) / 2.0
+        np.testing.assert_allclose(
+            frame["MAF"], np.minimum(allele_freq, 1.0 - allele_freq), rtol=1e-10
+        )
+        np.testing.assert_allclose(
+            frame["CallRate"], 1.0 - np.isnan(snps).mean(axis=0), rtol=1e-10
+        )
+
+    def test_profile(self):
+        logging.info("TestSingleSnp test_profile")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        output_file = self.file_name("profile")
+        profile_file = os.path.join(self.tempout_dir, "profile.json")
+        frame = single_snp(
+            test_snps=test_snps[:, ::10],
+            pheno=pheno,
+            G0=test_snps[:, ::20],
+            covar=covar,
+            count_A1=False,
+            output_file_name=output_file,
+            profile_file_name=profile_file,
+        )
+        profile = pd.read_json(profile_file, orient="records")
+        assert len(profile) == len(frame.attrs["profile"])
+        for stage in [
+            "kernel fixup",
+            "kernel read",
+            "eigendecomposition",
+            "h2 search",
+            "snp block read",
+            "standardization",
+            "rotation",
+            "nLLeval",
+            "stats",
+            "output write",
+        ]:
+            assert stage in set(profile.stage), stage
+        block_read = profile[profile.stage == "snp block read"]
+        assert set(block_read.chrom) == set(test_snps.pos[:, 0])
+        assert block_read.snp_count.sum() == len(frame)
+        assert (block_read.bytes > 0).all()
+        assert (profile.wall_time >= 0).all()
+
+    def test_h2_optimizer(self):
+        logging.info("TestSingleSnp test_h2_optimizer")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        frame_list = [
+            single_snp(
+                test_snps=test_snps[:, ::10],
+                pheno=pheno,
+                G0=test_snps[:, ::20],
+                covar=covar,
+                count_A1=False,
+                h2_optimizer=h2_optimizer,
+            )
+            for h2_optimizer in ["grid", "newton"]
+        ]
+        assert np.array_equal(frame_list[0].SNP, frame_list[1].SNP)
+        assert np.allclose(frame_list[0].PValue, frame_list[1].PValue, rtol=1e-3)
+        assert np.allclose(frame_list[0].Nullh2, frame_list[1].Nullh2, atol=1e-4)
+
+    def test_output_top_n(self):
+        logging.info("TestSingleSnp test_output_top_n")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        frame_full = single_snp(
+            test_snps=test_snps[:, ::10],
+            pheno=pheno,
+            G0=test_snps[:, ::20],
+            covar=covar,
+            GB_goal=1e-4,
+            count_A1=False,
+        )
+        for leave_out_one_chrom in [True, False]:
+            output_file = self.file_name(f"output_top_n_{leave_out_one_chrom}")
+            frame = single_snp(
+                test_snps=test_snps[:, ::10],
+                pheno=pheno,
+                G0=test_snps[:, ::20],
+                covar=covar,
+                GB_goal=1e-4,
+                leave_out_one_chrom=leave_out_one_chrom,
+                output_file_name=output_file,
+                output_top_n=5,
+                count_A1=False,
+            )
+            assert len(frame) == 5
+            if leave_out_one_chrom:
+                assert np.array_equal(frame.SNP, frame_full.SNP[:5])
+                frame_file = pd.read_csv(output_file, sep="\t")
+                # rows with tied PValues may come out in a different order
+                assert set(frame_file.SNP) == set(frame_full.SNP)
+                assert np.allclose(frame_file.PValue, frame_full.PValue, rtol=1e-10)
+            assert not os.path.exists(output_file + ".spill")
+
+    def test_permutation_count(self):
+        logging.info("TestSingleSnp test_permutation_count")
+        from fastlmm.association.single_snp import _permuted_pheno
+
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = Pheno(self.phen_fn).read()
+        covar = Pheno(self.cov_fn)
+
+        frame = single_snp(
+            test_snps=test_snps[:, ::10],
+            pheno=pheno,
+            G0=test_snps[:, ::20],
+            covar=covar,
+            leave_out_one_chrom=False,
+            permutation_count=10,
+            count_A1=False,
+        )
+        assert len(frame) == 10 and len(set(frame.Pheno)) == 10
+        assert np.all(np.diff(frame.PValue) >= 0)
+
+        # Each row matches testing that permuted phenotype by itself
+        permuted, _ = _permuted_pheno(pheno, covar, 10, seed=0)
+        frame_one = single_snp(
+            test_snps=test_snps[:, ::10],
+            pheno=permuted[:, [3]],
+            G0=test_snps[:, ::20],
+            covar=covar,
+            leave_out_one_chrom=False,
+            count_A1=False,
+        )
+        row = frame[frame.Pheno == permuted.sid[3]].iloc[0]
+        assert row.SNP == frame_one.SNP[0]
+        assert np.isclose(row.PValue, frame_one.PValue[0], rtol=1e-3)
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("pyarrow") or os.environ.get("CI"),
+        "reading and writing Parquet needs pyarrow (CI installs it, so never skips)",
+    )
+    def test_output_parquet(self):
+        logging.info("TestSingleSnp test_output_parquet")
+        from fastlmm.util.result_file import read_results
+
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        for output_top_n in [None, 5]:
+            output_file = os.path.join(
+                self.tempout_dir, f"output_parquet_{output_top_n}.parquet"
+            )
+            frame = single_snp(
+                test_snps=test_snps[:, ::10],
+                pheno=pheno,
+                G0=test_snps[:, ::20],
+                covar=covar,
+                output_file_name=output_file,
+                output_top_n=output_top_n,
+                count_A1=False,
+            )
+            frame_file = read_results(output_file)
+            assert frame_file.PValue.dtype == np.float64
+            assert np.array_equal(frame_file.SNP[: len(frame)], frame.SNP)
+            assert np.allclose(frame_file.PValue[: len(frame)], frame.PValue, rtol=1e-10)
+
+    def test_output_parquet_no_pyarrow(self):
+        logging.info("TestSingleSnp test_output_parquet_no_pyarrow")
+        from fastlmm.util.result_file import write_results
+
+        output_file = os.path.join(self.tempout_dir, "no_pyarrow.parquet")
+        with patch.dict(sys.modules, {"pyarrow": None}):
+            with self.assertRaisesRegex(ImportError, "pyarrow"):
+                write_results(pd.DataFrame({"PValue": [0.5]}), output_file)
+
     def test_other(self):
         logging.info("TestSingleSnp test_other")
         test_snps = Bed(self.bedbase, count_A1=False)
@@ -695,6 +1020,32 @@ class TestSingleSnp(unittest.TestCase):
         )
         self.compare_files(frame, "G1")
 
+    def test_file_cache_stale(self):
+        logging.info("TestSingleSnp test_file_cache_stale")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        cache_file = self.file_name("cache_file_stale") + ".npz"
+        for p in Path(cache_file).parent.glob(Path(cache_file).name + "*"):
+            p.unlink()
+        # The 2nd run must not use the cache made from different kernel SNPs.
+        # The 3rd run uses the cache made by the 2nd.
+        for G0 in [test_snps[:, 10:100], test_snps, test_snps]:
+            frame = single_snp(
+                test_snps=test_snps[:, :10],
+                pheno=pheno,
+                G0=G0,
+                mixing=0,
+                leave_out_one_chrom=False,
+                covar=covar,
+                cache_file=cache_file,
+                count_A1=False,
+            )
+        self.compare_files(frame, "one")
+        U_file_list = list(Path(cache_file).parent.glob(Path(cache_file).name + ".*.U.npy"))
+        assert len(U_file_list) == 1, "Expect the stale U file to be removed"
+
     def test_G1_mixing(self):
         logging.info("TestSingleSnp test_G1_mixing")
         test_snps = Bed(self.bedbase, count_A1=False)
@@ -716,6 +1067,51 @@ class TestSingleSnp(unittest.TestCase):
 
         self.compare_files(frame, "one")
 
+    def test_find_mixing_qr(self):
+        logging.info("TestSingleSnp test_find_mixing_qr")
+        import fastlmm.util.mingrid as mingrid
+        from fastlmm.association.single_snp import (
+            _find_mixing_from_Gs,
+            _mix_from_Gs,
+        )
+        from fastlmm.inference.lmm_cov import LMM as lmm_cov
+
+        randomstate = RandomState(1)
+        iid_count, k0, k1 = 100, 10, 15
+        G0_val = randomstate.normal(size=(iid_count, k0))
+        G1_val = randomstate.normal(size=(iid_count, k1))
+        covar = np.c_[randomstate.normal(size=(iid_count, 2)), np.ones(iid_count)]
+        y = (
+            G0_val.dot(randomstate.normal(size=k0)) * 0.3
+            + G1_val.dot(randomstate.normal(size=k1)) * 0.2
+            + randomstate.normal(size=iid_count)
+        )[:, np.newaxis]
+
+        # The search before the QR factorization: a full SVD of the mixed G at every trial.
+        G_svd = np.empty((iid_count, k0 + k1))
+
+        def nLL(mixing):
+            _mix_from_Gs(G_svd, G0_val, G1_val, mixing)
+            lmm = lmm_cov(X=covar, Y=y, G=G_svd, K=None, inplace=True)
+            return lmm.findH2()
+
+        mixing_svd, nLL_svd = mingrid.minimize1D(
+            f=lambda mixing: nLL(mixing)["nLL"],
+            nGrid=10,
+            minval=0.0,
+            maxval=1.0,
+            verbose=False,
+        )
+
+        G = np.empty((iid_count, k0 + k1))
+        mixing, h2 = _find_mixing_from_Gs(G, covar, G0_val, G1_val, None, y, np)
+        result = nLL(mixing)
+        assert abs(mixing - mixing_svd) < 1e-6
+        assert abs(result["nLL"] - nLL_svd) < 1e-8
+        assert abs(h2 - result["h2"]) < 1e-6
+        _mix_from_Gs(G_svd, G0_val, G1_val, mixing)
+        assert np.allclose(G, G_svd, rtol=0, atol=1e-12)
+
     def test_unknown_sid(self):
         logging.info("TestSingleSnp test_unknown_sid")
 
@@ -869,6 +1265,28 @@ class TestSingleSnpLeaveOutOneChrom(unittest.TestCase):
 
         self.compare_files(frame, "one_looc")
 
+    def test_loco_kernel_blocks(self):
+        logging.info("TestSingleSnpLeaveOutOneChrom test_loco_kernel_blocks")
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+
+        for force_full_rank, force_low_rank in [(False, False), (False, True)]:
+            output_file = self.file_name(f"loco_kernel_blocks{force_low_rank}")
+            frame = single_snp(
+                test_snps,
+                pheno,
+                covar=covar,
+                mixing=0,
+                output_file_name=output_file,
+                count_A1=False,
+                force_full_rank=force_full_rank,
+                force_low_rank=force_low_rank,
+                loco_kernel_blocks=True,
+            )
+
+            self.compare_files(frame, "one_looc")
+
     def test_runner(self):
         logging.info("TestRunner")
         test_snps = Bed(self.bedbase, count_A1=False)
@@ -139,6 +139,158 @@ class TestSingleSnpScale(unittest.TestCase):
             )
             self.compare_files(results_df, "old")
 
+    def test_G0_storage_int8(self):
+        logging.info("test_G0_storage_int8")
+
+        output_file = self.file_name("G0_storage_int8")
+
+        storage = LocalCache("local_cache/G0_storage_int8")
+        for clear_cache in (True, False):
+            if clear_cache:
+                storage.rmtree()
+            results_df = single_snp_scale(
+                test_snps=self.bed,
+                pheno=self.phen_fn,
+                covar=self.cov_fn,
+                cache=storage,
+                output_file_name=output_file,
+                G0_storage="int8",
+            )
+            self.compare_files(results_df, "old")
+
+    def test_pipeline_count(self):
+        logging.info("test_pipeline_count")
+
+        output_file = self.file_name("pipeline_count")
+
+        storage = LocalCache("local_cache/pipeline_count")
+        storage.rmtree()
+        results_df = single_snp_scale(
+            test_snps=self.bed,
+            pheno=self.phen_fn,
+            covar=self.cov_fn,
+            cache=storage,
+            output_file_name=output_file,
+            pipeline_count=3,
+        )
+        self.compare_files(results_df, "old")
+
+    def test_pheno_rerun(self):
+        logging.info("test_pheno_rerun")
+
+        output_file = self.file_name("pheno_rerun")
+
+        storage = LocalCache("local_cache/pheno_rerun")
+        storage.rmtree()
+        pheno_reference = Pheno(self.phen_fn).read()
+        pheno_other = SnpData(
+            iid=pheno_reference.iid,
+            sid=["pheno_other"],
+            val=RandomState(2101).permutation(pheno_reference.val),
+        )
+
+        def G0_mtimes():
+            # The files of stages 0 to 3 that don't depend on the phenotype
+            return {
+                os.path.join(root, name): os.path.getmtime(os.path.join(root, name))
+                for root, _, name_list in os.walk(storage.name)
+                for name in name_list
+                if not os.path.basename(root).startswith("pheno_")
+                and "4_TestSNPs" not in root
+            }
+
+        results_df = single_snp_scale(
+            test_snps=self.bed,
+            pheno=self.phen_fn,
+            covar=self.cov_fn,
+            cache=storage,
+            output_file_name=output_file,
+        )
+        self.compare_files(results_df, "old")
+        mtimes = G0_mtimes()
+        assert any(name.endswith("U.memmap") for name in mtimes)
+
+        reference = single_snp(
+            test_snps=self.bed, pheno=pheno_other, covar=self.cov_fn
+        )
+        for pheno, ref in ((pheno_other, reference), (self.phen_fn, "old")):
+            results_df = single_snp_scale(
+                test_snps=self.bed,
+                pheno=pheno,
+                covar=self.cov_fn,
+                cache=storage,
+                output_file_name=output_file,
+            )
+            if isinstance(ref, str):
+                self.compare_files(results_df, ref)
+            else:
+                frame = results_df.set_index("SNP").loc[ref.SNP]
+                np.testing.assert_allclose(
+                    frame.PValue.values, ref.PValue.values, rtol=1e-5, atol=1e-5
+                )
+            assert G0_mtimes() == mtimes, "expect stages 0 to 3 to be reused"
+
+    def test_factor_gtg(self):
+        logging.info("test_factor_gtg")
+        from fastlmm.association.single_snp_scale import _factor_gtg
+        import numpy.linalg as la
+
+        random_state = RandomState(2021)
+        G = random_state.normal(size=(200, 40))
+        ata_val = G.T.dot(G)
+        factor = 1.7
+
+        # The SVD-based factorization that _factor_gtg replaced
+        ata_svd = ata_val * (float(ata_val.shape[0]) / np.diag(ata_val).sum())
+        Uata3, Sata3, _ = la.svd(ata_svd, full_matrices=False, compute_uv=True)
+        Sata3 *= factor * np.diag(ata_val).sum() / ata_val.shape[0]
+        S3 = Sata3**0.5
+        SVinv3 = la.inv(np.dot(np.diag(S3), Uata3.T)) * np.sqrt(factor)
+        inonzero = S3 > 1e-10
+        S_svd, SVinv3b_svd = S3[inonzero] ** 2, SVinv3[:, inonzero]
+
+        SVinv3b, S = _factor_gtg(ata_val.copy(), factor)
+        np.testing.assert_allclose(S, S_svd, rtol=1e-10)
+        # Each column is determined up to its sign
+        sign = np.sign((SVinv3b * SVinv3b_svd).sum(0))
+        np.testing.assert_allclose(SVinv3b * sign, SVinv3b_svd, rtol=1e-8, atol=1e-12)
+
+    def test_G0_fingerprint(self):
+        logging.info("test_G0_fingerprint")
+        from fastlmm.association.single_snp_scale import _G0_fingerprint
+
+        X = np.ones((self.bed.iid_count, 1))
+        snpdata0 = self.bed[:, :20].read()
+
+        def in_memory(val):
+            return SnpData(
+                iid=snpdata0.iid, sid=snpdata0.sid, pos=snpdata0.pos, val=val
+            )
+
+        snpdata = in_memory(snpdata0.val)
+        snpdata_same = in_memory(snpdata0.val.copy())
+        snpdata_other = in_memory(snpdata0.val.copy())
+        snpdata_other.val[0, 0] = 2 - snpdata_other.val[0, 0]
+        assert str(snpdata) == str(snpdata_other)
+        assert _G0_fingerprint(snpdata, X, "float64") == _G0_fingerprint(
+            snpdata_same, X, "float64"
+        )
+        assert _G0_fingerprint(snpdata, X, "float64") != _G0_fingerprint(
+            snpdata_other, X, "float64"
+        )
+
+        # A file's fingerprint changes when the file does
+        bed_dir = os.path.join(self.tempout_dir, "G0_fingerprint")
+        pstutil.create_directory_if_necessary(bed_dir, isfile=False)
+        Bed.write(os.path.join(bed_dir, "G0.bed"), snpdata, count_A1=True)
+        bed = Bed(os.path.join(bed_dir, "G0.bed"), count_A1=True)
+        fingerprint = _G0_fingerprint(bed[::2, :], X[::2], "float64")
+        assert fingerprint == _G0_fingerprint(bed[::2, :], X[::2], "float64")
+        Bed.write(os.path.join(bed_dir, "G0.bed"), snpdata_other, count_A1=True)
+        os.utime(bed.filename, (0, 0))
+        bed = Bed(os.path.join(bed_dir, "G0.bed"), count_A1=True)
+        assert fingerprint != _G0_fingerprint(bed[::2, :], X[::2], "float64")
+
     def test_multipheno(self):
         logging.info("test_multipheno")
 
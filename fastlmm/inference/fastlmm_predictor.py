@@ -232,6 +232,7 @@ class FastLMM(object):
                      * **snp_standardizer** (:class:`Standardizer`) -- The PySnpTools standardizer to be apply to SNP data. Choices include :class:`Standardizer.Unit` (Default. Makes values for each SNP have mean zero and standard deviation 1.0, then fills missing with zero) and :class:`Standardizer.Identity` (Do nothing)
                      * **covariate_standardizer** (:class:`Standardizer`) -- The PySnpTools standardizer to be apply to X, the covariate data. Some choices include :class:`Standardizer.Unit` (Default. Fills missing with zero) and :class:`Standardizer.Identity` (do nothing)
                      * **kernel_standardizer** (:class:`KernelStandardizer`) -- The PySnpTools kernel standardizer to be apply to the kernels. Some choices include :class:`KernelStandardizer.DiagKToN` (Default. Make the diagonal sum to iid_count)  and :class:`KernelStandardizer.Identity` (Do nothing)
+                     * **h2_optimizer** (string) -- How :meth:`fit` searches for h2. "grid" (Default) evaluates a grid and refines it with Brent's method. "newton" takes Newton steps in log(delta) and falls back to the grid if they don't find the minimum.
 
         :Example:
 
@@ -259,13 +260,14 @@ class FastLMM(object):
 
         '''
 
-    def __init__(self, GB_goal=None, force_full_rank=False, force_low_rank=False, snp_standardizer=Unit(), covariate_standardizer=Unit(), kernel_standardizer=DiagKtoN()):
+    def __init__(self, GB_goal=None, force_full_rank=False, force_low_rank=False, snp_standardizer=Unit(), covariate_standardizer=Unit(), kernel_standardizer=DiagKtoN(), h2_optimizer="grid"):
         self.GB_goal = GB_goal
         self.force_full_rank = force_full_rank
         self.force_low_rank = force_low_rank
         self.snp_standardizer = snp_standardizer
         self.covariate_standardizer = covariate_standardizer
         self.kernel_standardizer = kernel_standardizer
+        self.h2_optimizer = h2_optimizer
         self.is_fitted = False
 
     #!!!update doc to explain h2raw w.r.t h2
@@ -366,7 +368,7 @@ class FastLMM(object):
 
             # Find the best h2 and also on covariates (not given from new model)
             if h2raw is None:
-                res = lmm.findH2() #!!!why is REML true in the return???
+                res = lmm.findH2(optimizer=self.h2_optimizer) #!!!why is REML true in the return???
             else:
                 res = lmm.nLLeval(h2=h2raw)
 
@@ -9,6 +9,8 @@ from fastlmm.util.util import *
 import time
 import warnings
 import logging
+from fastlmm.inference.lmm_cov import nLL_log_delta_derivatives
+from fastlmm.inference.lmm_cov import randomized_svd as _randomized_svd
 
 class LMM(object):
     """
@@ -104,7 +106,7 @@ class LMM(object):
         self.y   = y
         N=self.y.shape[0]
 
-    def setG(self, G0=None, G1=None, a2=0.0, K0=None,K1=None):
+    def setG(self, G0=None, G1=None, a2=0.0, K0=None,K1=None, randomized_svd=None):
         '''
         set the Kernel (1-a2)*K0 and a2*K1 from G0 and G1.
         This has to be done before setting the data setX() and setY(). 
@@ -119,6 +121,9 @@ class LMM(object):
 
         K0              : [N*N] array, random effects covariance (positive semi-definite)
         K1              : [N*N] array, random effects covariance (positive semi-definite)(optional)
+        randomized_svd  : dictionary of keyword arguments for fastlmm.inference.lmm_cov.randomized_svd (for example, {'rank':1000}), optional.
+                          If given, and G has fewer columns than rows, use a randomized truncated SVD of G, falling back
+                          to the exact SVD if its estimated error is too large.
         -----------------------------------------------------------------------------
         '''
         self.G0 = G0
@@ -154,7 +159,13 @@ class LMM(object):
             if ((not self.forcefullrank) and (k<N)):
                 #it is faster using the eigen decomposition of G.T*G but this is more accurate
                 try:
-                    [U,S,V] = LA.svd(self.G,full_matrices = False) #!!!use big_svd?
+                    result = None
+                    if randomized_svd is not None:
+                        result = _randomized_svd(self.G, **randomized_svd)
+                    if result is not None:
+                        U,S,error = result
+                    else:
+                        [U,S,V] = LA.svd(self.G,full_matrices = False)
                     if np.any(S < -0.1):
                         logging.warning("kernel contains a negative Eigenvalue")
                     self.U = U
@@ -296,7 +307,7 @@ class LMM(object):
         #print "numcalls to innerLoopTwoKernel= " + str(self.numcalls)
         return resmin[0]
 
-    def findH2(self, nGridH2=10, minH2 = 0.0, maxH2 = 0.99999, REML=True, **kwargs):
+    def findH2(self, nGridH2=10, minH2 = 0.0, maxH2 = 0.99999, REML=True, optimizer="grid", **kwargs):
         '''
         Find the optimal h2 for a given K. Note that this is the single kernel case. So there is no a2.
         (default maxH2 value is set to a value smaller than 1 to avoid loss of positive definiteness of the final model covariance)
@@ -305,11 +316,19 @@ class LMM(object):
         nGridH2 : number of h2-grid points to evaluate the negative log-likelihood at
         minH2   : minimum value for h2 optimization
         maxH2   : maximum value for h2 optimization
+        optimizer: "grid" (grid plus Brent's method) or "newton" (Newton steps in log(delta),
+                   falling back to the grid, see fastlmm.inference.lmm_cov.LMM.findH2)
         --------------------------------------------------------------------------
         Output:
         dictionary containing the model parameters at the optimal h2
         --------------------------------------------------------------------------
         '''
+        if optimizer == "newton" and not kwargs and len(self.exclude_idx) == 0:
+            min_log_delta = NP.log((1.0-maxH2)/maxH2)
+            max_log_delta = NP.log((1.0-minH2)/minH2) if minH2 > 0.0 else 20.0
+            return self._find_newton(min_log_delta, max_log_delta, REML, lambda : self.findH2(nGridH2=nGridH2, minH2=minH2, maxH2=maxH2, REML=REML))
+        assert optimizer in {"grid", "newton"}, "optimizer must be 'grid' or 'newton'"
+
         #f = lambda x : (self.nLLeval(h2=x,**kwargs)['nLL'])
         resmin=[None]
         def f(x,resmin=resmin,**kwargs):
@@ -321,10 +340,19 @@ class LMM(object):
         min = minimize1D(f=f, nGrid=nGridH2, minval=minH2, maxval=maxH2 )
         return resmin[0]
 
-    def find_log_delta(self, sid_count, min_log_delta=-5, max_log_delta=10, nGrid=10, REML=True, **kwargs):
+    def find_log_delta(self, sid_count, min_log_delta=-5, max_log_delta=10, nGrid=10, REML=True, optimizer="grid", **kwargs):
         '''
         #Need comments
         '''
+        if optimizer == "newton" and not kwargs and len(self.exclude_idx) == 0:
+            #internal log delta is external log delta plus log(sid_count)
+            res = self._find_newton(NP.log(sid_count)+min_log_delta, NP.log(sid_count)+max_log_delta, REML,
+                                    lambda : self.find_log_delta(sid_count, min_log_delta=min_log_delta, max_log_delta=max_log_delta, nGrid=nGrid, REML=REML))
+            if 'log_delta' not in res:
+                res['log_delta'] = NP.log((1.0/res['h2']-1.0) / sid_count)
+            return res
+        assert optimizer in {"grid", "newton"}, "optimizer must be 'grid' or 'newton'"
+
         #f = lambda x : (self.nLLeval(h2=x,**kwargs)['nLL'])
         resmin=[None]
         def f(x,resmin=resmin,**kwargs):
@@ -343,6 +371,36 @@ class LMM(object):
         return res
 
 
+    def _find_newton(self, min_log_delta, max_log_delta, REML, grid_search):
+        '''
+        Find the optimal h2 with Newton steps in log(delta), using the grid if they fail
+        --------------------------------------------------------------------------
+        Input:
+        min_log_delta   : minimum value for log delta (h2 = 1/(1+delta))
+        max_log_delta   : maximum value for log delta
+        REML            : boolean
+        grid_search     : function that returns the result of the grid search
+        --------------------------------------------------------------------------
+        Output:
+        dictionary containing the model parameters at the optimal h2,
+        plus 'newton_iterations', 'newton_gradient' and 'newton_converged'
+        --------------------------------------------------------------------------
+        '''
+        UA = NP.c_[self.UX,self.Uy]
+        UUA = NP.c_[self.UUX,self.UUy] if self.S.shape[0] < self.y.shape[0] else None
+        f = lambda x : nLL_log_delta_derivatives(x, self.S, self.y.shape[0], UA, UUA, D=self.UX.shape[1], REML=REML)
+        log_delta, nLL, gradient, iterations, converged = minimize1D_newton(f, x0=min(max(0.0,min_log_delta),max_log_delta), minval=min_log_delta, maxval=max_log_delta)
+        res = self.nLLeval(h2=1.0/(1.0+NP.exp(log_delta)), REML=REML)
+        #like the grid search, also check the bounds
+        for log_delta_bound in [min_log_delta, max_log_delta]:
+            converged = converged and self.nLLeval(h2=1.0/(1.0+NP.exp(log_delta_bound)), REML=REML)['nLL'] >= res['nLL']
+        if not converged:
+            logging.info("Newton's method didn't find the minimum, so using the grid")
+            res = grid_search()
+        res['newton_iterations'] = iterations
+        res['newton_gradient'] = gradient
+        res['newton_converged'] = converged
+        return res
 
     def nLLeval(self,h2=0.0, REML=True, logdelta = None, delta = None, dof = None, scale = 1.0,penalty=0.0):
         '''
@@ -2,9 +2,12 @@ import numpy as np
 import scipy.optimize as opt
 import scipy.stats as st
 import scipy.special as ss
+from scipy.linalg import eigh_tridiagonal
+from scipy.linalg.lapack import dsytrd, dormqr
 from fastlmm.util.mingrid import *
 from fastlmm.util.util import *
 import time
+import copy
 import pysnptools.util as pstutil
 
 class LMM(object):
@@ -23,10 +26,10 @@ class LMM(object):
     TODO: Add full support for multiple phenotypes by extending h2 and a2
     TODO: Deal with h2_1 parameterization more eloquently (see comments below)
     '''
-    __slots__ = ["linreg","G","Y","X","K","U","S","UX","UY","UUX","UUY","forcefullrank","regressX","numcalls","_xp"]
+    __slots__ = ["linreg","G","Y","X","K","U","S","UX","UY","UUX","UUY","forcefullrank","regressX","numcalls","_xp","randomized_svd"]
 
     def __init__(self, forcefullrank=False, X=None, linreg=None, Y=None, G=None, K=None, regressX=True, inplace=False,
-                S=None, U=None, xp=None):
+                S=None, U=None, xp=None, randomized_svd=None):
         '''
 
         Args:
@@ -40,8 +43,12 @@ class LMM(object):
              K              : [N x N] np.array positive semi-definite Kernel matrix
              regressX       : regress out covariates to speed up computations? (default: True)
              inplace        : set kernel without copying? (default: False)
+             randomized_svd : dictionary of keyword arguments for randomized_svd (for example, {'rank':1000}). If given,
+                                and G has fewer columns than rows, setSU_fromG uses a randomized truncated SVD, falling back
+                                to the exact SVD if its estimated error is too large. (default: None, the exact SVD)
         '''
         self._xp = pstutil.array_module(xp)
+        self.randomized_svd = randomized_svd
         self.numcalls = 0
         self.setX(X=X, regressX=regressX, linreg=linreg)    #set the covariates (needs to be first)
         self.forcefullrank = forcefullrank
@@ -97,6 +104,47 @@ class LMM(object):
         self.U = self.U[:,D:N]
         self.S = self.S[D:N] - 1.0
 
+    def setSUY_fromK_tridiagonal(self):
+        """
+        compute the eigenvalues of the full kernel and the rotated phenotypes, but not the eigenvectors themselves
+        (full rank computations). This is enough for findH2 and skips transforming the eigenvectors back from
+        the tridiagonal form of the kernel, the most expensive part of 'setSU_fromK'.
+        Afterwards, U holds the eigenvectors in the basis of the tridiagonal form, so SNPs can't be rotated with it.
+        The LAPACK routines run on NumPy arrays, so with another array module, this is 'setSU_fromK'.
+        """
+        if self._xp is not np:
+            self.setSU_fromK()
+            return
+        N = self.K.shape[0]
+        D = self.linreg.D
+        self.K.flat[::N+1]+=1.0
+        K_ = self.linreg.regress(Y=self.K)
+        K_ = self.linreg.regress(Y=K_.T)
+        #K_ is symmetric, so its transpose is it in Fortran order
+        c,d,e,tau,info = dsytrd(K_.T, lower=1, overwrite_a=1)
+        assert info==0, "dsytrd failed"
+        del K_
+        #K_ = Q*T*Q.T with Q = H(1)*...*H(N-1). Like LAPACK's dormtr (which SciPy doesn't wrap), get Q.T*Y by applying
+        #the reflectors stored below the subdiagonal, blocked, with dormqr
+        QY = np.array(self.linreg.regress(Y=self.Y), dtype=float, order="F")
+        if N > 1:
+            reflectors = np.asfortranarray(c[1:,:N-1])
+            del c
+            work = dormqr("L", "T", reflectors, tau[:N-1], QY[1:], lwork=-1)[1]
+            QY[1:], _, info = dormqr("L", "T", reflectors, tau[:N-1], QY[1:], lwork=int(work[0]))
+            assert info==0, "dormqr failed"
+            del reflectors
+        else:
+            del c
+        [S,U] = eigh_tridiagonal(d, e)
+        if np.any(S < -0.1):
+            logging.warning("kernel contains a negative Eigenvalue")
+
+        self.U = U[:,D:N]
+        self.S = S[D:N] - 1.0
+        self.UY = self.U.T.dot(QY)
+        self.UUY = None
+
 
     def setSU_fromG(self):
         """
@@ -109,9 +157,15 @@ class LMM(object):
             if ((not self.forcefullrank) and (k < N)):
                 PxG = self.linreg.regress(Y=self.G)
                 #was
-                logging.info("Starting SVD")
-                [self.U,self.S,V] = self._xp.linalg.svd(PxG,full_matrices=False,compute_uv=True) #, N x min, min, min x k
-                logging.info("Ending SVD")
+                result = None
+                if self.randomized_svd is not None:
+                    result = randomized_svd(PxG, xp=self._xp, **self.randomized_svd)
+                if result is not None:
+                    self.U,self.S,error = result
+                else:
+                    logging.info("Starting SVD")
+                    [self.U,self.S,V] = self._xp.linalg.svd(PxG,full_matrices=False,compute_uv=True) #, N x min, min, min x k
+                    logging.info("Ending SVD")
                 inonzero = self._xp.arange(len(self.S))[self.S > 1E-10] #This 'arange' trick allows this indexing to work whether the svd is "full_matrix" or not.
                 self.S = self.S[inonzero]
                 self.U = self.U[:,inonzero]
@@ -161,7 +215,9 @@ class LMM(object):
         # treat pathological case where a variable is explained by the covariates
         A_std = A.std(0)
         A[:,A_std<=1e-10] = 0.0
-        if (S.shape[0] < N - D):#lowrank case
+        if isinstance(U, np.memmap):#U is on disk, so stream it in row tiles
+            UA,UUA = rotate_blocked(U, A, lowrank=S.shape[0] < N - D)
+        elif (S.shape[0] < N - D):#lowrank case
             # A = self.linreg.regress(A)
             UA = U.T.dot(A)
             UUA = A - U.dot(UA)
@@ -176,6 +232,31 @@ class LMM(object):
         return UA,UUA
 
 
+    def astype(self, dtype):
+        """
+        get a shallow copy of the LMM whose arrays used in testing SNPs (U, the rotated phenotypes
+        and the covariates) have the given dtype, for example, np.float32.
+        S and Y are shared with this LMM and keep their dtype. A memory-mapped U is also shared, rather than
+        read into memory as a converted copy. rotate converts its tiles to the dtype of the matrix it rotates.
+
+        Args:
+            dtype   : numpy dtype
+        Returns:
+            LMM that shares S and Y with this one
+        """
+        S,U = self.getSU()
+        UY,UUY = self.getUY()
+        if self.linreg.X is not None and self.linreg.Xdagger is None:
+            self.linreg.set_beta(Y=self.Y) #computes Xdagger
+        result = copy.copy(self)
+        result.U = U if isinstance(U, np.memmap) else U.astype(dtype)
+        result.UY = UY.astype(dtype)
+        result.UUY = None if UUY is None else UUY.astype(dtype)
+        result.linreg = Linreg(X=None if self.linreg.X is None else self.linreg.X.astype(dtype),
+                               Xdagger=None if self.linreg.Xdagger is None else self.linreg.Xdagger.astype(dtype),
+                               xp=self._xp)
+        return result
+
     def getUY(self, idx_pheno=None):
         """
         get the rotated phenotype matrix
@@ -188,7 +269,7 @@ class LMM(object):
             UUY     None if kernel is full rank, otherwise Y-U.dot(U.T.dot(Y))
         """
 
-        if self.UY is None or self.UUY is None:
+        if self.UY is None: #UUY is None when the kernel is full rank
             self.UY,self.UUY = self.rotate(A=self.Y)
         if idx_pheno is None:
             return self.UY,self.UUY
@@ -374,7 +455,7 @@ class LMM(object):
         min = minimize1D(f=f, nGrid=nGridH2, minval=minH2, maxval=maxH2)
         return resmin[0]
         
-    def find_log_delta(self, sid_count=1, min_log_delta=-5, max_log_delta=10, nGrid=10, **kwargs):
+    def find_log_delta(self, sid_count=1, min_log_delta=-5, max_log_delta=10, nGrid=10, optimizer="grid", **kwargs):
         '''
         perform search for optimal log delta (single kernel case)
 
@@ -383,10 +464,21 @@ class LMM(object):
              min_log_delta:  minimum value for log delta search (default: -5)
              max_log_delta:  maximum value for log delta search (default: 5)
              nGrid:          number of grid points for Brent search intervals (default: 10)
+             optimizer:      "grid" or "newton" (see findH2) (default: "grid")
              
         Returns:
             dictionary containing the model parameters at the optimal log delta
         '''
+        if optimizer == "newton" and not kwargs:
+            assert self.Y.shape[1] == 1, "find_log_delta expects a single phenotype"
+            #internal log delta is external log delta plus log(sid_count)
+            res = self._find_newton(np.log(sid_count) + min_log_delta, np.log(sid_count) + max_log_delta,
+                                    lambda: self.find_log_delta(sid_count=sid_count, min_log_delta=min_log_delta, max_log_delta=max_log_delta, nGrid=nGrid))
+            if 'log_delta' not in res:
+                res['log_delta'] = np.log((1.0 / res['h2'] - 1.0) / sid_count)
+            return res
+        assert optimizer in {"grid", "newton"}, "optimizer must be 'grid' or 'newton'"
+
         #f = lambda x : (self.nLLeval(h2=x,**kwargs)['nLL'])
         resmin = [None]
         #logging.info("starting log_delta search")
@@ -406,7 +498,7 @@ class LMM(object):
         res['log_delta'] = ln_external_delta
         return res
 
-    def findH2(self, nGridH2=10, minH2=0.0, maxH2=0.99999, estimate_Bayes=False, **kwargs):
+    def findH2(self, nGridH2=10, minH2=0.0, maxH2=0.99999, estimate_Bayes=False, optimizer="grid", **kwargs):
         '''
         Find the optimal h2 for a given K. Note that this is the single kernel case. So there is no a2.
         (default maxH2 value is set to a value smaller than 1 to avoid loss of positive definiteness of the final model covariance)
@@ -415,26 +507,34 @@ class LMM(object):
             minH2   : minimum value for h2 optimization (default: 0.0)
             maxH2   : maximum value for h2 optimization (default: 0.99999)
             estimate_Bayes: implement me!   (default: False)
+            optimizer: "grid" evaluates a grid and refines it with Brent's method.
+                      "newton" takes Newton steps in log(delta), using the closed-form derivatives of the nLL. If they don't
+                      converge, or either bound has a smaller nLL, it falls back to the grid. The result then also has
+                      'newton_iterations', 'newton_gradient' (the final derivative of the nLL with respect to log(delta))
+                      and 'newton_converged'. (default: "grid")
 
         Returns:
             dictionary containing the model parameters at the optimal h2
         '''
+        if optimizer == "newton" and not kwargs and not estimate_Bayes:
+            min_log_delta = np.log((1.0 - maxH2) / maxH2)
+            max_log_delta = np.log((1.0 - minH2) / minH2) if minH2 > 0.0 else 20.0 #h2 of about 2e-9
+            return self._find_newton(min_log_delta, max_log_delta, lambda: self.findH2(nGridH2=nGridH2, minH2=minH2, maxH2=maxH2))
+        assert optimizer in {"grid", "newton"}, "optimizer must be 'grid' or 'newton'"
+
         #f = lambda x : (self.nLLeval(h2=x,**kwargs)['nLL'])
         resmin = [None for i in range(self.Y.shape[1])]
         #logging.info("starting H2 search")
         assert estimate_Bayes == False, "not implemented"
         if self.Y.shape[1] > 1:
+            #all phenotypes share S and U, so search the h2 of every phenotype at once
+            P = self.Y.shape[1]
             def f(x):
-                res = self.nLLeval(h2=x,**kwargs)
-                #check all results for local minimum:
-                for i in range(self.Y.shape[1]):
-                    if (resmin[i] is None) or (res['nLL'][i] < resmin[i]['nLL']):
-                        resmin[i] = res.copy()
-                        resmin[i]['nLL'] = res['nLL'][i]
-                #logging.info("search\t{0}\t{1}".format(x,res['nLL']))
-                return res['nLL']
-            (evalgrid,resultgrid) = evalgrid1D(f, evalgrid = None, nGrid=nGridH2, minval=minH2, maxval = maxH2, dimF=self.Y.shape[1])
-            #import ipdb;ipdb.set_trace()
+                return self.nLLeval(h2=x,**kwargs)['nLL']
+            h2, nLL = minimize1D_multi(f=f, dimF=P, nGrid=nGridH2, minval=minH2, maxval=maxH2)
+            res = self.nLLeval(h2=h2,**kwargs)
+            for i in range(P):
+                resmin[i] = {key : value[...,i] if isinstance(value,np.ndarray) and value.shape[-1:]==(P,) else value for key,value in res.items()}
             return resmin
         elif estimate_Bayes:
             def f(x):
@@ -449,14 +549,66 @@ class LMM(object):
             return posterior_mean
         else: 
 
+            #without kwargs, nLLeval evaluates the whole grid at once
+            vectorized = not kwargs
             def f(x,resmin=resmin):
                 res = self.nLLeval(h2=x,**kwargs)
+                if np.ndim(x) > 0:
+                    return res['nLL']
                 if (resmin[0] is None) or (res['nLL'] < resmin[0]['nLL']):
                     resmin[0] = res
                 return res['nLL'][0]   
-            min = minimize1D(f=f, nGrid=nGridH2, minval=minH2, maxval=maxH2)
+            min = minimize1D(f=f, nGrid=nGridH2, minval=minH2, maxval=maxH2, vectorized=vectorized)
+            if vectorized and ((resmin[0] is None) or (min[1] < resmin[0]['nLL'][0])):
+                f(min[0]) #the minimum is a grid point
             return resmin[0]
 
+    def _find_newton(self, min_log_delta, max_log_delta, grid_search):
+        '''
+        Find the optimal h2 of each phenotype with Newton steps in log(delta) (see findH2)
+
+        Args:
+            min_log_delta   : minimum value for log delta (h2 = 1/(1+delta))
+            max_log_delta   : maximum value for log delta
+            grid_search     : function that returns the result of the grid search (used if Newton's method fails)
+
+        Returns:
+            result of findH2
+        '''
+        S,U = self.getSU()
+        UY,UUY = self.getUY()
+        S,UY,UUY = pstutil.asnumpy(S),pstutil.asnumpy(UY),None if UUY is None else pstutil.asnumpy(UUY)
+        N = self.Y.shape[0] - self.linreg.D
+        P = UY.shape[1]
+        newton = []
+        for i in range(P):
+            UUY_i = None if UUY is None else UUY[:,i:i+1]
+            f = lambda x, UY_i=UY[:,i:i+1], UUY_i=UUY_i : nLL_log_delta_derivatives(x, S, N, UY_i, UUY_i)
+            newton.append(minimize1D_newton(f, x0=min(max(0.0,min_log_delta),max_log_delta), minval=min_log_delta, maxval=max_log_delta))
+        h2 = np.array([1.0 / (1.0 + np.exp(item[0])) for item in newton])
+        converged = np.array([item[4] for item in newton])
+        res = self.nLLeval(h2=h2 if P > 1 else h2[0])
+        #like the grid search, also check the bounds
+        for log_delta in [min_log_delta, max_log_delta]:
+            h2_bound = 1.0 / (1.0 + np.exp(log_delta))
+            converged &= self.nLLeval(h2=np.full(P, h2_bound) if P > 1 else h2_bound)['nLL'] >= res['nLL']
+
+        if converged.all():
+            if P > 1:
+                resmin = [{key : value[...,i] if isinstance(value,np.ndarray) and value.shape[-1:]==(P,) else value for key,value in res.items()} for i in range(P)]
+            else:
+                resmin = [res]
+        else:
+            logging.info("Newton's method didn't find the minimum for {0} of {1} phenotypes, so using the grid".format((~converged).sum(), P))
+            resmin = grid_search()
+            if P == 1:
+                resmin = [resmin]
+        for i, item in enumerate(resmin):
+            item['newton_iterations'] = newton[i][3]
+            item['newton_gradient'] = newton[i][2]
+            item['newton_converged'] = bool(converged[i])
+        return resmin if P > 1 else resmin[0]
+
     def posterior_h2(self, nGridH2=1000, minH2=0.0, maxH2=0.99999, **kwargs):
         '''
         Find the optimal h2 for a given K. Note that this is the single kernel case. So there is no a2.
@@ -471,24 +623,17 @@ class LMM(object):
             dictionary containing the model parameters at the optimal h2
         '''
         #f = lambda x : (self.nLLeval(h2=x,**kwargs)['nLL'])
-        resmin = [None]
         #logging.info("starting H2 search")
         assert self.Y.shape[1] == 1, "only works for single phenotype"
-        def f(x):
-            res = self.nLLeval(h2=x,**kwargs)
-            #check all results for local minimum:
-            if (resmin[0] is None):
-                    resmin[0] = {'nLL':res['nLL'],'h2':np.zeros_like(res['nLL'])+res['h2']}
-            else:
-                for i in range(self.Y.shape[1]):
-                    if (res['nLL'][i] < resmin[0]['nLL'][i]):
-                        resmin[0]['nLL'][i] = res['nLL'][i]
-                        resmin[0]['h2'][i] = res['h2']
-            #logging.info("search\t{0}\t{1}".format(x,res['nLL']))
-            return res['nLL']
-        (evalgrid,resultgrid) = evalgrid1D(f, evalgrid = None, nGrid=nGridH2, minval=minH2, maxval = maxH2, dimF=self.Y.shape[1])
-        #import ipdb;ipdb.set_trace()
-        return resmin[0], evalgrid, resultgrid
+        if kwargs:
+            f = lambda x : self.nLLeval(h2=x,**kwargs)['nLL']
+        else:
+            #evaluate the whole grid at once
+            f = lambda x : self.nLLeval(h2=x)['nLL'].reshape(-1,1)
+        (evalgrid,resultgrid) = evalgrid1D(f, evalgrid = None, nGrid=nGridH2, minval=minH2, maxval = maxH2, dimF=self.Y.shape[1], vectorized=not kwargs)
+        i_min = resultgrid[:,0].argmin()
+        resmin = {'nLL':resultgrid[i_min].copy(),'h2':np.zeros(1)+evalgrid[i_min]}
+        return resmin, evalgrid, resultgrid
 
     def nLLeval_2K(self, h2=0.0, h2_1=0.0, dof=None, scale=1.0, penalty=0.0, snps=None, UW=None, UUW=None, i_up=None, i_G1=None, subset=False):
         '''
@@ -603,6 +748,7 @@ class LMM(object):
 
         Args:
             h2      : mixture weight between K and Identity (environmental noise)
+                        (with a single phenotype, a 1-D np.array of h2 values gives the nLL at each of them, and only the nLL)
             REML    : boolean
                     if True   : compute REML
                     if False  : compute ML
@@ -638,6 +784,10 @@ class LMM(object):
         k = S.shape[0]
         P = self.Y.shape[1] #number of phenotypes used
 
+        if (P==1 and isinstance(h2,np.ndarray) and h2.size > 1 and logdelta is None and delta is None and snps is None
+                and Usnps is None and UW is None and weightW is None and idx_pheno is None and Sd is None):
+            return self._nLLeval_grid(h2=h2, dof=dof, scale=scale, penalty=penalty)
+
         Sd, denom, h2 = self.get_Sd_etc(Sd, denom, h2, logdelta, delta, scale, weightW)
 
         if np.any(h2 < 0.0) or np.any(h2 >= 1.0):
@@ -660,6 +810,32 @@ class LMM(object):
         #logging.info("Ending nLLeval")
         return result
 
+    def _nLLeval_grid(self, h2, dof, scale, penalty, block_size=1000000):
+        '''
+        evaluate the nLL of the (single) phenotype at many values of h2 at once
+
+        Args:
+            h2          : 1-D np.array of h2 values
+            block_size  : at most about this many values of Sd are held at once (default: 1000000)
+
+        Returns:
+            Output dictionary:
+                'nLL'       : 1-D np.array of the negative log-likelihood at each h2 (3E20 when h2 is out of range)
+                'h2'        : h2
+                'scale'     : Scale parameter that multiplies the Covariance matrix
+        '''
+        S,U = self.getSU()
+        nLL = np.full(h2.shape[0], 3E20)
+        index = np.flatnonzero((h2 >= 0.0) & (h2 < 1.0))
+        step = max(1, block_size // max(1, S.shape[0]))
+        for start in range(0, len(index), step):
+            index_block = index[start:start+step]
+            Sd, denom, h2_block = self.get_Sd_etc(None, None, h2[index_block], None, None, scale, None)
+            nLL[index_block] = self.nLLcore(Sd=Sd, dof=dof, scale=scale, penalty=penalty, denom=denom)['nLL']
+        return {'nLL':nLL,
+                'h2':h2,
+                'scale':scale}
+
     def get_Sd_etc(self, Sd, denom, h2, logdelta, delta, scale, weightW):
         if h2 is not None and Sd is not None and denom is not None:
             return Sd, denom, h2
@@ -726,12 +902,8 @@ class LMM(object):
         UY,UUY = self.getUY(idx_pheno = idx_pheno)
         P = UY.shape[1] #number of phenotypes used
 
-        YKY = np.full(P,np.nan)
-        for pheno_index in range(P):
-            YKY[pheno_index] = self.computeAKA(Sd=Sd[:,pheno_index:pheno_index+1],
-                                                denom=denom[pheno_index],
-                                                UA=UY[:,pheno_index:pheno_index+1],
-                                                UUA=None if UUY is None else UUY[:,pheno_index:pheno_index+1])
+        #All phenotypes at once. Sd and denom have one column per phenotype (or a single column shared by all phenotypes)
+        YKY = self.computeYKY_multi(Sd=Sd, denom=denom, UY=UY, UUY=UUY)
 
 
         logdetK = np.log(Sd).sum(0)
@@ -740,19 +912,10 @@ class LMM(object):
             logdetK+=(N - k) * np.log(denom)
         
         if Usnps is not None:
-            snpsKsnps = np.full((Usnps.shape[1],P),np.nan)
-            snpsKY = np.full((Usnps.shape[1],P),np.nan)
-            for pheno_index in range(P):
-                snpsKsnps[:,pheno_index] = self.computeAKA(Sd[:,pheno_index:pheno_index+1],
-                                                denom=denom[pheno_index],
-                                                UA=Usnps,
-                                                UUA=UUsnps)
-                snpsKY[:,pheno_index:pheno_index+1] = self.computeAKB(Sd[:,pheno_index],
-                                                denom=denom[pheno_index],
-                                                UA=Usnps,
-                                                UB=UY[:,pheno_index:pheno_index+1],
-                                                UUA=UUsnps,
-                                                UUB=None if UUY is None else UUY[:,pheno_index:pheno_index+1])
+            snpsKsnps = self.computeAKA_multi(Sd=Sd, denom=denom, UA=Usnps, UUA=UUsnps) # [S x P] (or [S x 1] if Sd is shared)
+            snpsKY = self.computeAKB_multi(Sd=Sd, denom=denom, UA=Usnps, UB=UY, UUA=UUsnps, UUB=UUY) # [S x P]
+            if snpsKsnps.shape[1] != snpsKY.shape[1]:
+                snpsKsnps = self._xp.repeat(snpsKsnps, snpsKY.shape[1], axis=1)
         
         if weightW is not None:
             absw = np.absolute(weightW)
@@ -870,6 +1033,54 @@ class LMM(object):
             AKB += UUA.T.dot(UUB) / denom
         return AKB
 
+    def computeYKY_multi(self, Sd, denom, UY, UUY=None):
+        """
+        compute the symmetric squared form of each phenotype with its own Sd and denom
+
+        Y[:,p].T.dot( f_p(K) ).dot(Y[:,p]) for every phenotype p
+        """
+        YKY = (UY * UY / Sd).sum(0)
+        if UUY is not None:
+            YKY += (UUY * UUY).sum(0) / denom
+        return YKY
+
+    def computeAKB_multi(self, Sd, denom, UA, UB, UUA=None, UUB=None):
+        """
+        compute asymmetric squared forms for all phenotypes at once
+
+        A.T.dot( f_p(K) ).dot(B[:,p]) for every phenotype p, as an [S x P] array
+        (Sd and denom have one column per phenotype or a single column shared by all)
+        """
+        assert (UUA is None) == (UUB is None), "Expect UUA and UUB to either both be given or both not"
+        AKB = UA.T.dot(UB / Sd)
+        if UUA is not None:
+            AKB += UUA.T.dot(UUB) / denom.reshape(1,-1)
+        return AKB
+
+    def computeAKA_multi(self, Sd, denom, UA, UUA=None):
+        """
+        compute symmetric squared forms for all phenotypes at once
+
+        A.T.dot( f_p(K) ).dot(A) for every phenotype p, as an [S x P] array
+        (Sd and denom have one column per phenotype or a single column shared by all)
+        """
+        #To save memory divide the work into 10 pieces
+        piece_count = 10 if UA.shape[0] > 10 and UA.shape[1] > 1 else 1
+
+        AKA = self._xp.zeros((UA.shape[1], Sd.shape[1]))
+        start0, start1 = 0, 0
+        for piece_index in range(piece_count):
+            end0 = UA.shape[0] * (piece_index+1) // piece_count
+            UA_piece = UA[start0:end0,:]
+            AKA += (UA_piece * UA_piece).T.dot(1.0 / Sd[start0:end0,:])
+            start0 = end0
+            if UUA is not None:
+                end1 = UUA.shape[0] * (piece_index+1) // piece_count
+                UUA_piece = UUA[start1:end1,:]
+                AKA += (UUA_piece * UUA_piece).sum(0).reshape(-1,1) / denom.reshape(1,-1)
+                start1 = end1
+        return AKA
+
     def computeAKA(self, Sd, denom, UA, UUA=None):
         """
         compute symmetric squared form
@@ -896,6 +1107,143 @@ class LMM(object):
 
     
 
+def randomized_svd(A, rank=None, energy=None, power_iterations=2, oversample=10, max_error=0.01, seed=0, xp=np):
+    '''
+    randomized truncated SVD of A (Halko, Martinsson and Tropp, 2011), with an estimate of its error.
+
+    The error is the fraction of the squared Frobenius norm of A that the truncated SVD leaves out,
+    1 - (S*S).sum()/(A*A).sum(). This is exact for the returned U and S, because they come from the
+    projection of A onto its sketched range.
+
+    Args:
+        A               : [N x k] np.array
+        rank            : number of singular values to keep (default: None, which requires energy)
+        energy          : if given, keep the fewest singular values that capture this fraction of (A*A).sum().
+                            Without rank, the sketch starts at 100 columns and doubles until it captures the energy.
+                            (default: None)
+        power_iterations: number of power iterations, which sharpen the sketch when the spectrum decays slowly (default: 2)
+        oversample      : number of sketch columns beyond rank (default: 10)
+        max_error       : largest acceptable error (default: .01)
+        seed            : seed for the random sketch (default: 0)
+
+    Returns:
+        U, S (the singular values, not squared), error
+        or None if the error is larger than max_error or the sketch would not be smaller than A
+    '''
+    assert rank is not None or energy is not None, "Expect rank or energy to be given"
+    N, k = A.shape
+    smallest = min(N, k)
+    total = (A * A).sum()
+    randomstate = np.random.RandomState(seed)
+    sketch = rank + oversample if rank is not None else 100
+    while True:
+        if sketch >= smallest:
+            logging.info("randomized_svd: sketch would not be smaller than A, so using exact SVD")
+            return None
+        Q = xp.linalg.qr(A.dot(xp.asarray(randomstate.standard_normal((k, sketch)))))[0]
+        for i in range(power_iterations):
+            Q = xp.linalg.qr(A.dot(xp.linalg.qr(A.T.dot(Q))[0]))[0]
+        U_B, S, V = xp.linalg.svd(Q.T.dot(A), full_matrices=False)
+        captured = xp.cumsum(S * S) / total
+        if energy is None:
+            count = rank
+        elif float(captured[-1]) >= energy or rank is not None:
+            count = int(xp.searchsorted(captured, energy)) + 1
+            if rank is not None:
+                count = min(count, rank)
+        else:
+            sketch *= 2
+            continue
+        count = min(count, len(S))
+        error = max(0.0, 1.0 - float(captured[count - 1]))
+        if error > max_error:
+            logging.warning("randomized_svd: error {0} is more than max_error {1}, so using exact SVD".format(error, max_error))
+            return None
+        logging.info("randomized_svd: kept {0} of {1} singular values, error={2}".format(count, smallest, error))
+        return Q.dot(U_B[:, :count]), S[:count], error
+
+rotate_block_bytes = 256 * 1024**2 #bytes of U read per tile in rotate_blocked
+
+def rotate_blocked(U, A, lowrank, block_bytes=None):
+    '''
+    rotate A with a (memory-mapped) U that is read in tiles of rows, so that U never needs to fit in memory.
+    Each tile is contiguous on disk (if U is in C order), so U is read sequentially, once for UA and,
+    in the low-rank case, once more for UUA. The tiles are converted to A's dtype, so a float32 A is rotated
+    in float32 without a float32 copy of all of U.
+
+    Args:
+        U           : [N x k] np.array (usually a np.memmap) of eigenvectors
+        A           : [N x D] np.array (already regressed)
+        lowrank     : if True, also compute A - U.dot(UA)
+        block_bytes : number of bytes of U to read per tile (default: rotate_block_bytes)
+
+    Returns:
+        U.T.dot(A)
+        A - U.dot(U.T.dot(A))    (None if not lowrank)
+    '''
+    if block_bytes is None:
+        block_bytes = rotate_block_bytes
+    N, k = U.shape
+    dtype = A.dtype if np.issubdtype(A.dtype, np.floating) else np.result_type(U.dtype, A.dtype)
+    step = max(1, block_bytes // max(1, k * U.dtype.itemsize))
+    UA = np.zeros((k, A.shape[1]), dtype=dtype)
+    for start in range(0, N, step):
+        UA += np.asarray(U[start:start+step], dtype=dtype).T.dot(A[start:start+step])
+    if not lowrank:
+        return UA, None
+    UUA = np.empty(A.shape, dtype=dtype)
+    for start in range(0, N, step):
+        UUA[start:start+step] = A[start:start+step] - np.asarray(U[start:start+step], dtype=dtype).dot(UA)
+    return UA, UUA
+
+def nLL_log_delta_derivatives(log_delta, S, N, UA, UUA=None, D=0, REML=False):
+    '''
+    evaluate the negative log-likelihood (up to a constant) of y in N(y | X*beta, sigma2*(K + delta*I)), with beta and sigma2
+    at their optimum, and its first and second derivatives with respect to log(delta).
+    Everything is found in the rotated space, K = U*diag(S)*U^T, where it is a function of the [D+1 x D+1] matrix
+    A = [X,y]^T (K + delta*I)^-1 [X,y] and the log determinant of K + delta*I. The squared residual is det(A)/det(A[:D,:D]).
+
+    Args:
+        log_delta   : log(delta)
+        S           : [k] np.array of the eigenvalues of K
+        N           : number of individuals (or degrees of freedom)
+        UA          : [k x D+1] np.array, U^T [X,y] (y is the last column)
+        UUA         : [N x D+1] np.array, [X,y] - U U^T [X,y] (None, if full rank)
+        D           : number of covariates in X (default: 0, when the covariates have been regressed out)
+        REML        : if True, compute REML, otherwise ML (default: False)
+
+    Returns:
+        nLL, d nLL / d log(delta), d^2 nLL / d log(delta)^2
+    '''
+    delta = np.exp(log_delta)
+    w = 1.0 / (S + delta)
+    #A and its first and second derivatives with respect to delta, using d^n/d delta^n 1/(S+delta) = c_n/(S+delta)^(n+1)
+    c = [1.0, -1.0, 2.0]
+    A = [(UA * (c[order] * w ** (order + 1))[:, np.newaxis]).T.dot(UA) for order in range(3)]
+    logdetK = [np.log(S + delta).sum(), w.sum(), -(w * w).sum()]
+    if UUA is not None:
+        k_rest = N - S.shape[0]
+        BB = UUA.T.dot(UUA)
+        A = [A[order] + c[order] * BB / delta ** (order + 1) for order in range(3)]
+        logdetK = [logdetK[0] + k_rest * np.log(delta), logdetK[1] + k_rest / delta, logdetK[2] - k_rest / delta ** 2]
+
+    def logdet_derivatives(A0, A1, A2):
+        if A0.shape[0] == 0:
+            return np.zeros(3)
+        A0inv = np.linalg.inv(A0)
+        A0inv_A1 = A0inv.dot(A1)
+        return np.array([np.linalg.slogdet(A0)[1], np.trace(A0inv_A1),
+                         np.trace(A0inv.dot(A2)) - np.trace(A0inv_A1.dot(A0inv_A1))])
+
+    logdet_A = logdet_derivatives(*A)
+    logdet_XKX = logdet_derivatives(*[A_i[:D, :D] for A_i in A])
+    if REML:
+        nLL = 0.5 * (np.array(logdetK) + logdet_XKX + (N - D) * (logdet_A - logdet_XKX))
+    else:
+        nLL = 0.5 * (np.array(logdetK) + N * (logdet_A - logdet_XKX))
+    return nLL[0], delta * nLL[1], delta * delta * nLL[2] + delta * nLL[1]
+
+
 class Linreg(object):
     """ linear regression class"""
     __slots__ = ["X", "Xdagger", "beta", "N", "D", "_xp"]
@@ -0,0 +1,312 @@
+import numpy as np
+import scipy.stats as st
+import logging
+from scipy.linalg import eigh_tridiagonal
+from pysnptools.snpreader import SnpReader
+from pysnptools.standardizer import Unit
+from fastlmm.inference.lmm_cov import Linreg
+from fastlmm.util.mingrid import minimize1D
+
+
+class LMM(object):
+    '''
+    linear mixed model N(y | covariates*alpha; sigma2(h2*K + (1-h2)*I)), where K = c*G*G^T and c makes the diagonal of K sum to N.
+
+    Unlike lmm_cov, K is never formed or decomposed. Everything is built from products G.dot(G.T.dot(V)), streaming the
+    SNPs of G in blocks (from disk, if G is a SnpReader), so memory is O(N*(block_size + probe_count + precondition_rank)).
+        * (h2*K + (1-h2)*I)^-1 y is found with conjugate gradients, preconditioned by the top eigenpairs of K
+          (found with a randomized range finder).
+        * log det(h2*K + (1-h2)*I) is estimated with stochastic Lanczos quadrature, using the Lanczos coefficients
+          of the same conjugate-gradient runs (Hutchinson probes). The probes are fixed, so the nLL is smooth in h2.
+        * SNPs get a score test: g'V^-1 y is exact, and g'V^-1 g is gamma*g'g, with gamma calibrated on SNPs
+          solved exactly (as in GRAMMAR-Gamma and BOLT-LMM).
+
+    As in lmm_cov, the covariates are regressed out first, so the likelihood is over N-D dimensions and matches lmm_cov's nLL
+    up to the error of the log determinant estimate.
+
+    This class is experimental. single_snp does not use it; call findH2 and score_test directly.
+    '''
+
+    def __init__(self, G, X=None, Y=None, standardizer=Unit(), block_size=1000, precondition_rank=50, probe_count=30,
+                 tol=1e-6, maxiter=1000, seed=0):
+        '''
+        Args:
+            G               : [N x k] np.array of (standardized) design vectors for the kernel, or a SnpReader that is read
+                                and standardized block by block on each pass
+            X               : [N x D] np.array of D covariates for N individuals (including bias term).
+                                If None is given, only a bias term is used. (Default: None)
+            Y               : [N x 1] np.array holding one phenotype for N individuals
+            standardizer    : standardizer applied to each block of G, if G is a SnpReader (default: Unit())
+            block_size      : number of SNPs of G read at a time (default: 1000)
+            precondition_rank: number of eigenpairs of K in the preconditioner, 0 for none (default: 50)
+            probe_count     : number of random probes for the log determinant (default: 30)
+            tol             : relative residual at which conjugate gradients stop (default: 1e-6)
+            maxiter         : maximum number of conjugate gradient iterations (default: 1000)
+            seed            : seed for the probes, the preconditioner and the calibration SNPs (default: 0)
+        '''
+        self.G = G
+        self.standardizer = standardizer
+        self.block_size = block_size
+        self.tol = tol
+        self.maxiter = maxiter
+        self.linreg = Linreg(X=X)
+        Y = np.asarray(Y, dtype=np.float64).reshape(Y.shape[0], -1)
+        assert Y.shape[1] == 1, "Expect a single phenotype"
+        self.Y = Y
+        self.RxY = self.linreg.regress(Y)
+        self.N = Y.shape[0] - self.linreg.D
+        self.passes = 0
+        self._null = None
+
+        randomstate = np.random.RandomState(seed)
+        self.scale = Y.shape[0] / sum((block * block).sum() for block in self._blocks(G))
+        self._precondition(precondition_rank, randomstate)
+        self.probes = self.linreg.regress(randomstate.choice([-1.0, 1.0], size=(Y.shape[0], probe_count)))
+        self._randomstate = randomstate
+
+    def _blocks(self, G):
+        '''
+        yield G in blocks of SNPs
+        '''
+        if isinstance(G, SnpReader):
+            for start in range(0, G.sid_count, self.block_size):
+                yield G[:, start:start + self.block_size].read(order='F', dtype=np.float64).standardize(self.standardizer).val
+        else:
+            for start in range(0, G.shape[1], self.block_size):
+                yield G[:, start:start + self.block_size]
+
+    def Kdot(self, V):
+        '''
+        compute P.dot(K).dot(V) with one pass over G, where P regresses out the covariates.
+
+        Args:
+            V   : [N x m] np.array with the covariates regressed out
+        Returns:
+            [N x m] np.array
+        '''
+        KV = np.zeros_like(V)
+        for block in self._blocks(self.G):
+            KV += block.dot(block.T.dot(V))
+        self.passes += 1
+        return self.linreg.regress(KV * self.scale)
+
+    def _precondition(self, rank, randomstate):
+        '''
+        find the top eigenpairs of P.dot(K).dot(P) with a randomized range finder (one power iteration, three passes over G)
+        '''
+        N = self.Y.shape[0]
+        rank = min(rank, self.N)
+        if rank == 0:
+            self.precondition_U = np.zeros((N, 0))
+            self.precondition_S = np.zeros(0)
+            return
+        oversample = min(rank + 10, self.N)
+        Q = np.linalg.qr(self.Kdot(self.linreg.regress(randomstate.standard_normal((N, oversample)))))[0]
+        Q = np.linalg.qr(self.Kdot(Q))[0]
+        QKQ = Q.T.dot(self.Kdot(Q))
+        S, V = np.linalg.eigh(0.5 * (QKQ + QKQ.T))
+        order = np.argsort(S)[::-1][:rank]
+        self.precondition_S = np.maximum(S[order], 0.0)
+        self.precondition_U = Q.dot(V[:, order])
+
+    def _Mpow(self, h2, V, power):
+        '''
+        compute M^power.dot(V) for the preconditioner M = h2*Uk.dot(diag(Sk)).dot(Uk.T) + (1-h2)*I
+        '''
+        ratio = (h2 * self.precondition_S + (1.0 - h2)) / (1.0 - h2)
+        UV = self.precondition_U.T.dot(V)
+        return (V + self.precondition_U.dot(UV * (ratio ** power - 1.0)[:, None])) * (1.0 - h2) ** power
+
+    def _Bdot(self, h2, V):
+        '''
+        compute the preconditioned M^-1/2 (h2*K + (1-h2)*I) M^-1/2 V
+        '''
+        MV = self._Mpow(h2, V, -0.5)
+        return self._Mpow(h2, h2 * self.Kdot(MV) + (1.0 - h2) * MV, -0.5)
+
+    def _cg(self, h2, R):
+        '''
+        solve B.dot(W) = R, one conjugate gradient run per column of R, all sharing each pass over G.
+
+        Returns:
+            W       : [N x m] np.array
+            alpha   : [maxiter x m] np.array of the step sizes (nan after a column converges)
+            beta    : [maxiter x m] np.array of the direction updates (nan after a column converges)
+            count   : [m] np.array of the number of iterations of each column
+        '''
+        m = R.shape[1]
+        W = np.zeros_like(R)
+        residual = R.copy()
+        direction = R.copy()
+        rr = (residual * residual).sum(0)
+        threshold = rr * self.tol * self.tol
+        alpha = np.full((self.maxiter, m), np.nan)
+        beta = np.full((self.maxiter, m), np.nan)
+        count = np.zeros(m, dtype=int)
+        active = np.flatnonzero(rr > 0)
+        for iteration in range(self.maxiter):
+            if len(active) == 0:
+                break
+            Bd = self._Bdot(h2, direction[:, active])
+            a = rr[active] / (direction[:, active] * Bd).sum(0)
+            W[:, active] += direction[:, active] * a
+            residual[:, active] -= Bd * a
+            rr_new = (residual[:, active] * residual[:, active]).sum(0)
+            b = rr_new / rr[active]
+            alpha[iteration, active] = a
+            beta[iteration, active] = b
+            count[active] += 1
+            rr[active] = rr_new
+            direction[:, active] = residual[:, active] + direction[:, active] * b
+            active = active[rr_new > threshold[active]]
+        if len(active) > 0:
+            logging.warning("lmm_pcg: conjugate gradients didn't converge in {0} iterations for {1} of {2} columns".format(self.maxiter, len(active), m))
+        return W, alpha, beta, count
+
+    def solve(self, h2, V):
+        '''
+        compute (h2*K + (1-h2)*I)^-1 V
+
+        Args:
+            h2  : mixture weight between K and Identity (environmental noise)
+            V   : [N x m] np.array with the covariates regressed out
+        Returns:
+            [N x m] np.array
+        '''
+        W = self._cg(h2, self._Mpow(h2, V, -0.5))[0]
+        return self._Mpow(h2, W, -0.5)
+
+    def nLLeval(self, h2=0.0):
+        '''
+        evaluate the negative log likelihood (over the N-D dimensions left after regressing out the covariates) at h2
+
+        Args:
+            h2      : mixture weight between K and Identity (environmental noise)
+
+        Returns:
+            Output dictionary:
+                'nLL'       : negative log-likelihood (the log determinant is a stochastic estimate)
+                'sigma2'    : the model variance sigma^2
+                'h2'        : h2
+                'logdetK'   : estimate of log det(h2*K + (1-h2)*I) over the N-D dimensions
+                'iterations': the largest number of conjugate gradient iterations
+        '''
+        if (h2 < 0.0) or (h2 >= 1.0):
+            return {'nLL': 3E20,
+                    'h2': h2}
+        #the probes start the Lanczos runs on B itself, so they are not multiplied by M^-1/2
+        R = np.c_[self._Mpow(h2, self.RxY, -0.5), self.probes]
+        W, alpha, beta, count = self._cg(h2, R)
+        YKY = (R[:, 0] * W[:, 0]).sum()
+
+        #stochastic Lanczos quadrature: the conjugate gradient coefficients give each probe's Lanczos tridiagonal matrix
+        quadrature = np.zeros(self.probes.shape[1])
+        for j in range(self.probes.shape[1]):
+            n = count[j + 1]
+            if n == 0:
+                continue
+            a = alpha[:n, j + 1]
+            b = beta[:n, j + 1]
+            diagonal = 1.0 / a
+            diagonal[1:] += b[:-1] / a[:-1]
+            offdiagonal = np.sqrt(b[:-1]) / a[:-1]
+            theta, V = eigh_tridiagonal(diagonal, offdiagonal)
+            quadrature[j] = (R[:, j + 1] * R[:, j + 1]).sum() * (V[0] * V[0] * np.log(theta)).sum()
+        logdetM = np.log(h2 * self.precondition_S + (1.0 - h2)).sum() + (self.N - len(self.precondition_S)) * np.log(1.0 - h2)
+        logdetK = logdetM + quadrature.mean()
+
+        sigma2 = YKY / self.N
+        nLL = 0.5 * (logdetK + self.N * (np.log(2.0 * np.pi * sigma2) + 1))
+        return {'nLL': nLL,
+                'sigma2': sigma2,
+                'h2': h2,
+                'logdetK': logdetK,
+                'iterations': count.max()}
+
+    def findH2(self, nGridH2=10, minH2=0.0, maxH2=0.99999):
+        '''
+        Find the optimal h2 (see lmm_cov.LMM.findH2)
+
+        Args:
+            nGridH2 : number of h2-grid points to evaluate the negative log-likelihood at (default: 10)
+            minH2   : minimum value for h2 optimization (default: 0.0)
+            maxH2   : maximum value for h2 optimization (default: 0.99999)
+
+        Returns:
+            dictionary containing the model parameters at the optimal h2
+        '''
+        resmin = [None]
+        def f(x, resmin=resmin):
+            res = self.nLLeval(h2=x)
+            if (resmin[0] is None) or (res['nLL'] < resmin[0]['nLL']):
+                resmin[0] = res
+            return res['nLL']
+        minimize1D(f=f, nGrid=nGridH2, minval=minH2, maxval=maxH2)
+        return resmin[0]
+
+    def _null_model(self, h2, calibration_snps):
+        '''
+        find V^-1 y once per h2, and calibrate gamma, the ratio of g'V^-1 g to g'g, once per h2 and calibration_snps.
+        If calibration_snps is None, the last calibration for this h2 is used.
+        '''
+        if self._null is None or self._null['h2'] != h2:
+            w = self.solve(h2, self.RxY)[:, 0]
+            self._null = {'h2': h2,
+                          'w': w,
+                          'YKY': (self.RxY[:, 0] * w).sum(),
+                          'calibration_snps': None}
+        if calibration_snps is None:
+            assert self._null['calibration_snps'] is not None, "Expect calibration_snps the first time an h2 is used"
+            return self._null
+        if self._null['calibration_snps'] is not None and np.array_equal(self._null['calibration_snps'], calibration_snps):
+            return self._null
+        calibration_res = self.linreg.regress(calibration_snps)
+        gKg = (calibration_res * self.solve(h2, calibration_res)).sum(0)
+        gg = (calibration_res * calibration_res).sum(0)
+        ratio = gKg[gg > 0] / gg[gg > 0]
+        assert len(ratio) > 0, "Expect at least one non-constant calibration snp"
+        self._null['calibration_snps'] = np.array(calibration_snps)
+        self._null['gamma'] = ratio.mean()
+        self._null['gamma_std'] = ratio.std()
+        logging.info("lmm_pcg: gamma={0} (std {1}, from {2} snps)".format(self._null['gamma'], self._null['gamma_std'], len(ratio)))
+        return self._null
+
+    def score_test(self, h2, snps, calibration_snps=None, calibration_count=30):
+        '''
+        test SNPs with the calibrated score test
+
+        Args:
+            h2              : h2 of the null model (for example, findH2()['h2'])
+            snps            : [N x S] np.array of standardized SNPs
+            calibration_snps: [N x C] np.array of standardized SNPs whose g'V^-1 g is found exactly to calibrate gamma.
+                                Calibration happens once per h2 and calibration_snps. If None, the last calibration for
+                                this h2 is reused or, if there is none, calibration_count SNPs are sampled from snps.
+                                (default: None)
+            calibration_count: number of SNPs to sample from snps when calibration_snps is None (default: 30)
+
+        Returns:
+            Output dictionary:
+                'beta'          : [S] np.array of SNP effects
+                'variance_beta' : [S] np.array of the variances of beta
+                'pvalue'        : [S] np.array of p-values
+                'gamma'         : the calibrated ratio of g'V^-1 g to g'g
+        '''
+        if calibration_snps is None and (self._null is None or self._null['h2'] != h2
+                                         or self._null['calibration_snps'] is None):
+            index = self._randomstate.choice(snps.shape[1], size=min(calibration_count, snps.shape[1]), replace=False)
+            calibration_snps = snps[:, np.sort(index)]
+        null = self._null_model(h2, calibration_snps)
+
+        snps_res = self.linreg.regress(snps)
+        snpsKY = snps_res.T.dot(null['w'])
+        snpsKsnps = null['gamma'] * (snps_res * snps_res).sum(0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = snpsKY / snpsKsnps
+            beta[snpsKsnps == 0] = 0.0
+            variance_beta = (null['YKY'] - snpsKY * beta) / (self.N - 1.0) / snpsKsnps
+            chi2stats = beta * beta / variance_beta
+        pvalue = st.f.sf(chi2stats, 1, self.Y.shape[0] - (self.linreg.D + 1))
+        return {'beta': beta,
+                'variance_beta': variance_beta,
+                'pvalue': pvalue,
+                'gamma': null['gamma']}
@@ -832,6 +832,293 @@ class TestBin2Kernel(unittest.TestCase):
             self.assertAlmostEqual(ps[i], p[i])
 
 
+class TestLmmCov(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        from numpy.random import RandomState
+
+        randomstate = RandomState(621360)
+        self._N = 60
+        self._P = 4
+        self._X = NP.c_[NP.ones(self._N), randomstate.randn(self._N)]
+        self._Y = randomstate.randn(self._N, self._P)
+        self._G_full = randomstate.randn(self._N, 100)
+        self._G_low = randomstate.randn(self._N, 20)
+        self._snps = randomstate.randn(self._N, 30)
+
+    def test_nLLeval_multipheno(self):
+        from fastlmm.inference.lmm_cov import LMM
+
+        h2 = NP.array([0.1, 0.3, 0.5, 0.7])
+        for G in [self._G_full, self._G_low]:
+            lmm = LMM(X=self._X, Y=self._Y, G=G)
+            for h2_i in [h2, 0.4]:
+                res = lmm.nLLeval(h2=h2_i, snps=self._snps)
+                for pheno_index in range(self._P):
+                    h2_p = h2_i[pheno_index] if isinstance(h2_i, NP.ndarray) else h2_i
+                    res_p = lmm.nLLeval(
+                        h2=h2_p, snps=self._snps, idx_pheno=[pheno_index]
+                    )
+                    for key in ["nLL", "beta", "variance_beta"]:
+                        NP.testing.assert_allclose(
+                            res[key][..., pheno_index],
+                            res_p[key][..., 0],
+                            rtol=1e-10,
+                        )
+
+    def test_findH2_multipheno(self):
+        from fastlmm.inference.lmm_cov import LMM
+
+        lmm = LMM(X=self._X, Y=self._Y, G=self._G_low)
+        result = lmm.findH2()
+        assert len(result) == self._P
+        for pheno_index in range(self._P):
+            lmm_p = LMM(
+                X=self._X, Y=self._Y[:, pheno_index : pheno_index + 1], G=self._G_low
+            )
+            result_p = lmm_p.findH2()
+            self.assertAlmostEqual(result[pheno_index]["h2"], result_p["h2"][0], places=5)
+            assert result[pheno_index]["nLL"] <= result_p["nLL"][0] + 1e-8
+
+    def test_minimize1D_multi_local_minima(self):
+        from fastlmm.util.mingrid import minimize1D, minimize1D_multi
+
+        # Two local minima. On the grid, the one near .3 looks smaller, but (except for the last function)
+        # the narrow one at .68 is the global minimum.
+        depth = NP.array([1.3, 1.5, 0.9])
+
+        def f(x):
+            return -depth * NP.exp(-((x - 0.68) / 0.03) ** 2) - NP.exp(
+                -((x - 0.3) / 0.2) ** 2
+            )
+
+        xopt, fopt = minimize1D_multi(f, dimF=len(depth))
+        for index in range(len(depth)):
+            x1, f1 = minimize1D(lambda x: f(NP.full(len(depth), x))[index])
+            self.assertAlmostEqual(xopt[index], x1, places=4)
+            self.assertAlmostEqual(fopt[index], f1, places=8)
+
+    def test_setSUY_fromK_tridiagonal(self):
+        from fastlmm.inference.lmm_cov import LMM
+
+        K = self._G_full.dot(self._G_full.T) / self._G_full.shape[1]
+        lmm = LMM(X=self._X, Y=self._Y, K=K)
+        lmm_tri = LMM(X=self._X, Y=self._Y, K=K)
+        lmm_tri.setSUY_fromK_tridiagonal()
+        NP.testing.assert_allclose(lmm_tri.S, lmm.getSU()[0], rtol=1e-10, atol=1e-10)
+        result, result_tri = lmm.findH2(), lmm_tri.findH2()
+        for pheno_index in range(self._P):
+            for key in ["h2", "nLL"]:
+                NP.testing.assert_allclose(
+                    result_tri[pheno_index][key], result[pheno_index][key], rtol=1e-8
+                )
+
+
+    def test_nLLeval_grid(self):
+        from fastlmm.inference.lmm_cov import LMM
+
+        for G in [self._G_full, self._G_low]:
+            lmm = LMM(X=self._X, Y=self._Y[:, :1], G=G)
+            h2_grid = NP.array([-0.1, 0.0, 0.25, 0.5, 0.75, 0.99, 1.0])
+            res = lmm._nLLeval_grid(h2_grid, dof=None, scale=1.0, penalty=0.0, block_size=1)
+            NP.testing.assert_allclose(res["nLL"], lmm.nLLeval(h2=h2_grid)["nLL"])
+            for h2, nLL in zip(h2_grid, res["nLL"]):
+                NP.testing.assert_allclose(
+                    nLL, NP.ravel(lmm.nLLeval(h2=h2)["nLL"])[0], rtol=1e-10
+                )
+
+            result, evalgrid, resultgrid = lmm.posterior_h2(nGridH2=100)
+            for h2, nLL in zip(evalgrid, resultgrid[:, 0]):
+                NP.testing.assert_allclose(nLL, lmm.nLLeval(h2=h2)["nLL"][0], rtol=1e-10)
+            assert result["nLL"][0] == resultgrid.min()
+
+    def test_rotate_memmap(self):
+        import tempfile
+        from fastlmm.inference.lmm_cov import LMM, rotate_blocked
+
+        for G in [self._G_full, self._G_low]:
+            lmm = LMM(X=self._X, Y=self._Y, G=G)
+            UA, UUA = lmm.rotate(self._snps)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                U_file = os.path.join(temp_dir, "U.npy")
+                NP.save(U_file, lmm.U)
+                lmm.U = NP.load(U_file, mmap_mode="r")
+                UA2, UUA2 = lmm.rotate(self._snps)
+                NP.testing.assert_allclose(UA2, UA, rtol=1e-10, atol=1e-10)
+                assert (UUA is None) == (UUA2 is None)
+                if UUA is not None:
+                    NP.testing.assert_allclose(UUA2, UUA, rtol=1e-10, atol=1e-10)
+                # tiles of 7 rows
+                UA3, UUA3 = rotate_blocked(
+                    lmm.U, self._snps, lowrank=True, block_bytes=7 * lmm.U.shape[1] * 8
+                )
+                NP.testing.assert_allclose(UA3, lmm.U.T.dot(self._snps), rtol=1e-10, atol=1e-10)
+                NP.testing.assert_allclose(
+                    UUA3, self._snps - lmm.U.dot(UA3), rtol=1e-10, atol=1e-10
+                )
+                del lmm, UA2, UUA2, UA3, UUA3
+
+    def test_astype_memmap(self):
+        import tempfile
+        from fastlmm.inference.lmm_cov import LMM
+
+        for G in [self._G_full, self._G_low]:
+            lmm = LMM(X=self._X, Y=self._Y, G=G)
+            UA, UUA = lmm.rotate(self._snps)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                U_file = os.path.join(temp_dir, "U.npy")
+                NP.save(U_file, lmm.U)
+                lmm.U = NP.load(U_file, mmap_mode="r")
+                lmm32 = lmm.astype(NP.float32)
+                assert lmm32.U is lmm.U  # not read into memory
+                UA32, UUA32 = lmm32.rotate(self._snps.astype(NP.float32))
+                assert UA32.dtype == NP.float32
+                NP.testing.assert_allclose(UA32, UA, rtol=1e-3, atol=1e-3)
+                assert (UUA is None) == (UUA32 is None)
+                if UUA is not None:
+                    assert UUA32.dtype == NP.float32
+                    NP.testing.assert_allclose(UUA32, UUA, rtol=1e-3, atol=1e-3)
+                del lmm, lmm32
+
+    def test_randomized_svd(self):
+        from fastlmm.inference.lmm_cov import LMM, randomized_svd
+        from fastlmm.inference.lmm import LMM as LMM_kernel
+
+        G = self._G_full[:, :5].dot(self._G_full[:5, 5:45]) + 1e-3 * self._G_full[:, 45:85]
+        U, S, error = randomized_svd(G, rank=8)
+        assert U.shape == (self._N, 8) and error < 1e-5
+        NP.testing.assert_allclose(S, NP.linalg.svd(G, compute_uv=False)[:8], rtol=1e-2)
+        assert randomized_svd(G, rank=3) is None  # the error is too large
+
+        Y = self._Y[:, :1] + G[:, :1]
+        exact = LMM(X=self._X, Y=Y, G=G).findH2()
+        for options in [{"rank": 8}, {"energy": 0.999}, {"rank": 3}]:
+            res = LMM(X=self._X, Y=Y, G=G, randomized_svd=options).findH2()
+            NP.testing.assert_allclose(res["h2"], exact["h2"], rtol=1e-4)
+            NP.testing.assert_allclose(res["nLL"], exact["nLL"], rtol=1e-6)
+
+            lmm = LMM_kernel()
+            lmm.setG(G, randomized_svd=options)
+            lmm.setX(self._X)
+            lmm.sety(Y[:, 0])
+            lmm_exact = LMM_kernel()
+            lmm_exact.setG(G)
+            lmm_exact.setX(self._X)
+            lmm_exact.sety(Y[:, 0])
+            NP.testing.assert_allclose(
+                lmm.nLLeval(h2=0.5)["nLL"], lmm_exact.nLLeval(h2=0.5)["nLL"], rtol=1e-6
+            )
+
+    def test_findH2_newton(self):
+        from fastlmm.inference.lmm_cov import LMM
+        from fastlmm.inference.lmm import LMM as LMM_kernel
+
+        for G in [self._G_full, self._G_low]:
+            Y = self._Y + G.dot(self._G_full.T[: G.shape[1], : self._P]) / NP.sqrt(G.shape[1])
+            lmm = LMM(X=self._X, Y=Y[:, 1:], G=G / NP.sqrt(G.shape[1]))
+            for grid, newton in zip(lmm.findH2(), lmm.findH2(optimizer="newton")):
+                assert newton["newton_converged"]
+                assert abs(newton["newton_gradient"]) < 1e-6
+                NP.testing.assert_allclose(newton["h2"], grid["h2"], atol=1e-4)
+                assert newton["nLL"] <= grid["nLL"] + 1e-8
+
+            # the minimum is at the bound, so Newton falls back to the grid
+            lmm = LMM(X=self._X, Y=Y[:, 1:2], G=G / NP.sqrt(G.shape[1]))
+            grid, newton = lmm.findH2(maxH2=0.01), lmm.findH2(maxH2=0.01, optimizer="newton")
+            assert not newton["newton_converged"]
+            NP.testing.assert_allclose(newton["h2"], grid["h2"])
+
+            lmm = LMM_kernel()
+            lmm.setG(G / NP.sqrt(G.shape[1]))
+            lmm.setX(self._X)
+            lmm.sety(Y[:, 1])
+            for REML in [True, False]:
+                grid = lmm.findH2(REML=REML)
+                newton = lmm.findH2(REML=REML, optimizer="newton")
+                assert newton["newton_converged"]
+                NP.testing.assert_allclose(newton["h2"], grid["h2"], atol=1e-4)
+                assert newton["nLL"] <= grid["nLL"] + 1e-8
+            NP.testing.assert_allclose(
+                lmm.find_log_delta(G.shape[1], optimizer="newton")["log_delta"],
+                lmm.find_log_delta(G.shape[1])["log_delta"],
+                atol=1e-3,
+            )
+
+
+class TestLmmPcg(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        from numpy.random import RandomState
+
+        randomstate = RandomState(621360)
+        self._N = 300
+        self._G = randomstate.randn(self._N, 600)
+        self._G = (self._G - self._G.mean(0)) / self._G.std(0)
+        self._X = NP.c_[NP.ones(self._N), randomstate.randn(self._N)]
+        self._Y = (
+            self._G[:, :50].dot(randomstate.randn(50)) * 0.15 + randomstate.randn(self._N)
+        ).reshape(-1, 1)
+        self._snps = randomstate.randn(self._N, 50)
+
+    def test_nLLeval(self):
+        from fastlmm.inference.lmm_pcg import LMM as lmm_pcg
+        from fastlmm.inference.lmm_cov import LMM as lmm_cov
+
+        lmm = lmm_pcg(self._G, X=self._X, Y=self._Y, block_size=128, probe_count=100)
+        reference = lmm_cov(X=self._X, Y=self._Y, G=self._G * NP.sqrt(lmm.scale))
+        for h2 in [0.0, 0.3, 0.7]:
+            res = lmm.nLLeval(h2=h2)
+            res_ref = reference.nLLeval(h2=h2)
+            NP.testing.assert_allclose(res["nLL"], res_ref["nLL"][0], rtol=5e-3)
+            if h2 > 0.0:
+                solution = lmm.solve(h2, lmm.RxY)
+                NP.testing.assert_allclose(
+                    h2 * lmm.Kdot(solution) + (1.0 - h2) * solution, lmm.RxY, atol=1e-5
+                )
+
+        h2 = reference.findH2()["h2"]
+        assert abs(lmm.findH2()["h2"] - h2) < 0.05
+
+        # the score test, calibrated on all snps, is exact for snps like the calibration snps
+        res = lmm.score_test(h2, self._snps, calibration_count=self._snps.shape[1])
+        res_ref = reference.nLLeval(h2=h2, snps=self._snps)
+        NP.testing.assert_allclose(res["beta"], res_ref["beta"][:, 0], rtol=0.1, atol=1e-3)
+        pvalue_ref = SP.stats.f.sf(
+            (res_ref["beta"] ** 2 / res_ref["variance_beta"])[:, 0], 1, self._N - 3
+        )
+        NP.testing.assert_allclose(NP.log10(res["pvalue"]), NP.log10(pvalue_ref), atol=0.1)
+
+    def test_recalibrate(self):
+        from fastlmm.inference.lmm_pcg import LMM as lmm_pcg
+
+        lmm = lmm_pcg(self._G, X=self._X, Y=self._Y, block_size=128)
+        gamma_list = []
+        for calibration_snps in [self._snps[:, :5], self._snps[:, 5:10], self._snps[:, :5]]:
+            res = lmm.score_test(0.5, self._snps, calibration_snps=calibration_snps)
+            fresh = lmm_pcg(self._G, X=self._X, Y=self._Y, block_size=128)
+            res_fresh = fresh.score_test(0.5, self._snps, calibration_snps=calibration_snps)
+            assert res["gamma"] == res_fresh["gamma"]
+            gamma_list.append(res["gamma"])
+        assert gamma_list[0] != gamma_list[1] and gamma_list[0] == gamma_list[2]
+        # with no calibration_snps, the last calibration for this h2 is reused
+        assert lmm.score_test(0.5, self._snps)["gamma"] == gamma_list[2]
+
+    def test_snpreader(self):
+        from pysnptools.snpreader import SnpData
+        from fastlmm.inference.lmm_pcg import LMM as lmm_pcg
+
+        snpdata = SnpData(
+            iid=[["fam", str(i)] for i in range(self._N)],
+            sid=[str(i) for i in range(self._G.shape[1])],
+            val=self._G,
+        )
+        lmm = lmm_pcg(self._G, X=self._X, Y=self._Y, block_size=128)
+        lmm_reader = lmm_pcg(snpdata, X=self._X, Y=self._Y, block_size=128)
+        NP.testing.assert_allclose(
+            lmm_reader.nLLeval(h2=0.5)["nLL"], lmm.nLLeval(h2=0.5)["nLL"], rtol=1e-8
+        )
+
+
 def getTestSuite():
     """
     set up composite test suite
@@ -840,8 +1127,10 @@ def getTestSuite():
     suite1 = unittest.TestLoader().loadTestsFromTestCase(TestBin2Kernel)
     suite2 = unittest.TestLoader().loadTestsFromTestCase(TestProximalContamination)
     suite3 = unittest.TestLoader().loadTestsFromTestCase(TestLmmKernel)
+    suite4 = unittest.TestLoader().loadTestsFromTestCase(TestLmmCov)
+    suite5 = unittest.TestLoader().loadTestsFromTestCase(TestLmmPcg)
 
-    return unittest.TestSuite([suite1, suite2, suite3])
+    return unittest.TestSuite([suite1, suite2, suite3, suite4, suite5])
 
 
 if __name__ == "__main__":
@@ -23,6 +23,10 @@ def mmultfile_ata(memmap_lambda,writer,sid,work_count,name,runner,force_python_o
         memmap = memmap_lambda()
         piece_index0 = work_index
         piece_index1 = piece_count-work_index-1
+        if not isinstance(memmap, SnpMemMap): #Other readers, for example single_snp_scale's compact G0, find their own pieces
+            gtg_piece0 = memmap.ata_piece(piece_index0,piece_count,log_frequency=log_frequency)
+            gtg_piece1 = memmap.ata_piece(piece_index1,piece_count,log_frequency=log_frequency)
+            return [[piece_index0, gtg_piece0],[piece_index1, gtg_piece1]]
         gtg_piece0 = mmultfile_ata_piece(memmap.filename,memmap.offset,piece_index0,piece_count,log_frequency=log_frequency,force_python_only=force_python_only)
         gtg_piece1 = mmultfile_ata_piece(memmap.filename,memmap.offset,piece_index1,piece_count,log_frequency=log_frequency,force_python_only=force_python_only)
         return [[piece_index0, gtg_piece0],[piece_index1, gtg_piece1]]
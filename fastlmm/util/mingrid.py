@@ -1,11 +1,12 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import numpy as np
 import scipy as SP
 import scipy.optimize as opt
 from six.moves import range
 
 
-def minimize1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, verbose=False, brent=True,check_boundaries = True, resultgrid=None, return_grid=False):
+def minimize1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, verbose=False, brent=True,check_boundaries = True, resultgrid=None, return_grid=False, vectorized=False):
     '''
     minimize a function f(x) in the grid between minval and maxval.
     The function will be evaluated on a grid and then all triplets,
@@ -20,6 +21,8 @@ def minimize1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, verbo
     maxval  : maximum x-value for optimization of f(x)
     brent   : boolean indicator whether to do Brent search or not.
               (default: True)
+    vectorized: if True, f(x) also accepts a 1-D array of x-values and returns the array of their
+              function values. The grid is then evaluated with a single call. (default: False)
     --------------------------------------------------------------------------
     Output list:
     [xopt, f(xopt)]
@@ -33,7 +36,7 @@ def minimize1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, verbo
         i_sort = evalgrid.argsort()
         evalgrid = evalgrid[i_sort]
     if resultgrid is None:
-        [evalgrid,resultgrid] = evalgrid1D(f, evalgrid = evalgrid, nGrid=nGrid, minval=minval, maxval = maxval  )
+        [evalgrid,resultgrid] = evalgrid1D(f, evalgrid = evalgrid, nGrid=nGrid, minval=minval, maxval = maxval, vectorized=vectorized)
     
     i_currentmin=resultgrid.argmin()
     minglobal = (evalgrid[i_currentmin],resultgrid[i_currentmin])
@@ -68,7 +71,84 @@ def minimize1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, verbo
         return minglobal
 
 
-def evalgrid1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, dimF=0):
+def minimize1D_multi(f, dimF, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, xtol=1e-7, maxiter=100, return_grid=False):
+    '''
+    minimize dimF independent functions f_i(x) at once, where f(x) takes a 1-D array x of
+    dimF values and returns the 1-D array of the dimF function values.
+    All functions are evaluated on a common grid (a [nGrid x dimF] array of values).
+    Then, as in minimize1D, every grid point that is a local minimum of a function (including
+    a boundary point smaller than its neighbor) is refined with a golden section search bracketed
+    by its neighboring grid points, and the best value found is kept. Every step of the search
+    calls f once for all functions.
+    --------------------------------------------------------------------------
+    Input:
+    f(x)    : callable target function, vectorized over the dimF functions
+    dimF    : number of functions
+    evalgrid: 1-D array prespecified grid of x-values
+    nGrid   : number of x-grid points to evaluate f(x)
+    minval  : minimum x-value for optimization of f(x)
+    maxval  : maximum x-value for optimization of f(x)
+    xtol    : width of the bracket at which the search stops (default: 1e-7)
+    maxiter : maximum number of golden section steps (default: 100)
+    --------------------------------------------------------------------------
+    Output list:
+    [xopt, f(xopt)]
+    xopt    : 1-D array of x-values at the optima
+    f(xopt) : 1-D array of function values at the optima
+    --------------------------------------------------------------------------
+    '''
+    if evalgrid is not None:
+        evalgrid = np.sort(evalgrid)
+    [evalgrid,resultgrid] = evalgrid1D(lambda x: f(np.full(dimF,x)), evalgrid = evalgrid, nGrid=nGrid, minval=minval, maxval = maxval, dimF=dimF)
+
+    i_currentmin = resultgrid.argmin(0)
+    xopt = evalgrid[i_currentmin]
+    fopt = resultgrid[i_currentmin,np.arange(dimF)]
+
+    #the grid points that are local minima, like the triplets and boundary checks of minimize1D
+    is_min = np.ones(resultgrid.shape, dtype=bool)
+    is_min[1:] &= resultgrid[1:] < resultgrid[:-1]
+    is_min[:-1] &= resultgrid[:-1] < resultgrid[1:]
+    min_count = is_min.sum(0)
+
+    #search the j-th local minimum of every function at once. A function with fewer local minima searches its grid minimum again.
+    for j in range(max(min_count.max(),1)):
+        i_min = np.array([np.flatnonzero(is_min[:,k])[j] if j < min_count[k] else i_currentmin[k] for k in range(dimF)])
+        a = evalgrid[np.maximum(i_min-1,0)]
+        b = evalgrid[np.minimum(i_min+1,evalgrid.shape[0]-1)]
+        for x, fx in _golden_section_multi(f, a, b, xtol, maxiter):
+            is_better = fx < fopt
+            xopt = np.where(is_better, x, xopt)
+            fopt = np.where(is_better, fx, fopt)
+
+    if return_grid:
+        return (xopt, fopt, evalgrid, resultgrid)
+    else:
+        return [xopt, fopt]
+
+
+def _golden_section_multi(f, a, b, xtol, maxiter):
+    '''
+    golden section search of a vectorized f(x) in the brackets [a,b]. Returns the last two points searched, with their values.
+    '''
+    invphi = (np.sqrt(5.0) - 1.0) / 2.0
+    c = b - invphi * (b - a)
+    d = a + invphi * (b - a)
+    fc = f(c)
+    fd = f(d)
+    for i in range(maxiter):
+        if (b - a).max() < xtol:
+            break
+        is_left = fc < fd #the minimum is in [a,d]
+        b = np.where(is_left, d, b)
+        a = np.where(is_left, a, c)
+        x = np.where(is_left, b - invphi * (b - a), a + invphi * (b - a))
+        fx = f(x)
+        c, fc, d, fd = np.where(is_left, x, d), np.where(is_left, fx, fd), np.where(is_left, c, x), np.where(is_left, fc, fx)
+    return [(c,fc),(d,fd)]
+
+
+def evalgrid1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, dimF=0, vectorized=False):
     '''
     evaluate a function f(x) on all values of a grid.
     --------------------------------------------------------------------------
@@ -78,6 +158,9 @@ def evalgrid1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, dimF=
     nGrid   : number of x-grid points to evaluate f(x)
     minval  : minimum x-value for optimization of f(x)
     maxval  : maximum x-value for optimization of f(x)
+    dimF    : number of values returned by f(x) (default: 0, a single value)
+    vectorized: if True, f(x) accepts the 1-D array of all x-values and returns the array of their
+              function values (with a row per x-value, if dimF), so f is called only once. (default: False)
     --------------------------------------------------------------------------
     Output:
     evalgrid    : x-values
@@ -91,6 +174,11 @@ def evalgrid1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, dimF=
         resultgrid = SP.ones((evalgrid.shape[0],dimF))*9999999999999.0
     else:
         resultgrid = SP.ones(evalgrid.shape[0])*9999999999999.0
+    if vectorized:
+        fevalgrid = np.asarray(f(evalgrid))
+        assert np.isreal(fevalgrid).all(),"function returned imaginary value"
+        resultgrid[:] = fevalgrid.reshape(resultgrid.shape)
+        return (evalgrid,resultgrid)
     for i in range(evalgrid.shape[0]):        
         fevalgrid = f(evalgrid[i])
 
@@ -105,3 +193,47 @@ def evalgrid1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, dimF=
     return (evalgrid,resultgrid)
 
 
+
+
+def minimize1D_newton(f, x0, minval, maxval, gtol=1e-6, xtol=1e-8, maxiter=50, maxstep=5.0):
+    '''
+    minimize a function f(x) between minval and maxval with Newton steps, each safeguarded by
+    a backtracking line search. Where f is not convex, a gradient step of length 1 is taken instead.
+    --------------------------------------------------------------------------
+    Input:
+    f(x)    : callable target function that returns the triple (f(x), f'(x), f''(x))
+    x0      : starting x-value
+    minval  : minimum x-value for optimization of f(x)
+    maxval  : maximum x-value for optimization of f(x)
+    gtol    : converged when |f'(x)| is at most gtol (default: 1e-6)
+    xtol    : converged when a step is at most xtol (default: 1e-8)
+    maxiter : maximum number of steps (default: 50)
+    maxstep : maximum length of a step (default: 5.0)
+    --------------------------------------------------------------------------
+    Output list:
+    [xopt, f(xopt), f'(xopt), iterations, converged]
+    converged   : False if maxiter was reached, the line search failed, or a bound stopped the search
+    --------------------------------------------------------------------------
+    '''
+    x = min(max(x0,minval),maxval)
+    fx, gx, hx = f(x)
+    for iteration in range(1,maxiter+1):
+        if abs(gx) <= gtol:
+            return [x, fx, gx, iteration-1, True]
+        step = -gx / hx if hx > 0 else -np.sign(gx)
+        step = max(min(step,maxstep),-maxstep)
+        for halving in range(30):
+            x_new = min(max(x+step,minval),maxval)
+            if x_new == x:
+                return [x, fx, gx, iteration, False] #a bound stops the search
+            f_new, g_new, h_new = f(x_new)
+            if f_new <= fx:
+                break
+            step /= 2.0
+        else:
+            return [x, fx, gx, iteration, False]
+        converged = abs(x_new-x) <= xtol
+        x, fx, gx, hx = x_new, f_new, g_new, h_new
+        if converged:
+            return [x, fx, gx, iteration, True]
+    return [x, fx, gx, maxiter, abs(gx) <= gtol]
@@ -0,0 +1,128 @@
+"""
+read and write tables of association results as tab-delimited text, Parquet or Feather
+"""
+
+import os
+import pandas as pd
+
+#: File name suffixes that select a binary, columnar format. Any other name is written as tab-delimited text.
+result_suffixes = {".parquet": "parquet", ".feather": "feather"}
+
+#: Columns whose min/max are recorded for each Parquet row group, so readers can skip row groups
+#: (for example, with pandas.read_parquet(..., filters=[("PValue", "<", 5e-8)])).
+statistics_columns = ["PValue", "Chr"]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError(
+            "Parquet and Feather result files need 'pyarrow'. Install it with 'pip install fastlmm[parquet]' or 'pip install pyarrow'."
+        ) from e
+    return pyarrow
+
+
+def get_result_format(file_name, result_format=None):
+    """
+    Returns 'tsv', 'parquet' or 'feather'. If result_format is not given, it is taken from file_name's suffix.
+
+    >>> from fastlmm.util.result_file import get_result_format
+    >>> get_result_format("results/gwas.parquet"), get_result_format("results/gwas.txt"), get_result_format(None)
+    ('parquet', 'tsv', 'tsv')
+    """
+    if result_format is not None:
+        assert result_format in {"tsv", "parquet", "feather"}, (
+            "Expect result_format to be 'tsv', 'parquet' or 'feather', not '{0}'".format(
+                result_format
+            )
+        )
+        return result_format
+    if file_name is None:
+        return "tsv"
+    return result_suffixes.get(os.path.splitext(str(file_name))[1].lower(), "tsv")
+
+
+def write_results(frame, file_name, result_format=None, row_group_size=100000):
+    """
+    Write a frame of results. Parquet files are zstd compressed, with row groups of row_group_size rows and
+    statistics on the :data:`statistics_columns`. Feather files are zstd compressed. Both need 'pyarrow'.
+    """
+    write_results_chunks([frame], file_name, result_format, row_group_size)
+
+
+def write_results_chunks(
+    chunk_sequence, file_name, result_format=None, row_group_size=100000
+):
+    """
+    Like :func:`write_results`, but writes a sequence of frames, one at a time, as one table.
+    Every chunk is cast to the column types of the first.
+    """
+    format = get_result_format(file_name, result_format)
+    if format == "tsv":
+        header = True
+        with open(file_name, "w", newline="") as out:
+            for chunk in chunk_sequence:
+                chunk.to_csv(out, sep="\t", index=False, header=header)
+                header = False
+        return
+
+    pa = _import_pyarrow()
+
+    writer = None
+    schema = None
+    try:
+        for chunk in chunk_sequence:
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = _arrow_writer(format, file_name, schema)
+            if format == "parquet":
+                writer.write_table(table, row_group_size=row_group_size)
+            else:
+                writer.write_table(table)
+        if writer is None:  # no chunks, so no columns
+            writer = _arrow_writer(format, file_name, pa.schema([]))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _arrow_writer(format, file_name, schema):
+    pa = _import_pyarrow()
+
+    if format == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.ParquetWriter(
+            file_name,
+            schema,
+            compression="zstd",
+            write_statistics=[
+                name for name in statistics_columns if name in schema.names
+            ],
+        )
+    # Feather version 2 is the Arrow IPC file format
+    return pa.ipc.new_file(
+        file_name, schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+    )
+
+
+def read_results(file_name, result_format=None):
+    """
+    Read a frame of results written by :func:`write_results` (or by DataFrame.to_csv(sep="\\t", index=False)).
+    """
+    format = get_result_format(file_name, result_format)
+    if format != "tsv":
+        _import_pyarrow()
+    if format == "parquet":
+        return pd.read_parquet(file_name)
+    if format == "feather":
+        return pd.read_feather(file_name)
+    return pd.read_csv(file_name, delimiter="\t")
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,175 @@
+"""
+write a large table of results, sorted by one column, without holding it in memory
+"""
+
+import os
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+from fastlmm.util.result_file import get_result_format, write_results_chunks
+
+
+class SortedWriter(object):
+    """
+    Collects frames of results. Each frame is sorted and spilled to a tab-delimited file in spill_dir.
+    :meth:`finish` merges the spilled files, fan_in at a time, into one sorted file. The merge reads
+    chunk_rows rows of each file at a time, so memory is bounded no matter how many rows there are.
+    Only the top_n rows with the smallest values stay in memory.
+
+    Values are copied from the spilled files as text, so the output is what DataFrame.to_csv(sep="\\t", index=False)
+    would have written for the whole sorted frame (up to the order of ties). Missing values of the 'by' column sort last.
+    If the output file name ends in '.parquet' or '.feather', the merged rows are written in that format instead
+    (see :mod:`fastlmm.util.result_file`), chunk_rows rows at a time.
+
+    :Example:
+
+    >>> import os
+    >>> import tempfile
+    >>> import pandas as pd
+    >>> from fastlmm.util.sorted_writer import SortedWriter
+    >>> temp_dir = tempfile.TemporaryDirectory()
+    >>> writer = SortedWriter(os.path.join(temp_dir.name, "spill"), top_n=2)
+    >>> writer.add(pd.DataFrame({"SNP": ["a", "b"], "PValue": [.5, .01]}))
+    >>> writer.add(pd.DataFrame({"SNP": ["c", "d"], "PValue": [.2, .9]}))
+    >>> output_file = os.path.join(temp_dir.name, "sorted_writer_example.tsv")
+    >>> top = writer.finish(output_file)
+    >>> print(list(top.SNP), list(pd.read_csv(output_file, sep="\\t").SNP))
+    ['b', 'c'] ['b', 'c', 'a', 'd']
+    >>> temp_dir.cleanup()
+    """
+
+    def __init__(self, spill_dir, top_n=0, by="PValue", fan_in=64, chunk_rows=100000):
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = spill_dir
+        self.top_n = top_n
+        self.by = by
+        self.fan_in = fan_in
+        self.chunk_rows = chunk_rows
+        self.files = []
+        self.row_count = 0
+        self.top = None
+
+    def _new_file(self):
+        fd, file = tempfile.mkstemp(suffix=".tsv", dir=self.spill_dir)
+        os.close(fd)
+        return file
+
+    def add(self, frame):
+        """
+        Spill a frame of results. If frame.attrs["sorted_file"] is set (as it is on the result of
+        finish() with no output file), frame is that file's top rows and the file is merged as is.
+        """
+        sorted_file = frame.attrs.get("sorted_file")
+        if sorted_file is not None:
+            self.files.append(sorted_file)
+            self.row_count += frame.attrs["row_count"]
+        else:
+            frame = frame.sort_values(by=self.by, kind="mergesort")
+            if len(frame) > 0:
+                file = self._new_file()
+                frame.to_csv(file, sep="\t", index=False)
+                self.files.append(file)
+                self.row_count += len(frame)
+        top = frame if self.top is None else pd.concat([self.top, frame])
+        self.top = top.sort_values(by=self.by, kind="mergesort").head(self.top_n)
+        self.top.attrs = {}
+
+    def finish(self, output_file_name=None):
+        """
+        Merge the spilled files into output_file_name and remove them. Returns the top_n rows.
+        If output_file_name is None, the merged file stays in spill_dir and the returned frame's
+        attrs["sorted_file"] and attrs["row_count"] describe it (for a later SortedWriter.add).
+        """
+        while len(self.files) > self.fan_in:
+            files = []
+            for start in range(0, len(self.files), self.fan_in):
+                group = self.files[start : start + self.fan_in]
+                if len(group) == 1:
+                    files.extend(group)
+                else:
+                    files.append(self._merge(group, self._new_file()))
+            self.files = files
+
+        out_file = output_file_name if output_file_name is not None else self._new_file()
+        columnar = get_result_format(output_file_name) != "tsv"
+        text_file = self._new_file() if columnar else out_file
+        if len(self.files) == 0:
+            (self.top if self.top is not None else pd.DataFrame()).head(0).to_csv(
+                text_file, sep="\t", index=False
+            )
+        else:
+            self._merge(self.files, text_file)
+        self.files = []
+        if columnar:
+            with pd.read_csv(text_file, sep="\t", chunksize=self.chunk_rows) as reader:
+                write_results_chunks(reader, out_file)
+            os.remove(text_file)
+        logging.info(f"SortedWriter: wrote {self.row_count} rows to '{out_file}'")
+
+        top = self.top if self.top is not None else pd.DataFrame()
+        top.index = np.arange(len(top))
+        if output_file_name is None:
+            top.attrs["sorted_file"] = out_file
+            top.attrs["row_count"] = self.row_count
+        else:
+            try:
+                os.rmdir(self.spill_dir)
+            except OSError:
+                pass  # still holds files of other writers
+        return top
+
+    def _merge(self, files, out_file):
+        """
+        k-way merge of sorted files, a chunk of each at a time. Rows at or below the smallest
+        last-value of the chunks in hand can't be preceded by an unread row, so they are written.
+        """
+        readers = [
+            pd.read_csv(
+                file, sep="\t", dtype=str, keep_default_na=False, chunksize=self.chunk_rows
+            )
+            for file in files
+        ]
+        chunks = [_next_chunk(reader) for reader in readers]
+        keys = [self._keys(chunk) for chunk in chunks]
+        header = True
+        with open(out_file, "w", newline="") as out:
+            while True:
+                active = [i for i, chunk in enumerate(chunks) if chunk is not None]
+                if not active:
+                    break
+                cutoff = min(keys[i][-1] for i in active)
+                parts, part_keys = [], []
+                for i in active:
+                    n = np.searchsorted(keys[i], cutoff, side="right")
+                    parts.append(chunks[i].iloc[:n])
+                    part_keys.append(keys[i][:n])
+                    chunks[i], keys[i] = chunks[i].iloc[n:], keys[i][n:]
+                    if len(chunks[i]) == 0:
+                        chunks[i] = _next_chunk(readers[i])
+                        keys[i] = self._keys(chunks[i])
+                merged = pd.concat(parts)
+                order = np.argsort(np.concatenate(part_keys), kind="mergesort")
+                merged.iloc[order].to_csv(out, sep="\t", index=False, header=header)
+                header = False
+            if header:  # every file was empty
+                pd.read_csv(files[0], sep="\t", nrows=0).to_csv(out, sep="\t", index=False)
+        for reader in readers:
+            reader.close()
+        for file in files:
+            os.remove(file)
+        return out_file
+
+    def _keys(self, chunk):
+        if chunk is None:
+            return None
+        keys = pd.to_numeric(chunk[self.by].replace("", np.nan)).to_numpy(dtype=float)
+        keys[np.isnan(keys)] = np.inf
+        return keys
+
+
+def _next_chunk(reader):
+    for chunk in reader:
+        if len(chunk) > 0:
+            return chunk
+    return None
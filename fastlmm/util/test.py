@@ -43,6 +43,11 @@ class TestDocStrings(unittest.TestCase):
         os.chdir(old_dir)
         assert result.failed == 0, "failed doc test: " + __file__
 
+    def test_sorted_writer(self):
+        import fastlmm.util.sorted_writer
+        result = doctest.testmod(fastlmm.util.sorted_writer)
+        assert result.failed == 0, "failed doc test: " + __file__
+
 
 
 def getTestSuite():
@@ -98,4 +98,7 @@ setup(
         "psutil>=5.6.7",
         "fastlmmclib>=0.0.2",
     ],
+    extras_require={
+        "parquet": ["pyarrow>=4.0.0"],
+    },
 )